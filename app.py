@@ -1,6 +1,6 @@
 ### All necessary library to meke the web application work:
 ### Import Flask and other utilities templates, handling sessions, redirects, requests, and JSON responses
-from flask import Flask, json, render_template, redirect, url_for, session, request, jsonify
+from flask import Flask, json, render_template, redirect, url_for, session, request, jsonify, Response, stream_with_context, g
 ### Import FlaskForm for creating secure web forms and field types
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, IntegerField, SelectField, TextAreaField
@@ -14,33 +14,86 @@ from flask_mysqldb import MySQL
 import os
 ### Handle environment variables in a .env environment
 from dotenv import load_dotenv
-### SMTP ptotocol for handling emails
-import smtplib
-from email.mime.text import MIMEText
 ### Generating and verifying secure tokens
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
-### Rendering of some templates
-from jinja2 import Template
 ### Custom log type
 from log_types import LogType
+### Cache for LLM replies
+from llm_cache import ResponseCache
+from semantic_cache import SemanticCache
 ### Handling authentication with google ID
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 ### Handling real time chat
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 ### Handlig AI API
 from langchain_groq import ChatGroq
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+### HTTP client with pooled keep-alive connections for the AI API
+import httpx
+### Deadlines, retries and concurrency limit for AI calls
+from llm_client import LLMClient, RateLimiter, CircuitBreaker, CircuitOpenError, TaskRoute
+### Other AI backends (local llama.cpp, deterministic stub, recorder, reasoning budget)
+from llm_providers import LlamaCppProvider, StubProvider, RecordingProvider, ReasoningBudgetProvider
+### Thread pool for concurrent AI batches
+from concurrent.futures import ThreadPoolExecutor
+### Durable background jobs for work that doesn't block the reply
+from jobs import JobRunner
+### Request-scoped unit of work for the DB writes of a chat turn
+from unit_of_work import UnitOfWork, session_statement_counts
+### Concurrent stages of the chat pipeline and their own DB connections
+from pipeline import Pipeline, PipelineStats
+from db_pool import ConnectionPool
+### In-memory conversation state, written through, with last activity written behind
+from conversation_cache import ConversationCache, ConversationState, utc_now
+### Per-user profile part of the chat context, checked against users.context_version
+from profile_cache import ProfileCache, ProfileContext, profile_sentence
+### Countries and form choices kept in memory, reloaded when their version is bumped
+from reference_data import ReferenceData, GENDER_CHOICES
+### Audit trail written in batches by a background worker
+from audit_log import AuditLogger
+### Keyset pagination of the log viewers
+from keyset import encode_cursor, decode_cursor, after_cursor, page_size, like_pattern, PAGE_SIZE
+### Email logs stored as template version + variables, rendered again when viewed
+from email_log_store import TemplateVersions, pack_variables, pack_content, unpack_json, render_stored, compile_template
+### Emails queued in the transaction of the change they are about, sent in the background
+from email_outbox import EmailOutbox, SmtpSender, enqueue_email
+from smtp_stand_in import SmtpStandIn
+### Partitioning, retention and archives of app_logs
+from log_retention import LogRetention, parse_policy, scan_archives
+### Hourly counters of the audit log
+from log_rollups import rollup_series, backfill_rollups, hour_bucket, ROLLUP_BUCKETS
+### Native thread pool for blocking calls when running under eventlet
+try:
+    from eventlet import patcher as eventlet_patcher, tpool
+except ImportError:
+    eventlet_patcher = tpool = None
+### Coalescing of concurrent title generations
+from singleflight import SingleFlight
+### Local nearest-neighbour category classifier
+from category_classifier import NearestCategoryClassifier, lexical_tokens
 ### To work with regular expressions
 import re
 ### NLP processing
 from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+### Command line options for the flask CLI commands
+import click
+### Fingerprints of keyword sets
+import hashlib
+### Synthetic rows of the benchmarks
+import random
 ### Handling dates and times
 from datetime import datetime, timedelta, timezone
+import time
+### Background writer of the conversations' last activity
+import threading
+import atexit
 ### Tokenisation 
 import tiktoken
 ### Counter of occurrencies
 from collections import Counter
+### Caching of expensive objects
+from functools import lru_cache
 ### Creates default lists for each key
 from collections import defaultdict
 
@@ -70,16 +123,284 @@ app.config['MYSQL_PASSWORD'] = os.getenv("MYSQL_PASSWORD")  # password of the da
 app.config['MYSQL_DB'] = os.getenv("MYSQL_DB")   # database name
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)  # session timeout
 MAX_TOKENS = 6000
+### Tokens kept free in the context window for the model's reply
+REPLY_TOKENS_RESERVED = int(os.getenv("REPLY_TOKENS_RESERVED", 1024))
+### Upper bound of history messages read per turn, whatever their size
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", 50))
+### Stream chat replies token-by-token over Socket.IO ('bot_reply_chunk' events)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "true").lower() in ("1", "true", "yes")
 
 ### Initialise MySQL with Flask app
 mysql = MySQL(app)
 
+### Function that opens a connection for the pool (autocommit so reads always see the latest rows)
+def open_pooled_connection():
+    with app.app_context():
+        connection = mysql.connect
+    connection.autocommit(True)
+    return connection
+
+### Connections used by the concurrent stages of the chat pipeline
+db_pool = ConnectionPool(open_pooled_connection, size=int(os.getenv("DB_POOL_SIZE", 8)))
+### Bounded pool running the independent steps before the AI call (green threads under eventlet)
+chat_pipeline_executor = ThreadPoolExecutor(max_workers=int(os.getenv("CHAT_PIPELINE_WORKERS", 16)))
+chat_pipeline_stats = PipelineStats()
+### Countries registry, workers check the stored version at most every REFERENCE_DATA_CHECK_SECONDS
+reference_data = ReferenceData(db_pool.connection, check_interval=float(os.getenv("REFERENCE_DATA_CHECK_SECONDS", 60)))
+### Audit log entries are queued and written with executemany every AUDIT_LOG_FLUSH_SECONDS or AUDIT_LOG_BATCH_SIZE entries
+audit_logger = AuditLogger(
+    db_pool.connection,
+    spawn=socketio.start_background_task,
+    run=lambda fn, *args: offload(fn, *args),
+    batch_size=int(os.getenv("AUDIT_LOG_BATCH_SIZE", 200)),
+    flush_interval=float(os.getenv("AUDIT_LOG_FLUSH_SECONDS", 1)),
+    max_queue=int(os.getenv("AUDIT_LOG_MAX_QUEUE", 10000)),
+    types_check_interval=float(os.getenv("LOG_TYPES_CHECK_SECONDS", 30))
+)
+### Entries still queued when the process stops are written on exit
+atexit.register(audit_logger.close)
+### Months of app_logs kept in the database (LOG_RETENTION_MONTHS) and the log types kept shorter or longer
+### (LOG_RETENTION_POLICY, "LOG_TYPE=months,..."); older rows are moved to the archives in LOG_ARCHIVE_DIR
+log_retention = LogRetention(
+    archive_dir=os.getenv("LOG_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "log_archive")),
+    default_months=int(os.getenv("LOG_RETENTION_MONTHS", 6)),
+    policy=parse_policy(
+        os.getenv("LOG_RETENTION_POLICY", "LOGIN_FAILED=24,PASSWORD_RESET_FAILED=24,TOKEN_INVALID=24,USER_DELETED=24,PRODUCT_VIEWED=1"),
+        {log_type.value for log_type in LogType}
+    ),
+    months_ahead=int(os.getenv("LOG_PARTITIONS_AHEAD", 3))
+)
+
+### Deadline (seconds) of short AI tasks such as titles and category picks
+LLM_SHORT_TASK_TIMEOUT = float(os.getenv("LLM_SHORT_TASK_TIMEOUT", 30))
+### Maximum number of AI requests in flight at the same time (per worker)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+
+### One HTTP client shared by every Groq model so connections are kept alive and reused
+llm_http_client = httpx.Client(
+    limits=httpx.Limits(
+        max_connections=LLM_MAX_CONCURRENCY,
+        max_keepalive_connections=LLM_MAX_CONCURRENCY,
+        keepalive_expiry=120
+    )
+)
+
 ### Create DeepSeek chat model
 deepseek_chat = ChatGroq(
     api_key=DEEPSEEK_API_KEY,
-    model_name="deepseek-r1-distill-llama-70b"  # or "deepseek-r1-distill-llama-70b" if available
+    model_name="deepseek-r1-distill-llama-70b",  # or "deepseek-r1-distill-llama-70b" if available
+    ### Retries are handled by LLMClient (429/5xx only, with backoff)
+    max_retries=0,
+    http_client=llm_http_client
+)
+
+### AI backend of each task: "groq", "llama_cpp" (local GGUF model) or "stub" (load tests)
+### LLM_PROVIDER sets the default, LLM_PROVIDER_CHAT / _TITLE / _CATEGORY override it per task
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "groq").lower()
+LLM_TASKS = ("chat", "title", "category")
+LLM_TASK_PROVIDERS = {task: os.getenv(f"LLM_PROVIDER_{task.upper()}", LLM_PROVIDER).lower() for task in LLM_TASKS}
+### Groq model of each task: the reasoning model for chat, a small fast model for the short tasks
+### (short tasks escalate to the reasoning model when the small model's answer fails validation)
+LLM_SMALL_MODEL = os.getenv("LLM_SMALL_MODEL", "llama-3.1-8b-instant")
+LLM_TASK_MODELS = {
+    "chat": os.getenv("LLM_MODEL_CHAT", deepseek_chat.model_name),
+    "title": os.getenv("LLM_MODEL_TITLE", LLM_SMALL_MODEL),
+    "category": os.getenv("LLM_MODEL_CATEGORY", LLM_SMALL_MODEL)
+}
+### Latency SLO (seconds) and output token cap of each task (0 = no cap)
+LLM_TASK_SLOS = {task: float(os.getenv(f"LLM_SLO_{task.upper()}", default)) for task, default in (("chat", 20), ("title", 3), ("category", 3))}
+LLM_TASK_MAX_TOKENS = {task: int(os.getenv(f"LLM_MAX_TOKENS_{task.upper()}", default)) for task, default in (("chat", 0), ("title", 64), ("category", 256))}
+### When set, responses of real backends are appended to this JSON lines file (replayed by the stub)
+LLM_RECORD_PATH = os.getenv("LLM_RECORD_PATH")
+### Groq models that write a <think> block before answering
+LLM_REASONING_MODELS = set(os.getenv("LLM_REASONING_MODELS", deepseek_chat.model_name).split(","))
+### Reasoning output of those models per task (LLM_REASONING_MODE, overridden by LLM_REASONING_<TASK>):
+### "raw" keeps the <think> block, "hidden" asks Groq to leave it out of the response and "budget"
+### cuts it after LLM_REASONING_BUDGET_<TASK> tokens and makes the model answer
+LLM_REASONING_MODES = {task: os.getenv(f"LLM_REASONING_{task.upper()}", os.getenv("LLM_REASONING_MODE", "raw")).lower() for task in LLM_TASKS}
+LLM_REASONING_BUDGETS = {task: int(os.getenv(f"LLM_REASONING_BUDGET_{task.upper()}", default)) for task, default in (("chat", 512), ("title", 128), ("category", 128))}
+
+### Function that creates a Groq chat model once per model name and reasoning format
+@lru_cache(maxsize=None)
+def get_groq_model(model_name, reasoning_format=None):
+    if model_name == deepseek_chat.model_name and reasoning_format is None:
+        return deepseek_chat
+    options = {"reasoning_format": reasoning_format} if reasoning_format else {}
+    return ChatGroq(api_key=DEEPSEEK_API_KEY, model_name=model_name, max_retries=0, http_client=llm_http_client, **options)
+
+### Function that gets the Groq model of a task with its reasoning mode applied
+def create_groq_provider(task, model_name):
+    mode = LLM_REASONING_MODES[task] if model_name in LLM_REASONING_MODELS else "raw"
+    if mode == "hidden":
+        return get_groq_model(model_name, "hidden")
+    if mode == "budget":
+        return ReasoningBudgetProvider(get_groq_model(model_name), LLM_REASONING_BUDGETS[task])
+    return get_groq_model(model_name)
+
+### Function that loads the local llama.cpp model once, shared by every task using it
+@lru_cache(maxsize=1)
+def get_llama_provider():
+    return LlamaCppProvider(
+        os.getenv("LLAMA_MODEL_PATH", os.path.join("models", "model.gguf")),
+        processes=int(os.getenv("LLAMA_PROCESSES", 1)),
+        n_ctx=int(os.getenv("LLAMA_CONTEXT", 4096)),
+        max_tokens=int(os.getenv("LLAMA_MAX_TOKENS", 256))
+    )
+
+### Function that creates the AI backend of a task (name and model default to the task's configuration)
+def create_llm_provider(task, name=None, model_name=None):
+    name = name or LLM_TASK_PROVIDERS[task]
+    if name == "groq":
+        provider = create_groq_provider(task, model_name or LLM_TASK_MODELS[task])
+    elif name == "llama_cpp":
+        provider = get_llama_provider()
+    elif name == "stub":
+        ### Stub latency and output length distributions (milliseconds / tokens, normal distributions)
+        return StubProvider(
+            task,
+            latency_ms=float(os.getenv("LLM_STUB_LATENCY_MS", 800)),
+            latency_jitter_ms=float(os.getenv("LLM_STUB_LATENCY_JITTER_MS", 200)),
+            token_ms=float(os.getenv("LLM_STUB_TOKEN_MS", 10)),
+            tokens=int(os.getenv("LLM_STUB_TOKENS", 120)),
+            tokens_jitter=int(os.getenv("LLM_STUB_TOKENS_JITTER", 30)),
+            seed=int(os.getenv("LLM_STUB_SEED", 0)),
+            replay_path=os.getenv("LLM_STUB_REPLAY_PATH")
+        )
+    else:
+        raise ValueError(f"Unknown AI provider '{name}' for task '{task}'")
+    if LLM_RECORD_PATH:
+        provider = RecordingProvider(provider, LLM_RECORD_PATH)
+    return provider
+
+### Function that builds the routing table: backend, SLO and token cap of every task
+def create_llm_routes():
+    routes = {}
+    for task in LLM_TASKS:
+        name = LLM_TASK_PROVIDERS[task]
+        model_name = LLM_TASK_MODELS[task] if name == "groq" else name
+        escalate_to = None
+        ### Short tasks served by a small Groq model escalate to the reasoning model; the stub and the local
+        ### model never do, so load tests and local runs don't spend API quota
+        if task != "chat" and name == "groq" and model_name != deepseek_chat.model_name:
+            escalate_to = TaskRoute(
+                create_llm_provider(task, "groq", deepseek_chat.model_name),
+                model=deepseek_chat.model_name,
+                timeout=LLM_SHORT_TASK_TIMEOUT
+            )
+        routes[task] = TaskRoute(
+            create_llm_provider(task),
+            model=model_name,
+            slo=LLM_TASK_SLOS[task],
+            max_tokens=LLM_TASK_MAX_TOKENS[task] or None,
+            timeout=None if task == "chat" else LLM_SHORT_TASK_TIMEOUT,
+            escalate_to=escalate_to
+        )
+    return routes
+
+### Circuit breaker of the chat path: opens after N failures or replies slower than the SLO (seconds,
+### time to first chunk when streaming), then fails fast with the canned apology until a probe succeeds
+chat_breaker = CircuitBreaker(
+    failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", 5)),
+    latency_slo=float(os.getenv("LLM_CHAT_LATENCY_SLO", 20)),
+    reset_timeout=float(os.getenv("LLM_BREAKER_RESET", 30)),
+    half_open_max_calls=int(os.getenv("LLM_BREAKER_PROBES", 1))
+)
+### Hedged chat requests: a second request starts when the first is slower than the rolling p95
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+
+### Client used for every AI call (per-call deadline, retries, concurrency limit, breaker, hedging, metrics)
+llm_client = LLMClient(
+    deepseek_chat,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=float(os.getenv("LLM_TIMEOUT", 60)),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", 3)),
+    routes=create_llm_routes(),
+    breakers={"chat": chat_breaker},
+    hedge_tasks={"chat"} if LLM_HEDGE_ENABLED else (),
+    ### Maximum share of chat calls that may be hedged
+    hedge_budget=float(os.getenv("LLM_HEDGE_BUDGET", 0.1))
 )
 
+### Persistent cache for DeepSeek replies (TTL + size bounded LRU)
+response_cache = ResponseCache(
+    os.getenv("LLM_CACHE_DIR", os.path.join(".cache", "llm")),
+    ttl=int(os.getenv("LLM_CACHE_TTL", 24 * 3600)),
+    size_limit=int(os.getenv("LLM_CACHE_SIZE_LIMIT", 256 * 1024 * 1024)),
+    namespace=LLM_TASK_MODELS["chat"] if LLM_TASK_PROVIDERS["chat"] == "groq" else LLM_TASK_PROVIDERS["chat"],
+    enabled=os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+)
+
+### In-memory semantic cache for near-duplicate first-turn product queries
+semantic_cache = SemanticCache(
+    capacity=int(os.getenv("SEMANTIC_CACHE_SIZE", 512)),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.85)),
+    enabled=os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+)
+
+### Background job runner (titles, auto-categorization, ...)
+job_runner = JobRunner(
+    app, mysql,
+    spawn=socketio.start_background_task,
+    workers=int(os.getenv("JOB_WORKERS", 2)),
+    poll_interval=float(os.getenv("JOB_POLL_INTERVAL", 2))
+)
+### Count the MySQL statements and commits of every chat turn (SHOW SESSION STATUS, see /api/db/stats)
+DB_STATEMENT_STATS = os.getenv("DB_STATEMENT_STATS", "false").lower() in ("1", "true", "yes")
+db_turn_stats = {"turns": 0, "statements": 0, "commits": 0, "last": None}
+### Titles replaced by AI generated ones
+DEFAULT_TITLES = {"chat session", "untitled", "new chat after timeout"}
+### Prefix of the title used when the AI title generation failed, replaced like a default title
+FALLBACK_TITLE_PREFIX = "Chat Session: "
+### Seconds a worker waits for another worker generating the same conversation title
+TITLE_LOCK_TIMEOUT = int(os.getenv("TITLE_LOCK_TIMEOUT", 30))
+### Concurrent title generations of the same conversation share one AI call
+title_flight = SingleFlight()
+### Ids of the email template versions referenced by the email logs
+email_template_versions = TemplateVersions(db_pool.connection)
+### Attempts of an outbox email before it is marked dead (the delay doubles after every failure)
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", 5))
+### SMTP connection of the outbox sender; SMTP_SECURITY=none with SMTP_HOST=localhost SMTP_PORT=1025
+### sends to the local stand-in (flask smtp-stand-in)
+smtp_sender = SmtpSender(
+    host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+    port=int(os.getenv("SMTP_PORT", 465)),
+    username=os.getenv("EMAIL_USER"),
+    password=os.getenv("EMAIL_PASS"),
+    security=os.getenv("SMTP_SECURITY", "ssl").lower(),
+    timeout=float(os.getenv("SMTP_TIMEOUT", 30)),
+    idle_timeout=float(os.getenv("SMTP_IDLE_SECONDS", 60))
+)
+### Conversation rows and their newest messages kept in memory (see conversation_cache.py)
+conversation_cache = ConversationCache(
+    capacity=int(os.getenv("CONVERSATION_CACHE_SIZE", 2048)),
+    max_messages=MAX_HISTORY_MESSAGES
+)
+### Seconds between two bulk writes of the conversations' last activity
+ACTIVITY_FLUSH_SECONDS = float(os.getenv("ACTIVITY_FLUSH_SECONDS", 5))
+### Users' age, gender, country and prompt sentence kept in memory (see profile_cache.py)
+profile_cache = ProfileCache(capacity=int(os.getenv("PROFILE_CACHE_SIZE", 4096)))
+### Categorize every suggested product in the background right after it is saved
+AUTO_CATEGORIZE_PRODUCTS = os.getenv("AUTO_CATEGORIZE_PRODUCTS", "false").lower() in ("1", "true", "yes")
+
+### Category classification: "single_shot" (one AI call over pruned leaf paths) or "per_level" (one call per tree level)
+CATEGORY_CLASSIFIER_MODE = os.getenv("CATEGORY_CLASSIFIER_MODE", "single_shot")
+### Number of leaf paths sent to the model after lexical pruning
+CATEGORY_CANDIDATES = int(os.getenv("CATEGORY_CANDIDATES", 40))
+### Seconds the in-memory category tree is reused before being reloaded
+CATEGORY_INDEX_TTL = int(os.getenv("CATEGORY_INDEX_TTL", 600))
+category_index = {"data": None, "loaded_at": 0}
+### Local classifier tried before the AI, which is only used when the local prediction isn't confident
+CATEGORY_KNN_ENABLED = os.getenv("CATEGORY_KNN_ENABLED", "true").lower() in ("1", "true", "yes")
+### Seconds between two full rebuilds of the local classifier from the DB
+CATEGORY_KNN_REBUILD = int(os.getenv("CATEGORY_KNN_REBUILD", 3600))
+category_classifier = NearestCategoryClassifier(
+    max_products=int(os.getenv("CATEGORY_KNN_MAX_PRODUCTS", 4000)),
+    top_k=int(os.getenv("CATEGORY_KNN_TOP_K", 5)),
+    min_similarity=float(os.getenv("CATEGORY_KNN_MIN_SIMILARITY", 0.3)),
+    min_margin=float(os.getenv("CATEGORY_KNN_MIN_MARGIN", 0.1))
+)
+category_classifier_state = {"built_at": None}
+
 ### Token serializer
 s = URLSafeTimedSerializer(app.secret_key)
 
@@ -166,36 +487,28 @@ class ContactForm(FlaskForm):
 ###-------------------------------------------------------------------------
 ### Utility Functions
 
-### Function to count the tokens using tiktokens 
-def count_tokens(text):
+### Function that returns the tiktoken encoder, built once and reused
+@lru_cache(maxsize=1)
+def get_token_encoding():
     try:
         ### Attempt to get the appropriate encoding for GPT-3.5 Turbo
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")  # veya en yakın olanı
+        return tiktoken.encoding_for_model("gpt-3.5-turbo")  # veya en yakın olanı
     except KeyError:
         ### If the model is not found, fall back to a base encoding
-        encoding = tiktoken.get_encoding("cl100k_base")  # fallback
-    ### Return no of tokens
-    return len(encoding.encode(text))
+        return tiktoken.get_encoding("cl100k_base")  # fallback
 
-### Function to load from the Data Base the list of countries
-def load_countries_from_db():
-    cursor = mysql.connection.cursor()
-    cursor.execute("SELECT code, name FROM countries ORDER BY name")
-    countries = cursor.fetchall()
-    cursor.close()
-    return [{"code": code, "name": name} for code, name in countries]
+### Function to count the tokens using tiktokens 
+def count_tokens(text):
+    ### Return no of tokens
+    return len(get_token_encoding().encode(text or ""))
 
 ### Parse country code to extended name of the country
 def get_country_name(country_code):
     ### If input is empety return None
     if not country_code:
         return None    
-    countries = load_countries_from_db()
-    for country in countries:
-        if country['code'] == country_code:
-            return country['name']
     ### If the code is not found it will be retuned the country_code itself
-    return country_code
+    return reference_data.countries().names.get(country_code, country_code)
 
 ### Function that ensures a working connection to the database, reconnecting if necessary
 def get_db_connection():
@@ -217,14 +530,9 @@ def get_google_shopping_url(product_name, category_name=None):
 ###-------------------------------------------------------------------------
 ### Logging & Tracking
 
-### Returns the log type ID from the database based on an enum value
+### Returns the log type ID based on an enum value (from the log types map of the audit logger)
 def get_log_type_id(log_type: LogType):
-    cursor = mysql.connection.cursor()
-    ### Query
-    cursor.execute("SELECT log_type_id FROM log_types WHERE log_name = %s", (log_type.value,))
-    log_type_id = cursor.fetchone() # Get the log type ID from result
-    
-    cursor.close()
+    log_type_id = audit_logger.log_types().get(log_type.value)
 
     ### If log_type_id is found the function returns the ID
     if log_type_id:
@@ -235,43 +543,60 @@ def get_log_type_id(log_type: LogType):
         return None
 
 ### Function that inserts a int the Log (DB) an action
+### The entry is queued and written in a batch by the audit logger; disabled log types (isActive = 0) are skipped.
 def log_action(log_type: LogType, message, user_id=None):
-    log_type_id = get_log_type_id(log_type)
-    
-    ### Exit the function if log type is not valid
-    if log_type_id is None:
-        return
-    
-    cursor = mysql.connection.cursor()
+    audit_logger.log(log_type.value, message, user_id=user_id)
 
-    ### Query
-    cursor.execute("""
-        INSERT INTO app_logs (user_id, log_type_id, message)
-        VALUES (%s, %s, %s)
-    """, (user_id, log_type_id, message))
-
-    mysql.connection.commit()
-    cursor.close()
+### Function that logs an action once a unit of work is committed (message can be a function of its ids)
+def queue_log_action(uow, log_type: LogType, message, user_id=None):
+    uow.after_flush(lambda ids: log_action(log_type, message(ids) if callable(message) else message, user_id=user_id))
 
 ### Logs an email event in the database, including status and any errors
-def log_email(template_name, recipient_email, subject, body, status="SUCCESS", error=None):
-    cursor = mysql.connection.cursor()
+### With the template (raw subject and body) and its variables only the template version and the
+### compressed variables are stored; otherwise the rendered subject and body are stored compressed.
+### The owner is the user with the recipient address. With a connection the caller commits.
+def log_email(template_name, recipient_email, subject, body, status="SUCCESS", error=None, template=None, variables=None,
+              connection=None):
+    cursor = (connection or mysql.connection).cursor()
+
+    packed_variables = pack_variables(variables) if template and variables is not None else None
+    if packed_variables is not None:
+        template_version_id = email_template_versions.version_id(template_name, template["subject"], template["body"])
+        content = None
+    else:
+        template_version_id = None
+        content = pack_content(subject, body)
 
     ### Query
     cursor.execute("""
-        INSERT INTO email_logs (template_name, recipient_email, subject, body, status, error_message)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (template_name, recipient_email, subject, body, status, error))
+        INSERT INTO email_logs
+            (template_name, recipient_email, user_id, template_version_id, variables, content_compressed, status, error_message)
+        VALUES (%s, %s, (SELECT id FROM users WHERE email = %s LIMIT 1), %s, %s, %s, %s, %s)
+    """, (template_name, recipient_email, recipient_email, template_version_id, packed_variables, content, status, error))
 
-    mysql.connection.commit()
+    if connection is None:
+        mysql.connection.commit()
     cursor.close()
 
+### Function to get the subject and body of an email log
+### (legacy rows have them as text, compact rows are rendered again from their template version)
+def email_log_content(subject, body, content_compressed, variables, version_subject, version_body):
+    if content_compressed is not None:
+        content = unpack_json(content_compressed)
+        return content["subject"], content["body"]
+    if variables is not None and version_subject is not None:
+        return (
+            render_stored(version_subject, variables),
+            render_stored(version_body, variables) if version_body is not None else None
+        )
+    return subject, body
+
 ###-------------------------------------------------------------------------
 ### E-mail Handling
 
 ### Fetches the subject and body of an email template from the database
-def get_email_template(template_name):
-    cursor = mysql.connection.cursor()
+def get_email_template(template_name, connection=None):
+    cursor = (connection or mysql.connection).cursor()
     ### Query
     cursor.execute("SELECT subject, body FROM email_templates WHERE name = %s", (template_name,))
     result = cursor.fetchone()
@@ -282,48 +607,48 @@ def get_email_template(template_name):
 
 ### Function that using Jinja2 renders template string using the provided variables
 def render_template_from_db(text, variables):
-    template = Template(text)
-    return template.render(**variables)
+    return compile_template(text).render(**variables)
 
-### Function that sends an email using a DB stored template
-def send_email_from_template(template_name, to_email, variables):
-    template = get_email_template(template_name)
-    ### If the template is not found, print an error message and return False
+### Function that renders a queued email, (template, subject, body) (used by the outbox sender)
+def render_outbox_email(connection, template_name, variables):
+    template = get_email_template(template_name, connection)
+    ### Raising LookupError marks the email dead right away
     if not template:
-        print(f"Template {template_name} not found.")
-        return False
-
-    ### Render the subject and body using the provided variables
-    subject = render_template_from_db(template["subject"], variables)
-    ### Render the body using the provided variables
-    body = render_template_from_db(template["body"], variables)
-
-    ### Set up the email sender
-    sender_email = os.getenv("EMAIL_USER")
-    ### Set up the sender name
-    sender_name = "Botify"
-    ### Set up the sender password
-    sender_password = os.getenv("EMAIL_PASS")
-
-    ### Create the email message
-    message = MIMEText(body)
-    ### Set the email headers
-    message["Subject"] = subject
-    message['From'] = f"{sender_name} <{sender_email}>"
-    message["To"] = to_email
-
-    ### Try to set the email sender
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(message)
+        raise LookupError(f"Template {template_name} not found")
+    return template, render_template_from_db(template["subject"], variables), render_template_from_db(template["body"], variables)
+
+### Function that writes the email log of an outbox attempt with the sender's connection
+def record_outbox_email(connection, template_name, recipient_email, subject, body, status, error, template, variables):
+    log_email(template_name, recipient_email, subject, body, status=status, error=error,
+              template=template, variables=variables, connection=connection)
+
+### Function to queue an email in the transaction of the caller's cursor; it is sent after the caller commits
+### (the sender is woken up when the request ends)
+def queue_email(cursor, template_name, to_email, variables):
+    enqueue_email(cursor, template_name, to_email, variables, max_attempts=EMAIL_MAX_ATTEMPTS)
+    g.emails_queued = True
+
+### Background sender draining email_outbox in batches of EMAIL_OUTBOX_BATCH_SIZE
+email_outbox = EmailOutbox(
+    db_pool.connection,
+    spawn=socketio.start_background_task,
+    smtp=smtp_sender,
+    render=render_outbox_email,
+    record=record_outbox_email,
+    run=lambda fn, *args: offload(fn, *args),
+    batch_size=int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 20)),
+    poll_interval=float(os.getenv("EMAIL_OUTBOX_POLL_SECONDS", 5)),
+    retry_delay=int(os.getenv("EMAIL_RETRY_SECONDS", 30))
+)
+atexit.register(email_outbox.close)
 
-        log_email(template_name, to_email, subject, body, status="SUCCESS")
-        return True
-    ### If the email sender fails, log the error and return False
-    except Exception as e:
-        print("Email send failed:", str(e))
-        return False
+### Function that queues an email using a DB stored template on its own (committed right away)
+def send_email_from_template(template_name, to_email, variables):
+    cursor = mysql.connection.cursor()
+    queue_email(cursor, template_name, to_email, variables)
+    mysql.connection.commit()
+    cursor.close()
+    return True
 
 ### Send password reset email using a token
 def send_reset_email(to_email, token):
@@ -370,20 +695,8 @@ def separate_numbered_suggestions(text):
     matches = re.findall(pattern, text)
     return [{"name": name.strip(), "description": desc.strip()} for name, desc, _ in matches]
 
-### Function to get products suggestions from DeepSeek
-def ask_deepseek(user_message, user_context=None, conversation_history=None):
-    if conversation_history is None:
-        conversation_history = []
-
-    ### Terminal response
-    print(f"🧠🧠🧠 ask_deepseek called | message: {user_message}")
-    print(f"User context: {user_context}")
-    print(f"Conversation history length: {len(conversation_history)}")
-    print(f"Session: {session}")
-
-    try:
-        ### Prompt for the DeepSeek model
-        system_prompt = """
+### Prompt for the DeepSeek product model
+DEEPSEEK_SYSTEM_PROMPT = """
         You are an AI assistant designed to help users choose products.
 
         STRICT INSTRUCTIONS — FOLLOW CAREFULLY:
@@ -400,48 +713,104 @@ def ask_deepseek(user_message, user_context=None, conversation_history=None):
         <PRODUCT> - [Product Name] - [Short Description]
         ❗Do NOT use any numbering like "1.", "2.", etc. Only use <PRODUCT> tags.
         """
-        print(f"System prompt: {system_prompt}")
-        ### Add context if available
-        if user_context:
-            if user_context.get("age"):
-                ### Age of the user
-                system_prompt += f" The user is {user_context['age']} years old."
-            if user_context.get("gender"):
-                ### gender of the user
-                system_prompt += f" The user is a {user_context['gender']}."
-            if user_context.get("country"):
-                ### Country of the user
-                system_prompt += f" The user is from {user_context['country']}."
-            if user_context.get("keywords"):
-                ### Keywords of the user
-                system_prompt += f" The user's key concerns are: {', '.join(user_context['keywords'])}."
-
-        ### Build LangChain message list
-        messages = [SystemMessage(content=system_prompt)]
-        ### Terminal output
-        print (f"System prompt: {system_prompt}")
-        print (f"Messages: {messages}")
-        ### Add conversation history
-        for msg in conversation_history:
-            if msg["role"] == "user":
-                messages.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "bot":
-                messages.append(AIMessage(content=msg["content"]))
-
-        ### Add new user message
-        messages.append(HumanMessage(content=user_message))
-        print(f"Messages: {messages}")
-
-        ### Call the model
-        response = deepseek_chat(messages)
-        ### Terminal output response
-        print(f"Response: {response.content}")
-        ### Saving response variable with <think> tags removed
-        bot_reply = remove_thinking_tags(response.content)
+### Maximum number of products the prompt allows, used to stop streaming early
+MAX_PRODUCTS_PER_REPLY = 3
+
+### Function to build the system prompt sent to DeepSeek: the base prompt and the user's context
+def build_system_prompt(user_context=None):
+    system_prompt = DEEPSEEK_SYSTEM_PROMPT
+    ### Add context if available
+    if user_context:
+        ### Age, gender and country of the user, the sentence is prebuilt by the profile cache
+        if "profile_prompt" in user_context:
+            system_prompt += user_context["profile_prompt"]
+        else:
+            system_prompt += profile_sentence(user_context.get("age"), user_context.get("gender"), user_context.get("country"))
+        if user_context.get("keywords"):
+            ### Keywords of the user
+            system_prompt += f" The user's key concerns are: {', '.join(user_context['keywords'])}."
+    return system_prompt
+
+### Function to build the LangChain message list sent to DeepSeek
+def build_deepseek_messages(user_message, user_context=None, conversation_history=None):
+    system_prompt = build_system_prompt(user_context)
+
+    ### Build LangChain message list
+    messages = [SystemMessage(content=system_prompt)]
+    ### Terminal output
+    print (f"System prompt: {system_prompt}")
+    ### Add conversation history
+    for msg in conversation_history or []:
+        if msg["role"] == "user":
+            messages.append(HumanMessage(content=msg["content"]))
+        elif msg["role"] == "bot":
+            messages.append(AIMessage(content=msg["content"]))
+
+    ### Add new user message
+    messages.append(HumanMessage(content=user_message))
+    print(f"Messages: {messages}")
+    return messages
+
+### Function to check if the history has no bot reply yet (first turn of the conversation)
+def is_first_turn(conversation_history):
+    return not any(msg["role"] == "bot" for msg in conversation_history or [])
+
+### Function to look up a cached reply, returns (cache_key, reply or None)
+### The exact reply cache is checked first, then the semantic cache for first-turn prompts
+def get_cached_reply(user_message, user_context, conversation_history, use_cache=True):
+    cache_key = response_cache.make_key(user_message, user_context, conversation_history)
+    reply = response_cache.get(cache_key, bypass=not use_cache)
+    if reply is not None:
+        print("⚡ Reply served from cache")
+    elif use_cache and is_first_turn(conversation_history):
+        entry, similarity = semantic_cache.lookup(user_message, user_context)
+        if entry:
+            print(f"🧲 Reply served from semantic cache (similarity {similarity:.2f})")
+            reply = entry["reply"]
+    return cache_key, reply
+
+### Function to store a freshly generated reply in the caches
+def cache_reply(cache_key, user_message, user_context, conversation_history, bot_reply, structured):
+    ### An empty visible reply (e.g. the model only produced a <think> block) would be served until it expires
+    if not (bot_reply or "").strip():
+        print("⚠️ Empty reply, not cached")
+        return
+    response_cache.set(cache_key, bot_reply)
+    ### Only first-turn replies with products are worth sharing between similar prompts
+    if structured and is_first_turn(conversation_history):
+        semantic_cache.add(user_message, {"reply": bot_reply, "products": structured}, user_context)
+
+### Function to get products suggestions from DeepSeek
+def ask_deepseek(user_message, user_context=None, conversation_history=None, use_cache=True):
+    if conversation_history is None:
+        conversation_history = []
+
+    ### Terminal response
+    print(f"🧠🧠🧠 ask_deepseek called | message: {user_message}")
+    print(f"User context: {user_context}")
+    print(f"Conversation history length: {len(conversation_history)}")
+    print(f"Session: {session}")
+
+    try:
+        ### Look up the reply caches first (skipped when the request bypasses them)
+        cache_key, bot_reply = get_cached_reply(user_message, user_context, conversation_history, use_cache)
+        from_cache = bot_reply is not None
+        if not from_cache:
+            ### Build the prompt for the DeepSeek model
+            messages = build_deepseek_messages(user_message, user_context, conversation_history)
+
+            ### Call the model
+            response = llm_client.invoke(messages, call_site="chat", task="chat")
+            ### Terminal output response
+            print(f"Response: {response.content}")
+            ### Saving response variable with <think> tags removed
+            bot_reply = remove_thinking_tags(response.content)
         print(f"Bot reply: {bot_reply}")
         ### Clean response with previous functions
         structured = separate_numbered_suggestions(bot_reply)
         print(f"Structured response: {structured}")
+        if not from_cache:
+            cache_reply(cache_key, user_message, user_context, conversation_history, bot_reply, structured)
         ### Update history for next call
         conversation_history.append({"role": "user", "content": user_message})
         conversation_history.append({"role": "bot", "content": bot_reply})
@@ -449,6 +818,10 @@ def ask_deepseek(user_message, user_context=None, conversation_history=None):
         ### return row response and structured response
         return bot_reply, structured
 
+    ### While the AI provider is failing answer right away, without logging every rejected call
+    except CircuitOpenError as e:
+        print(f"⚡ {e}")
+        return "Sorry, I couldn't generate a response.", []
     ### If the model fails to respond, log the error and return a default message
     except Exception as e:
         log_action(
@@ -456,39 +829,215 @@ def ask_deepseek(user_message, user_context=None, conversation_history=None):
             f"AI response failed in conversation {session.get('conversation_id')}: {str(e)}",
             user_id=session.get("user_id")
         )        
-        return "Sorry, I couldn't generate a response.", conversation_history
+        return "Sorry, I couldn't generate a response.", []
+
+### Incremental parser for a streamed DeepSeek reply.
+### Hides <think> blocks on the fly (even when a tag is split across chunks)
+### and returns every <PRODUCT> line as soon as its line is complete.
+class ReplyStreamParser:
+    THINK_OPEN = "<think>"
+    THINK_CLOSE = "</think>"
+
+    def __init__(self, max_products=MAX_PRODUCTS_PER_REPLY):
+        self.max_products = max_products
+        self.in_think = False
+        ### Raw text not classified yet (may hold a partial tag)
+        self.pending = ""
+        ### Visible text of the line currently being streamed
+        self.line = ""
+        self.visible = []
+        self.products = []
+
+    ### True once the reply contains as many products as the prompt allows
+    @property
+    def done(self):
+        return len(self.products) >= self.max_products
+
+    ### Visible reply so far, equivalent to remove_thinking_tags() on the full text
+    @property
+    def text(self):
+        text = "".join(self.visible)
+        ### Drop the partial line generated after the last allowed product
+        if self.done and self.line:
+            text = text[:len(text) - len(self.line)]
+        return text.strip()
+
+    ### Length of the longest suffix of text that could be the start of tag
+    @staticmethod
+    def _partial_tag_length(text, tag):
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
+    ### Feed a raw chunk, returns (visible text delta, products completed by this chunk)
+    def feed(self, chunk):
+        self.pending += chunk
+        out = []
+        while self.pending:
+            if self.in_think:
+                end = self.pending.find(self.THINK_CLOSE)
+                ### Still thinking: drop everything except a possible partial closing tag
+                if end == -1:
+                    keep = self._partial_tag_length(self.pending, self.THINK_CLOSE)
+                    self.pending = self.pending[-keep:] if keep else ""
+                    break
+                self.pending = self.pending[end + len(self.THINK_CLOSE):]
+                self.in_think = False
+            else:
+                start = self.pending.find(self.THINK_OPEN)
+                if start != -1:
+                    out.append(self.pending[:start])
+                    self.pending = self.pending[start + len(self.THINK_OPEN):]
+                    self.in_think = True
+                    continue
+                ### Hold back a possible partial opening tag until the next chunk
+                keep = self._partial_tag_length(self.pending, self.THINK_OPEN)
+                out.append(self.pending[:len(self.pending) - keep])
+                self.pending = self.pending[len(self.pending) - keep:]
+                break
+        return self._emit("".join(out))
+
+    ### Flush the buffered text once the stream has ended
+    def finish(self):
+        rest = "" if self.in_think else self.pending
+        self.pending = ""
+        delta, products = self._emit(rest)
+        ### The last line has no trailing newline
+        if self.line and not self.done:
+            products += self._parse_line(self.line)
+            self.line = ""
+        return delta, products
+
+    def _emit(self, delta):
+        products = []
+        if not delta:
+            return delta, products
+        self.visible.append(delta)
+        self.line += delta
+        ### Parse every completed line
+        while "\n" in self.line and not self.done:
+            complete, self.line = self.line.split("\n", 1)
+            products += self._parse_line(complete)
+        return delta, products
+
+    def _parse_line(self, line):
+        found = separate_numbered_suggestions(line)[:self.max_products - len(self.products)]
+        self.products.extend(found)
+        return found
+
+### Function to get products suggestions from DeepSeek, streaming the reply over Socket.IO
+### Emits 'bot_reply_chunk' events while the model generates and returns the same
+### (bot_reply, structured) pair as ask_deepseek once the reply is complete.
+def stream_deepseek(user_message, user_context=None, conversation_history=None, conversation_id=None, use_cache=True):
+    if conversation_history is None:
+        conversation_history = []
+
+    ### Terminal response
+    print(f"🧠🌊 stream_deepseek called | message: {user_message}")
+    parser = ReplyStreamParser()
+
+    ### Push text deltas and freshly parsed products to the frontend
+    def push(delta, products):
+        if delta:
+            emit("bot_reply_chunk", {"content": delta, "conversation_id": conversation_id})
+        for product in products:
+            emit("bot_reply_chunk", {"product": product, "conversation_id": conversation_id})
+        ### Let eventlet flush the websocket frames before reading the next chunk
+        socketio.sleep(0)
+
+    try:
+        ### A cached reply is replayed through the parser as a single chunk
+        cache_key, cached_reply = get_cached_reply(user_message, user_context, conversation_history, use_cache)
+        if cached_reply is not None:
+            push(*parser.feed(cached_reply))
+            push(*parser.finish())
+        else:
+            messages = build_deepseek_messages(user_message, user_context, conversation_history)
+            stream = llm_client.stream(messages, call_site="chat_stream", task="chat")
+            try:
+                for chunk in stream:
+                    push(*parser.feed(chunk.content or ""))
+                    ### The prompt allows at most 3 products: stop generating once they are parsed
+                    if parser.done:
+                        print("⏹️ Product limit reached, stopping generation early")
+                        break
+            finally:
+                ### Closing the generator closes the HTTP stream to the provider
+                stream.close()
+            push(*parser.finish())
+            cache_reply(cache_key, user_message, user_context, conversation_history, parser.text, parser.products)
+    ### While the AI provider is failing answer right away, without logging every rejected call
+    except CircuitOpenError as e:
+        print(f"⚡ {e}")
+        return "Sorry, I couldn't generate a response.", []
+    ### If the model fails to respond, log the error and return a default message
+    except Exception as e:
+        log_action(
+            LogType.AI_RESPONSE_FAILED,
+            f"AI response failed in conversation {session.get('conversation_id')}: {str(e)}",
+            user_id=session.get("user_id")
+        )
+        return "Sorry, I couldn't generate a response.", []
+
+    bot_reply = parser.text
+    structured = parser.products
+    print(f"Bot reply: {bot_reply}")
+    print(f"Structured response: {structured}")
+    ### Update history for next call
+    conversation_history.append({"role": "user", "content": user_message})
+    conversation_history.append({"role": "bot", "content": bot_reply})
+    return bot_reply, structured
 
 ### Function to get user informations (age, gender, country)
-def get_user_context(user_id, conversation_id=None):
-    ### get user context from database
+### keywords can be passed when the caller already read them from the conversation row,
+### profile_version is the users.context_version kept in the session
+def get_user_context(user_id, conversation_id=None, keywords=None, profile_version=None):
+    ### get user context from the profile cache
     print(f"Fetching user context for user_id: {user_id}, conversation_id: {conversation_id}")
-    cursor = mysql.connection.cursor()
-    ### Query
-    cursor.execute("SELECT age, gender, country FROM users WHERE id = %s", (user_id,))
-    result = cursor.fetchone()
-
-    context = {}
+    profile = get_profile_context(user_id, profile_version)
     ### If user is found, get the context
-    if result:
-        context = {
-            "age": result[0],
-            "gender": result[1],
-            ### Get country name from the code using the function get_country_name(code)
-            "country": get_country_name(result[2])
-        }
+    context = profile.as_context() if profile else {}
 
     # get keywords from conversation if conversation_id is provided
     print(f"Fetching keywords for conversation_id: {conversation_id}")
-    if conversation_id:
-        ### Query
-        cursor.execute("SELECT keywords FROM conversations WHERE conversation_id = %s", (conversation_id,))
-        keyword_result = cursor.fetchone()
-        if keyword_result and keyword_result[0]:
-            context["keywords"] = [word.strip() for word in keyword_result[0].split(",")]
-            print(f"Keywords found: {context['keywords']}")
+    if keywords is None and conversation_id:
+        keywords = get_keywords_for_conversation(conversation_id)
+    if keywords:
+        context["keywords"] = keywords
+        print(f"Keywords found: {context['keywords']}")
+    return context
 
+### Function to read the profile of a user into the profile cache, None when there is no such user
+def load_profile_context(user_id, connection=None):
+    cursor = (connection or mysql.connection).cursor()
+    ### Query, the country name comes from the same query (the code itself when it is unknown)
+    cursor.execute("""
+        SELECT u.context_version, u.age, u.gender, COALESCE(c.name, NULLIF(u.country, ''))
+        FROM users u
+        LEFT JOIN countries c ON c.code = u.country
+        WHERE u.id = %s
+    """, (user_id,))
+    result = cursor.fetchone()
     cursor.close()
-    return context
+    if not result:
+        return None
+    return profile_cache.put(ProfileContext(user_id, *result))
+
+### Function to get the profile of a user from the cache, read on a pooled connection when it isn't cached
+### or is older than version
+def get_profile_context(user_id, version=None):
+    profile = profile_cache.get(user_id, version)
+    if profile is None:
+        profile = run_with_pooled_connection(load_profile_context, user_id)
+    return profile
+
+### Function to record a change of the user's profile
+### The UPDATE sets context_version = LAST_INSERT_ID(context_version + 1), so version is the cursor's lastrowid.
+### The new version goes in the session (other workers then see their entry as stale) and the local entry is dropped.
+def profile_changed(user_id, version):
+    profile_cache.invalidate(user_id)
+    session["profile_version"] = version
 
 ###--------------------------------------------------------------------------
 ### Conversation Management
@@ -506,6 +1055,8 @@ def start_new_conversation(user_id, title="Untitled"):
     conversation_id = cursor.lastrowid
     cursor.close()
     session['conversation_id'] = conversation_id
+    ### A new conversation is cached right away, with an empty history
+    conversation_cache.put(ConversationState(conversation_id, user_id, title, "", True, utc_now(), 0, []))
 
     ### Emit event to frontend
     emit("conversation_initialized", {"conversation_id": conversation_id})
@@ -516,53 +1067,51 @@ def start_new_conversation(user_id, title="Untitled"):
     )
     return conversation_id
 
+### Function to add new keywords to the stored keyword text, returns the sorted keyword text
+def merge_keywords(keyword_text, new_keywords):
+    existing_keywords = set()
+    ### If keywords are found, split them into a set
+    if keyword_text:
+        existing_keywords = set(k.strip() for k in keyword_text.split(','))
+    ### Union with new keywords, without duplicates
+    return ", ".join(sorted(existing_keywords.union(set(new_keywords))))
+
 ### Function to update conversation keywords
 def update_conversation_keywords(conversation_id, new_keywords):
     cursor = mysql.connection.cursor()
 
-    ### Query to get existing keywords
-    cursor.execute("SELECT keywords FROM conversations WHERE conversation_id = %s", (conversation_id,))
+    ### Query to get existing keywords (the row stays locked until the update is committed)
+    cursor.execute("SELECT keywords, version FROM conversations WHERE conversation_id = %s FOR UPDATE", (conversation_id,))
     result = cursor.fetchone()
-    existing_keywords = set()
-
-    ### If keywords are found, split them into a set
-    if result and result[0]:
-        existing_keywords = set(k.strip() for k in result[0].split(','))
-
-    ### Union with new keywords
-    combined_keywords = existing_keywords.union(set(new_keywords))
-    ### Remove duplicates
-    keyword_text = ", ".join(sorted(combined_keywords))
+    keyword_text = merge_keywords(result[0] if result else None, new_keywords)
 
     ### Query update keywords
     cursor.execute("""
-        UPDATE conversations SET keywords = %s WHERE conversation_id = %s
+        UPDATE conversations SET keywords = %s, version = version + 1 WHERE conversation_id = %s
     """, (keyword_text, conversation_id))
     mysql.connection.commit()
     cursor.close()
+    if result:
+        conversation_cache.apply(conversation_id, result[1], keywords=keyword_text)
 
 ### Function to update last activity timestamp
+### The timestamp is written behind: flush_conversation_activity writes the pending ones in one UPDATE
 def update_last_activity(conversation_id):
-    print(f"Updating last activity for conversation_id: {conversation_id}")
-    cursor = mysql.connection.cursor()
-    ### Query to update last activity timestamp
-    cursor.execute("""
-        UPDATE conversations SET last_activity_at = NOW() WHERE conversation_id = %s
-    """, (conversation_id,))
-    mysql.connection.commit()
-    cursor.close()
+    conversation_cache.touch(conversation_id)
 
 ### Function to check if a conversation has expired
+### The cached last activity misses activity on other workers, so an expired entry is read again before ending it
 def is_conversation_expired(conversation_id, minutes= 30):
     print(f"Checking if conversation_id: {conversation_id} is expired")
-    cursor = mysql.connection.cursor()
-    ### Query to get last activity timestamp
-    cursor.execute("SELECT last_activity_at FROM conversations WHERE conversation_id = %s", (conversation_id,))
-    result = cursor.fetchone()
-    print(f"Last activity result: {result}")
-    cursor.close()
-    if result and result[0]:
-        last_active = result[0]
+    state = get_conversation_state(conversation_id)
+    if state and last_activity_expired(state.last_activity_at, minutes):
+        state = get_conversation_state(conversation_id, refresh=True)
+    print(f"Last activity: {state.last_activity_at if state else None}")
+    return bool(state) and last_activity_expired(state.last_activity_at, minutes)
+
+### Function to check if a last activity timestamp is older than the given minutes
+def last_activity_expired(last_active, minutes=30):
+    if last_active:
         ### If last activity is older than the specified time, return True
         if datetime.now(timezone.utc) - last_active.replace(tzinfo=timezone.utc) > timedelta(minutes=minutes):
             return True
@@ -574,40 +1123,67 @@ def end_conversation(conversation_id):
     cursor = mysql.connection.cursor()
     ### Query to end the conversation
     cursor.execute("""
-        UPDATE conversations SET is_active = 0 WHERE conversation_id = %s
+        UPDATE conversations SET is_active = 0, version = version + 1 WHERE conversation_id = %s
     """, (conversation_id,))
     mysql.connection.commit()
     cursor.close()
+    conversation_cache.invalidate(conversation_id)
     ### Log the action
     log_action(LogType.CONVERSATION_ENDED, f"Conversation {conversation_id} auto-ended (timeout)", user_id=session.get("user_id"))
     session.pop('conversation_id', None)
 
-### Function to save a message in the database
-def save_message(conversation_id, sender_type, content):
+### Query to insert a new message, the token count is computed once and reused by the history
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (conversation_id, sender_type, content, token_count, sent_at)
+    VALUES (%s, %s, %s, %s, NOW())
+"""
+
+### Function to get the values of a new messages row
+def message_row(conversation_id, sender_type, content):
     ### If content is a list/tuple join into a single string
     if isinstance(content, (list, tuple)):
         ### Ensure all elements are strings and concatenate
         content = " ".join(map(str, content))
+    return (conversation_id, sender_type, content, count_tokens(content))
 
+### Function to save a message in the database
+def save_message(conversation_id, sender_type, content):
     cursor = mysql.connection.cursor()
-    ### Query to insert a new message
-    cursor.execute("""
-        INSERT INTO messages (conversation_id, sender_type, content, sent_at)
-        VALUES (%s, %s, %s, NOW())
-    """, (conversation_id, sender_type, content))
+    row = message_row(conversation_id, sender_type, content)
+    cursor.execute(INSERT_MESSAGE_SQL, row)
     mysql.connection.commit()
+    message_id = cursor.lastrowid
     cursor.close()
+    conversation_cache.add_messages(conversation_id, [row[1:]])
+    return message_id
+
+### Function to compute how many tokens of history fit next to the prompt and the reply
+### The whole system message is counted, with the profile sentence and the keywords of user_context.
+def history_token_budget(user_message, user_context=None):
+    prompt_tokens = count_tokens(build_system_prompt(user_context)) + count_tokens(user_message)
+    return max(0, MAX_TOKENS - REPLY_TOKENS_RESERVED - prompt_tokens)
 
 ### Function to get conversation history
-def get_conversation_history(conversation_id):
-    cursor = mysql.connection.cursor()
-    ### Query to get conversation history
+### Returns the newest messages whose summed token counts fit in token_budget, oldest first.
+### exclude_message_id skips the message being answered, which is sent separately.
+### connection lets a concurrent stage use its own pooled connection.
+def get_conversation_history(conversation_id, token_budget=MAX_TOKENS, exclude_message_id=None, connection=None):
+    cursor = (connection or mysql.connection).cursor()
+    ### Query to get conversation history: running token sum from the newest message backwards
     cursor.execute("""
         SELECT sender_type, content
-        FROM messages
-        WHERE conversation_id = %s
-        ORDER BY sent_at
-    """, (conversation_id,))
+        FROM (
+            SELECT message_id, sender_type, content,
+                   SUM(COALESCE(token_count, CEIL(CHAR_LENGTH(content) / 4)))
+                       OVER (ORDER BY message_id DESC) AS running_tokens
+            FROM messages
+            WHERE conversation_id = %s AND message_id <> %s
+            ORDER BY message_id DESC
+            LIMIT %s
+        ) recent
+        WHERE running_tokens <= %s
+        ORDER BY message_id
+    """, (conversation_id, exclude_message_id or 0, MAX_HISTORY_MESSAGES, token_budget))
     raw_history = cursor.fetchall()
     cursor.close()
 
@@ -620,18 +1196,55 @@ def get_conversation_history(conversation_id):
             history.append({"role": "bot", "content": content})
     return history
 
+### Function to read the newest messages of a conversation as (sender_type, content, token_count), oldest first
+def load_recent_messages(conversation_id, connection=None):
+    cursor = (connection or mysql.connection).cursor()
+    cursor.execute("""
+        SELECT sender_type, content, COALESCE(token_count, CEIL(CHAR_LENGTH(content) / 4))
+        FROM messages
+        WHERE conversation_id = %s
+        ORDER BY message_id DESC
+        LIMIT %s
+    """, (conversation_id, MAX_HISTORY_MESSAGES))
+    rows = cursor.fetchall()
+    cursor.close()
+    return [(sender_type, content, int(token_count)) for sender_type, content, token_count in reversed(rows)]
+
+### Function to get the newest messages whose summed token counts fit in token_budget, oldest first
+### (the same history get_conversation_history reads, built from the cached messages)
+def history_within_budget(messages, token_budget):
+    history, used_tokens = [], 0
+    for sender_type, content, token_count in reversed(messages):
+        used_tokens += token_count
+        if used_tokens > token_budget:
+            break
+        if sender_type in ("user", "bot"):
+            history.append({"role": sender_type, "content": content})
+    history.reverse()
+    return history
+
+### Function to get the newest messages of a conversation from the conversation cache (see history_within_budget)
+### They are read on a pooled connection the first time and kept up to date by every turn.
+def get_cached_messages(conversation_id):
+    messages = conversation_cache.get_messages(conversation_id)
+    if messages is None:
+        messages = run_with_pooled_connection(load_recent_messages, conversation_id)
+        conversation_cache.set_messages(conversation_id, messages)
+    return messages
+
 ### Function to get the conversation status
 def update_conversation_status(conversation_id, status):
     connection = get_db_connection()
     cursor = connection.cursor()
 
     ### Query to update the conversation status
-    query = "UPDATE conversations SET is_active = %s WHERE conversation_id = %s"
+    query = "UPDATE conversations SET is_active = %s, version = version + 1 WHERE conversation_id = %s"
     cursor.execute(query, (status, conversation_id))
 
     connection.commit()
     cursor.close()
     connection.close()
+    conversation_cache.invalidate(conversation_id)
 
 ###----------------------------------------------------------------------------
 ### AI Title & Keywords Handling
@@ -656,28 +1269,19 @@ def extract_title_from_llm_output(cleaned_text):
 
 ### Function to extract from the DB the keywords for a conversation
 def get_keywords_for_conversation(conversation_id):
-    cursor = mysql.connection.cursor()
-    ### Query to get keywords for the conversation
-    cursor.execute("SELECT keywords FROM conversations WHERE conversation_id = %s", (conversation_id,))
-    result = cursor.fetchone()
-    cursor.close()
+    ### The keywords come from the conversation cache
+    state = get_conversation_state(conversation_id)
 
     ### If no keywords are found, return an empty list
-    if not result or not result[0]:
+    if not state or not state.keywords:
         return []
-    return [k.strip() for k in result[0].split(',') if k.strip()]
-
-### Function that using keywords from the conversation generates a title (AI)
-def generate_ai_title_from_keywords(conversation_id):
-    ### Get keywords for the conversation using the function get_keywords_for_conversation
-    keywords = get_keywords_for_conversation(conversation_id)
-    ### If no keywords are found, return a default title
-    if not keywords:
-        return "Chat Session"
-    ### If keywords are found, join them into a string separated ", "
-    keyword_text = ", ".join(keywords)
-
-    ### Prompt to generate a title
+    return [k.strip() for k in state.keywords.split(',') if k.strip()]
+
+### Function that asks the AI for a title of a keyword set
+### Memoized on the keyword text (keywords are stored sorted), so equal keyword sets share one call.
+### Raises when the model fails or returns no valid title, so failures are not memoized.
+@lru_cache(maxsize=1024)
+def ai_title_for_keywords(keyword_text):
     system_prompt = """
     You are a product recommendation assistant.
 
@@ -696,31 +1300,32 @@ def generate_ai_title_from_keywords(conversation_id):
     ### User prompt with keywords
     user_prompt = f"Keywords: {keyword_text}"
     print(f"[🧠 PROMPT] {system_prompt}")
-    
-    try:
-        ### Call the model with system and user prompts
-        response = deepseek_chat([
-            ### System message with the prompt
-            SystemMessage(content=system_prompt),
-            ### User message with the keywords
-            HumanMessage(content=user_prompt)
-        ])
+
+    ### Function to extract the title from a model response, None when it isn't valid
+    def validate(response):
         ### Terminal output response
         print(f"[🧠 RESPONSE - response.content:] {response.content}")
-
         ### Clean response with previous function
         bot_reply_title = remove_thinking_tags(response.content)
         print(f"[🧠 CLEANED bot_reply_title] {bot_reply_title}")
         ### Extract title from the cleaned response
-        title = extract_title_from_llm_output(bot_reply_title)
-        ### If title is not found, return a default title
-        return title or f"{keyword_text}"
-    
-    ### If the model fails to respond, log the error and return a default title
-    except Exception as e:
-        ### Comsole output error message
-        print(f"❌ AI title generation failed: {e}")
-        return f"Chat Session: {keyword_text}"
+        return extract_title_from_llm_output(bot_reply_title)
+
+    ### Call the model with system and user prompts (the big model is asked again if the title isn't valid)
+    title = llm_client.invoke_validated([
+        ### System message with the prompt
+        SystemMessage(content=system_prompt),
+        ### User message with the keywords
+        HumanMessage(content=user_prompt)
+    ], validate, call_site="title", task="title")
+    if not title:
+        raise ValueError("No valid title in the AI output")
+    return title
+
+### Function to get the fingerprint of a keyword set
+def keywords_fingerprint(keywords):
+    normalized = sorted({keyword.strip().lower() for keyword in keywords if keyword.strip()})
+    return hashlib.sha256(",".join(normalized).encode("utf-8")).hexdigest()
 
 ### Function to update the conversation title in the database
 def update_conversation_title(conversation_id, new_title):
@@ -728,80 +1333,134 @@ def update_conversation_title(conversation_id, new_title):
 
     ### Query to update the conversation title
     cursor.execute("""
-        UPDATE conversations SET title = %s WHERE conversation_id = %s
+        UPDATE conversations SET title = %s, version = version + 1 WHERE conversation_id = %s
     """, (new_title, conversation_id))
     mysql.connection.commit()
     cursor.close()
+    conversation_cache.invalidate(conversation_id)
 
-### Function that change title if it's too generic
-def try_generate_title_if_needed(conversation_id):
-    """
-    If the current title is default (e.g., 'Chat Session', 'Untitled', etc.),
-    and there are enough keywords, generate a new title using AI.
-    """
+### Function that (re)generates a conversation title, at most once per keyword set
+### The AI call runs without any lock; the MySQL advisory lock is only held around the read-compare-UPDATE,
+### so a title another worker wrote meanwhile is kept instead of overwritten.
+### Returns the title (the current one when it was kept), or None when there is no such conversation.
+def regenerate_conversation_title(conversation_id):
     cursor = mysql.connection.cursor()
-    
-    ### Query to get the current title
-    cursor.execute("SELECT title FROM conversations WHERE conversation_id = %s", (conversation_id,))
-    result = cursor.fetchone()
-    
-    ### If no title is found return nothing 
-    if not result:
+    try:
+        cursor.execute("""
+            SELECT title, keywords, title_keywords_hash FROM conversations WHERE conversation_id = %s
+        """, (conversation_id,))
+        result = cursor.fetchone()
+        ### No such conversation
+        if not result:
+            return None
+        current_title, keyword_text, title_keywords_hash = result
+        keywords = [k.strip() for k in (keyword_text or "").split(",") if k.strip()]
+        fingerprint = keywords_fingerprint(keywords)
+        ### Keywords unchanged since the last generated title: keep it
+        if fingerprint == title_keywords_hash:
+            print(f"♻️ Keywords unchanged, keeping the title of conversation {conversation_id}")
+            return current_title
+
+        ### If no keywords are found, use a default title
+        if not keywords:
+            new_title = "Chat Session"
+        else:
+            try:
+                new_title = ai_title_for_keywords(", ".join(keywords))
+            ### If the model fails, use a fallback title and don't remember the keyword set so it is retried
+            except Exception as e:
+                print(f"❌ AI title generation failed: {e}")
+                new_title, fingerprint = f"{FALLBACK_TITLE_PREFIX}{', '.join(keywords)}", None
+        return write_generated_title(cursor, conversation_id, (current_title, title_keywords_hash), new_title, fingerprint)
+    finally:
         cursor.close()
-        return  # No such conversation
-
-    ### Clean current title
-    current_title = result[0].strip().lower()
-    ### List of different default titles
-    default_titles = {"chat session", "untitled", "new chat after timeout"}
-
-    ### If the current title is in the list of default titles generate a new title
-    if current_title in default_titles:
-        generated_title = generate_ai_title_from_keywords(conversation_id)
-        ### If successfully generated a title, update the conversation title in the database
-        if generated_title:
-            update_conversation_title(conversation_id, generated_title)
-            log_action(
-                LogType.AI_TITLE_GENERATED,
-                f"AI generated a title for conversation {conversation_id}: {generated_title}",
-                user_id=session.get("user_id")
-            )
-            ### Terminal output
-            print("✅ Title generated:", generated_title)
 
-    cursor.close()
+### Function that stores a generated title unless the title changed since it was read, returns the stored title
+### Runs under a MySQL advisory lock so two gunicorn workers never write a title over each other.
+def write_generated_title(cursor, conversation_id, read_title, new_title, fingerprint):
+    lock_name = f"conversation_title_{conversation_id}"
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (lock_name, TITLE_LOCK_TIMEOUT))
+    if not cursor.fetchone()[0]:
+        print(f"⚠️ Title of conversation {conversation_id} is being written by another worker")
+        return None
+    try:
+        cursor.execute("""
+            SELECT title, title_keywords_hash, version FROM conversations WHERE conversation_id = %s
+        """, (conversation_id,))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        ### Another worker stored a title while this one was generated: keep it
+        if result[:2] != read_title:
+            print(f"♻️ Conversation {conversation_id} got a title meanwhile, keeping it")
+            return result[0]
+        cursor.execute("""
+            UPDATE conversations SET title = %s, title_keywords_hash = %s, version = version + 1 WHERE conversation_id = %s
+        """, (new_title, fingerprint, conversation_id))
+        mysql.connection.commit()
+        conversation_cache.apply(conversation_id, result[2], title=new_title)
+        return new_title
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+        cursor.fetchone()
 
-###------------------------------------------------------------------------
-### Product Suggestions & Likes
+### Function that tells whether a title is a default or fallback one, which the AI generated title replaces
+def is_default_title(title):
+    title = (title or "").strip().lower()
+    return title in DEFAULT_TITLES or title.startswith(FALLBACK_TITLE_PREFIX.lower())
 
-### Function to save product suggestions in the database
-def save_product_suggestions(user_id, conversation_id, message_id, structured_products):
+### Function that generates a conversation title, concurrent requests for the same conversation share one generation
+def generate_conversation_title(conversation_id):
+    return title_flight.do(conversation_id, lambda: regenerate_conversation_title(conversation_id))
 
-    cursor = mysql.connection.cursor()
+### Function that change title if it's too generic
+def try_generate_title_if_needed(conversation_id, user_id=None):
+    """
+    If the current title is default (e.g., 'Chat Session', 'Untitled', etc.),
+    and the keywords changed since the last generation, generate a new title using AI.
+    Returns the new title, or None when the title was kept.
+    """
+    ### A title that isn't a default one is never replaced (the title is usually cached)
+    state = get_conversation_state(conversation_id)
+    if state is None or not is_default_title(state.title):
+        return None
+    ### The generation is shared with the other callers of the conversation, only a changed title is reported
+    current_title = state.title
+    generated_title = generate_conversation_title(conversation_id)
+    if generated_title == current_title:
+        return None
+    if generated_title:
+        log_action(
+            LogType.AI_TITLE_GENERATED,
+            f"AI generated a title for conversation {conversation_id}: {generated_title}",
+            user_id=user_id
+        )
+        ### Terminal output
+        print("✅ Title generated:", generated_title)
+    return generated_title
 
-    ### for each product in the structured products insert into the database
-    for product in structured_products:
-        product_name = product.get("name")
-        product_description = product.get("description")
+###------------------------------------------------------------------------
+### Product Suggestions & Likes
 
-        cursor.execute("""
-            INSERT INTO product_suggestions (
-                conversation_id, message_id, user_id,
-                product_name, product_description
-            ) VALUES (%s, %s, %s, %s, %s)
-        """, (
+### Function to queue the product suggestions of a reply in the unit of work of the turn
+### The message id is the one of the bot message inserted earlier in the same flush.
+def queue_product_suggestions(uow, user_id, conversation_id, structured_products, message_key="message_id"):
+    ### Insert every product of the reply in a single multi-row INSERT
+    uow.add("""
+        INSERT INTO product_suggestions (
             conversation_id, message_id, user_id,
             product_name, product_description
-        ))
-
-    mysql.connection.commit()
-    ### Emit event to frontend
-    log_action(
+        ) VALUES (%s, %s, %s, %s, %s)
+    """, lambda ids: [
+        (conversation_id, ids[message_key], user_id, product.get("name"), product.get("description"))
+        for product in structured_products
+    ], many=True)
+    queue_log_action(
+        uow,
         LogType.PRODUCT_SUGGESTION_SAVED,
         f"{len(structured_products)} product(s) saved for conversation {conversation_id}.",
         user_id=user_id
     )
-    cursor.close()
 
 ### Handles a real-time 'toggle_like' event from the client.
 ### Updates the 'liked' status of a product suggestion in the database,
@@ -885,12 +1544,19 @@ def handle_user_message(data):
     user_text = data.get("content", "").strip()
     ### Saveing user_id from the session
     user_id = session.get("user_id")
+    ### Version of the user's profile, the cached profile is read again when it changed
+    profile_version = session.get("profile_version")
     
     ### If user_id is not found, emit an info message to the frontend
     if not user_id:
         emit("info_message", {"content": "User session not found. Please log in again."})
         return
 
+    ### Every write of the turn is queued and flushed in a single transaction once the reply is ready
+    uow = UnitOfWork(mysql.connection)
+    if DB_STATEMENT_STATS:
+        statements_before = session_statement_counts(mysql.connection)
+
     ### If user_id is not empty save conversation_id from the session variable
     conversation_id = session.get("conversation_id")
 
@@ -914,53 +1580,99 @@ def handle_user_message(data):
 
     ### Update session with the valid conversation_id
     session["conversation_id"] = conversation_id
+    ### The conversation row and its newest messages are cached, a turn normally doesn't read them
+    conversation = get_conversation_state(conversation_id)
 
     ### Save user's message to the database
-    save_message(conversation_id, 'user', user_text)
+    user_row = message_row(conversation_id, 'user', user_text)
+    uow.add(INSERT_MESSAGE_SQL, user_row)
 
+    ### Independent steps before the AI call run concurrently, the DB ones on their own pooled connections
+    pipeline = Pipeline(chat_pipeline_executor)
     ### Extract conversation keywords
-    new_keywords = extract_keywords(user_text)
-    ### Update conversation keywords in the database
-    update_conversation_keywords(conversation_id, new_keywords)
+    pipeline.stage("keywords", lambda: extract_keywords(user_text))
+    ### Fetch user context (age, gender, country), the keywords are added once they are merged
+    pipeline.stage("user_context", lambda: get_user_context(user_id, conversation_id, keywords=[], profile_version=profile_version))
+    ### Get the newest messages of the conversation (the user message isn't saved yet)
+    pipeline.stage("history", lambda: get_cached_messages(conversation_id))
+    stage_results, stage_timings, pre_llm_ms = pipeline.run()
+    new_keywords = stage_results["keywords"]
+    user_context = stage_results["user_context"]
+    recent_messages = stage_results["history"]
+
+    keyword_text = merge_keywords(conversation.keywords if conversation else None, new_keywords)
+    cached_version = conversation.version if conversation else None
+    ### Update conversation keywords, only if the row is still at the cached version; without a cached row
+    ### there is no version to compare (version = NULL would never match)
+    ### (the last activity timestamp is written behind, see flush_conversation_activity)
+    if cached_version is None:
+        uow.add("""
+            UPDATE conversations SET keywords = %s, version = version + 1 WHERE conversation_id = %s
+        """, (keyword_text, conversation_id), name="keywords")
+    else:
+        uow.add("""
+            UPDATE conversations SET keywords = %s, version = version + 1
+            WHERE conversation_id = %s AND version = %s
+        """, (keyword_text, conversation_id, cached_version), name="keywords")
     ### Save log for keywords extraction
-    log_action(
+    queue_log_action(
+        uow,
         LogType.AI_KEYWORDS_EXTRACTED,
         f"Keywords extracted from message in conversation {conversation_id}: {', '.join(new_keywords)}",
         user_id=user_id
     )
 
-    ### Update last activity timestamp for session timeout tracking
-    update_last_activity(conversation_id)
-
-    ### Fetch user context (age, gender, country, keywords, etc.)
-    user_context = get_user_context(user_id, conversation_id)
+    ### The user context includes the merged keywords
+    keywords = [word.strip() for word in keyword_text.split(",") if word.strip()]
+    if keywords:
+        user_context["keywords"] = keywords
+    ### Conversation history: only the newest messages that fit next to the whole system message and the reply
+    conversation_history = history_within_budget(recent_messages, history_token_budget(user_text, user_context))
 
     ### Get AI assistant's response based on conversation history and user context
-    conversation_history = get_conversation_history(conversation_id)
-    bot_reply, structured = ask_deepseek(user_text, user_context, conversation_history)
-
-    ### Save bot's reply to the database
-    save_message(conversation_id, 'bot', bot_reply)
+    ### The client can skip the reply cache for a single message
+    use_cache = not data.get("no_cache", False)
+    llm_started = time.perf_counter()
+    ### The client may opt in or out of streaming, otherwise the server default is used
+    if data.get("stream", STREAM_REPLIES):
+        bot_reply, structured = stream_deepseek(user_text, user_context, conversation_history, conversation_id, use_cache=use_cache)
+    else:
+        bot_reply, structured = ask_deepseek(user_text, user_context, conversation_history, use_cache=use_cache)
+    llm_ms = (time.perf_counter() - llm_started) * 1000
+    chat_pipeline_stats.record(stage_timings, pre_llm_ms, llm=llm_ms)
+    print("⏱️ " + ", ".join(f"{name} {ms:.1f}ms" for name, ms in stage_timings.items())
+          + f" | pre-LLM wall {pre_llm_ms:.1f}ms | LLM {llm_ms:.1f}ms")
 
-    cursor = mysql.connection.cursor()
-    ### Query to get the last inserted message ID
-    cursor.execute("SELECT LAST_INSERT_ID()")
-    message_id = cursor.fetchone()[0]
-    cursor.close()    
+    ### Save bot's reply to the database, its id is the lastrowid of the INSERT
+    bot_row = message_row(conversation_id, 'bot', bot_reply)
+    uow.add(INSERT_MESSAGE_SQL, bot_row, name="message_id")
 
     ### Save log for bot's reply
-    log_action(
+    queue_log_action(
+        uow,
         LogType.AI_REPLY_GENERATED,
-        f"AI generated a reply in conversation {conversation_id}. Message ID: {message_id}",
+        lambda ids: f"AI generated a reply in conversation {conversation_id}. Message ID: {ids['message_id']}",
         user_id=user_id
     )
+    ### Save product suggestions to the database
+    if structured:
+        queue_product_suggestions(uow, user_id, conversation_id, structured)
+
+    ### Write the whole turn in one transaction
+    message_id = uow.flush()["message_id"]
+
+    ### Write the turn through to the conversation cache
+    if uow.rowcounts["keywords"]:
+        conversation_cache.apply(conversation_id, cached_version, keywords=keyword_text)
+        conversation_cache.add_messages(conversation_id, [user_row[1:], bot_row[1:]])
+    elif cached_version is not None:
+        ### Another worker changed the conversation since it was cached: drop it and merge the keywords into the current row
+        conversation_cache.invalidate(conversation_id, conflict=True)
+        update_conversation_keywords(conversation_id, new_keywords)
+    update_last_activity(conversation_id)
 
     ### Send bot's reply to frontend in real-time
     if structured:
-        ### Save product suggestions to the database
-        save_product_suggestions(user_id, conversation_id, message_id, structured)
-        ### Generate a title if needed
-        try_generate_title_if_needed(conversation_id)
         ### Send structured product suggestions to the frontend
         emit("bot_reply", {
             "products": structured,
@@ -968,6 +1680,11 @@ def handle_user_message(data):
             "conversation_id": conversation_id,
             "user_id": user_id
         })
+        ### Generate a title if needed in the background, it is pushed to the client when ready
+        job_runner.enqueue("generate_title", {"conversation_id": conversation_id, "user_id": user_id})
+        ### Categorize the new products in the background
+        if AUTO_CATEGORIZE_PRODUCTS:
+            job_runner.enqueue("categorize_products", {"message_id": message_id, "user_id": user_id})
     else:
         ### Sends plain text response if there are no structured suggestions
         emit("bot_reply", {
@@ -977,6 +1694,139 @@ def handle_user_message(data):
             "user_id": user_id
         })
 
+    if DB_STATEMENT_STATS:
+        record_turn_statements(statements_before)
+
+### Function that runs a blocking call without blocking the event loop: MySQLdb is a C extension
+### eventlet can't make cooperative, so under a monkey patched server it runs in eventlet's native thread pool
+def offload(fn, *args, **kwargs):
+    if eventlet_patcher is not None and eventlet_patcher.is_monkey_patched("thread"):
+        return tpool.execute(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+### Function that runs a DB read on a pooled connection (fn must accept a connection argument)
+def run_with_pooled_connection(fn, *args, **kwargs):
+    with db_pool.connection() as connection:
+        return offload(fn, *args, connection=connection, **kwargs)
+
+### Function to read a conversation row into the conversation cache, None when there is no such conversation
+def load_conversation_state(conversation_id, connection=None):
+    cursor = (connection or mysql.connection).cursor()
+    cursor.execute("""
+        SELECT user_id, title, keywords, is_active, last_activity_at, version
+        FROM conversations WHERE conversation_id = %s
+    """, (conversation_id,))
+    result = cursor.fetchone()
+    cursor.close()
+    if not result:
+        return None
+    return conversation_cache.put(ConversationState(conversation_id, *result))
+
+### Function to get the state of a conversation from the cache, read from the database when it isn't cached
+### refresh reads the row again (its history is read again too when needed)
+def get_conversation_state(conversation_id, refresh=False):
+    state = None if refresh else conversation_cache.get(conversation_id)
+    if state is None:
+        state = load_conversation_state(conversation_id)
+    return state
+
+### Function that writes the pending last activity timestamps in one UPDATE on a pooled connection
+def flush_conversation_activity():
+    try:
+        return run_with_pooled_connection(conversation_cache.flush_activity)
+    except Exception as e:
+        print(f"❌ Last activity flush failed: {e}")
+        return 0
+
+### Background loop writing the last activity timestamps every ACTIVITY_FLUSH_SECONDS
+def activity_flush_loop():
+    while True:
+        socketio.sleep(ACTIVITY_FLUSH_SECONDS)
+        flush_conversation_activity()
+
+### Function to start the last activity writer once per process
+activity_flusher_lock = threading.Lock()
+activity_flusher_started = False
+def start_activity_flusher():
+    global activity_flusher_started
+    with activity_flusher_lock:
+        if activity_flusher_started:
+            return
+        activity_flusher_started = True
+    socketio.start_background_task(activity_flush_loop)
+    ### Timestamps still pending when the process stops are written on exit
+    atexit.register(flush_conversation_activity)
+
+### Function to add the statements and commits of a chat turn to the counters
+def record_turn_statements(before):
+    statements, commits = session_statement_counts(mysql.connection)
+    ### The second SHOW STATUS query is not part of the turn
+    turn = {"statements": statements - before[0] - 1, "commits": commits - before[1]}
+    db_turn_stats["turns"] += 1
+    db_turn_stats["statements"] += turn["statements"]
+    db_turn_stats["commits"] += turn["commits"]
+    db_turn_stats["last"] = turn
+    print(f"🧮 Chat turn ran {turn['statements']} statement(s) and {turn['commits']} commit(s)")
+
+### Handles a new websocket connection
+@socketio.on("connect")
+### Function that puts the connection in the room of its user, used to push background results
+def handle_connect():
+    user_id = session.get("user_id")
+    if user_id:
+        join_room(f"user_{user_id}")
+
+###------------------------------------------------------------------------
+### Background Jobs
+
+### Start the job workers with the first request (they also pick up jobs left by a previous run)
+@app.before_request
+def start_job_runner():
+    job_runner.start()
+    start_activity_flusher()
+    ### Also sends the emails left in the outbox by a previous run
+    email_outbox.start()
+
+### Wake the email sender up when the request queued emails (its transaction is committed by now)
+@app.after_request
+def wake_email_outbox(response):
+    if g.pop("emails_queued", False):
+        email_outbox.wake()
+    return response
+
+### Job that generates a conversation title and pushes it to the user's open pages
+@job_runner.job("generate_title")
+def generate_title_job(payload):
+    conversation_id = payload["conversation_id"]
+    user_id = payload.get("user_id")
+    ### Forced generation (end of chat) always replaces the title
+    if payload.get("force"):
+        title = generate_conversation_title(conversation_id)
+        print("Generated Title:", title)
+    else:
+        title = try_generate_title_if_needed(conversation_id, user_id)
+    ### Push the new title over Socket.IO
+    if title and user_id:
+        socketio.emit(
+            "conversation_title",
+            {"conversation_id": conversation_id, "title": title},
+            to=f"user_{user_id}"
+        )
+
+### Job that assigns a category to every uncategorized product of a bot message
+@job_runner.job("categorize_products")
+def categorize_products_job(payload):
+    cursor = mysql.connection.cursor()
+    cursor.execute("""
+        SELECT id, product_name, product_description
+        FROM product_suggestions
+        WHERE message_id = %s AND category_id IS NULL
+    """, (payload["message_id"],))
+    rows = cursor.fetchall()
+    cursor.close()
+    for product_id, product_name, product_description in rows:
+        auto_assign_category(product_id, product_name, product_description, payload.get("user_id"), source="background job")
+
 ###------------------------------------------------------------------------
 ### Category Matching & Resolution
 
@@ -1055,21 +1905,28 @@ def get_deep_category_path(product_name, product_description):
         ❗Only return ONE category name from the list above that best fits. Do NOT explain.
         """
 
+        ### Function to clean the output from <think> tags, None when the answer isn't one of the options
+        def validate(response):
+            chosen = remove_thinking_tags(response.content).strip()
+            if chosen not in options:
+                print(f"❌ Category '{chosen}' is not one of the options.")
+                return None
+            return chosen
+
         try:
-            ### Call the model with system and user prompts
-            response = deepseek_chat([
+            ### Call the model with system and user prompts (the big model is asked again if the answer isn't valid)
+            chosen_category = llm_client.invoke_validated([
                 SystemMessage(content=system_prompt),
                 HumanMessage(content="Select the best fitting category from the list.")
-            ])
-            ### Clean the output from <think> tags
-            cleaned_category = remove_thinking_tags(response.content)
-            chosen_category = cleaned_category.strip()
+            ], validate, call_site="category", task="category")
             print(f"✅ AI selected: {repr(chosen_category)}")
         ### Manage exceptions
         except Exception as e:
             print("❌ Error during AI selection:", e)
             ### Stop the loop
             break
+        if chosen_category is None:
+            break
 
         # Fetch selected category ID
         cursor.execute("""
@@ -1108,6 +1965,379 @@ def get_deep_category_path(product_name, product_description):
         print("⚠️ No category path could be determined.")
         return None
 
+### Function that loads the category tree once and keeps it in memory for CATEGORY_INDEX_TTL seconds
+### Returns {"paths": {id: full path}, "ids": {normalised path: id}, "leaves": [(id, path, tokens)]}
+def get_category_index():
+    if category_index["data"] and time.monotonic() - category_index["loaded_at"] < CATEGORY_INDEX_TTL:
+        return category_index["data"]
+
+    cursor = mysql.connection.cursor()
+    ### A single query for the whole tree
+    cursor.execute("SELECT id, name, parent_id FROM categories")
+    rows = cursor.fetchall()
+    cursor.close()
+
+    names = {cat_id: name for cat_id, name, _ in rows}
+    parents = {cat_id: parent_id for cat_id, _, parent_id in rows}
+    paths = {}
+    ### Build the full path of every category walking up to its root
+    for cat_id in names:
+        parts = []
+        current = cat_id
+        while current and current in names and len(parts) < 20:
+            parts.insert(0, names[current])
+            current = parents[current]
+        paths[cat_id] = " > ".join(parts)
+
+    has_children = {parent_id for parent_id in parents.values() if parent_id}
+    leaves = [
+        (cat_id, path, category_tokens(path, names[cat_id]))
+        for cat_id, path in paths.items() if cat_id not in has_children
+    ]
+    data = {
+        "paths": paths,
+        "ids": {normalize_category_path(path): cat_id for cat_id, path in paths.items()},
+        "leaves": leaves
+    }
+    category_index.update(data=data, loaded_at=time.monotonic())
+    print(f"📚 Category index loaded: {len(paths)} categories, {len(leaves)} leaves")
+    return data
+
+### Function to normalise a category path for comparisons
+def normalize_category_path(path):
+    return " > ".join(part.strip().lower() for part in (path or "").split(">"))
+
+### Function to get the weighted tokens of a category path, the leaf name counts double
+def category_tokens(path, leaf_name):
+    weights = {token: 1 for token in lexical_tokens(path)}
+    for token in lexical_tokens(leaf_name):
+        weights[token] = 2
+    return weights
+
+### Function that keeps the leaf paths sharing most words with the product (cheap local pruning)
+def prune_category_candidates(product_name, product_description, limit=None):
+    limit = limit or CATEGORY_CANDIDATES
+    leaves = get_category_index()["leaves"]
+    ### Words of the name are stronger hints than words of the description
+    name_tokens = set(lexical_tokens(product_name))
+    description_tokens = set(lexical_tokens(product_description))
+    scored = []
+    for cat_id, path, weights in leaves:
+        score = sum(weight * (2 if token in name_tokens else 1)
+                    for token, weight in weights.items()
+                    if token in name_tokens or token in description_tokens)
+        scored.append((score, path, cat_id))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [(cat_id, path) for _, path, cat_id in scored[:limit]]
+
+### Function to check the model's answer against the candidate paths, returns the matching path or None
+def validate_category_answer(answer, candidates):
+    match = re.search(r"<CATEGORY>(.*?)</CATEGORY>", answer, re.IGNORECASE | re.DOTALL)
+    chosen = normalize_category_path((match.group(1) if match else answer).strip().strip('"\'`-• '))
+    by_path = {normalize_category_path(path): path for _, path in candidates}
+    if chosen in by_path:
+        return by_path[chosen]
+    ### Accept an answer that wraps a candidate path in extra words, preferring the longest path
+    contained = [path for normalized, path in by_path.items() if normalized in chosen]
+    return max(contained, key=len) if contained else None
+
+### Function to get the full category path with a single AI call over the pruned leaf paths
+def get_category_path_single_shot(product_name, product_description):
+    ### Terminal output
+    print("🎯 Starting single-shot category path resolution")
+    candidates = prune_category_candidates(product_name, product_description)
+    if not candidates:
+        print("⚠️ No categories available.")
+        return None
+
+    options = "\n    ".join(f"- {path}" for _, path in candidates)
+    ### Prompt for the AI model
+    system_prompt = f"""
+    You are a product categorization assistant.
+
+    Given a product name and description, and a list of category paths,
+    choose the single most appropriate path.
+
+    Product Name: {product_name}
+    Description: {product_description}
+
+    Category paths:
+    {options}
+
+    ❗Return ONLY one path from the list above, exactly as written, wrapped in <CATEGORY></CATEGORY> tags. Do NOT explain.
+    """
+    ### Function to clean the output from <think> tags and check it is one of the candidates
+    def validate(response):
+        answer = remove_thinking_tags(response.content)
+        path = validate_category_answer(answer, candidates)
+        if not path:
+            print(f"❌ Category '{answer}' is not one of the candidate paths.")
+        return path
+
+    try:
+        ### Call the model with system and user prompts (the big model is asked again if the answer isn't valid)
+        path = llm_client.invoke_validated([
+            SystemMessage(content=system_prompt),
+            HumanMessage(content="Select the best fitting category path from the list.")
+        ], validate, call_site="category_single", task="category")
+    ### Manage exceptions
+    except Exception as e:
+        print("❌ Error during AI selection:", e)
+        return None
+
+    if path:
+        print(f"🏁 Final path: {path}")
+    return path
+
+### Function that resolves the category path of a product with the configured mode
+def classify_category_path(product_name, product_description, mode=None):
+    if (mode or CATEGORY_CLASSIFIER_MODE) == "per_level":
+        return get_deep_category_path(product_name, product_description)
+    return get_category_path_single_shot(product_name, product_description)
+
+### Function to classify several products with a single AI call
+### products is a list of (product_id, name, description); candidates the leaf paths offered to the model.
+### Returns {product_id: full path or None}. Doesn't touch the DB so it can run in a worker thread.
+### Products without a valid answer are asked again to the task's escalation model (the big one).
+def classify_category_batch(products, candidates, escalate=False):
+    listed = "\n    ".join(
+        f"{number}. {name} - {(description or '')[:200]}"
+        for number, (_, name, description) in enumerate(products, start=1)
+    )
+    options = "\n    ".join(f"- {path}" for _, path in candidates)
+    ### Prompt for the AI model
+    system_prompt = f"""
+    You are a product categorization assistant.
+
+    For each numbered product below, choose the single most appropriate category path from the list.
+
+    Products:
+    {listed}
+
+    Category paths:
+    {options}
+
+    ❗Answer with exactly one line per product, in the same order, formatted as:
+    <number>. <CATEGORY>path from the list</CATEGORY>
+    Do NOT explain.
+    """
+    response = llm_client.invoke([
+        SystemMessage(content=system_prompt),
+        HumanMessage(content="Select the best fitting category path for every product.")
+    ], call_site="category_batch", task="category", timeout=LLM_SHORT_TASK_TIMEOUT * 2, escalate=escalate)
+
+    ### Match every answer line to its product and check it against the candidates
+    answer = remove_thinking_tags(response.content)
+    paths = {product_id: None for product_id, _, _ in products}
+    for number, chosen in re.findall(r"(\d+)\s*[.):-]\s*(<CATEGORY>.*?</CATEGORY>)", answer, re.IGNORECASE | re.DOTALL):
+        index = int(number) - 1
+        if 0 <= index < len(products):
+            paths[products[index][0]] = validate_category_answer(chosen, candidates)
+
+    missing = [product for product in products if paths[product[0]] is None]
+    if missing and llm_client.record_validation_failure("category", escalated=escalate):
+        print(f"⬆️ Escalating {len(missing)} product(s) of the batch to the big model")
+        paths.update(classify_category_batch(missing, candidates, escalate=True))
+    return paths
+
+### Function to get the leaf paths offered for a batch: the best candidates of each product, without duplicates
+def batch_category_candidates(products, limit=None):
+    limit = limit or CATEGORY_CANDIDATES * 2
+    per_product = max(5, limit // max(1, len(products)))
+    candidates = {}
+    for _, name, description in products:
+        for cat_id, path in prune_category_candidates(name, description, per_product):
+            candidates.setdefault(cat_id, path)
+    return list(candidates.items())[:limit]
+
+### Function that categorizes every product_suggestions row without a category
+### Rows are read in keyset-paginated chunks; each chunk is classified locally when confident and
+### by batched AI prompts run concurrently under a rate limit, then saved with one executemany and
+### a checkpoint so an interrupted run resumes after the last saved chunk.
+### A batch whose AI call still fails after `retries` retries is counted as failed, and the checkpoint
+### doesn't move past its smallest product id, so the next run asks for those products again.
+def bulk_categorize_products(chunk_size=200, batch_size=8, concurrency=4, rate=2.0, restart=False, checkpoint="bulk_categorize",
+                             retries=2):
+    connection = mysql.connection
+    cursor = connection.cursor()
+    last_id = 0
+    if restart:
+        cursor.execute("DELETE FROM job_checkpoints WHERE name = %s", (checkpoint,))
+        connection.commit()
+    else:
+        cursor.execute("SELECT last_id FROM job_checkpoints WHERE name = %s", (checkpoint,))
+        row = cursor.fetchone()
+        last_id = row[0] if row else 0
+    print(f"🗂️ Bulk categorization starting after product id {last_id}")
+
+    limiter = RateLimiter(rate)
+    stats = llm_client.metrics["category_batch"]
+    calls_before, tokens_before = stats.calls, stats.input_tokens + stats.output_tokens
+    totals = {"products": 0, "local": 0, "ai": 0, "unresolved": 0, "failed": 0}
+    started = time.perf_counter()
+    ### Smallest product id of a failed batch, the checkpoint stays before it
+    first_failed_id = None
+
+    ### Batches are sent by a bounded thread pool; the rate limiter spaces their start
+    ### Returns None when the AI call failed every time (rate limit, timeout, unreadable answer...)
+    def run_batch(batch, candidates):
+        for attempt in range(retries + 1):
+            limiter.wait()
+            try:
+                return classify_category_batch(batch, candidates)
+            except Exception as e:
+                print(f"❌ Batch of {len(batch)} products failed (attempt {attempt + 1}/{retries + 1}): {e}")
+                if attempt < retries:
+                    time.sleep(2 ** attempt)
+        return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            ### Next chunk after the last processed id (keyset pagination, no OFFSET)
+            cursor.execute("""
+                SELECT id, product_name, product_description
+                FROM product_suggestions
+                WHERE category_id IS NULL AND id > %s
+                ORDER BY id
+                LIMIT %s
+            """, (last_id, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            pending = []
+            ### Cheap local predictions first
+            for product_id, name, description in rows:
+                category_id = None
+                if CATEGORY_KNN_ENABLED:
+                    category_id, _ = get_category_classifier().predict(name, description)
+                if category_id:
+                    updates.append((category_id, product_id))
+                    totals["local"] += 1
+                else:
+                    pending.append((product_id, name, description))
+
+            ### The rest goes to the AI, several products per prompt
+            batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+            futures = [executor.submit(run_batch, batch, batch_category_candidates(batch)) for batch in batches]
+            ids_by_path = get_category_index()["ids"]
+            names = {product_id: name for product_id, name, _ in pending}
+            failed = 0
+            for batch, future in zip(batches, futures):
+                paths = future.result()
+                if paths is None:
+                    failed += len(batch)
+                    batch_first_id = min(product_id for product_id, _, _ in batch)
+                    first_failed_id = batch_first_id if first_failed_id is None else min(first_failed_id, batch_first_id)
+                    continue
+                for product_id, path in paths.items():
+                    category_id = ids_by_path.get(normalize_category_path(path)) if path else None
+                    if category_id:
+                        updates.append((category_id, product_id))
+                        totals["ai"] += 1
+                        if CATEGORY_KNN_ENABLED:
+                            category_classifier.add_example(names[product_id], category_id)
+            totals["unresolved"] += len(rows) - len(updates) - failed
+            totals["failed"] += failed
+            totals["products"] += len(rows)
+
+            ### Save the chunk and move the checkpoint in the same transaction
+            ### (this run goes on with the next chunk, the stored checkpoint stays before a failed batch)
+            last_id = rows[-1][0]
+            checkpoint_id = last_id if first_failed_id is None else first_failed_id - 1
+            if updates:
+                cursor.executemany("""
+                    UPDATE product_suggestions SET category_id = %s
+                    WHERE id = %s AND category_id IS NULL
+                """, updates)
+            cursor.execute("""
+                INSERT INTO job_checkpoints (name, last_id) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE last_id = VALUES(last_id)
+            """, (checkpoint, checkpoint_id))
+            connection.commit()
+            print(f"✔️ Chunk up to id {last_id}: {len(updates)}/{len(rows)} categorized, {failed} failed")
+
+    cursor.close()
+    elapsed = time.perf_counter() - started
+    calls = stats.calls - calls_before
+    tokens = stats.input_tokens + stats.output_tokens - tokens_before
+    totals.update(
+        seconds=round(elapsed, 1),
+        ai_calls=calls,
+        products_per_second=round(totals["products"] / elapsed, 2) if elapsed else 0.0,
+        tokens_per_product=round(tokens / totals["ai"], 1) if totals["ai"] else 0.0
+    )
+    log_action(LogType.CATEGORY_PREDICTED, f"Bulk categorization finished: {totals}")
+    return totals
+
+### Function that returns the local classifier, (re)built from the category paths and categorized products when stale
+def get_category_classifier():
+    built_at = category_classifier_state["built_at"]
+    if built_at is None or time.monotonic() - built_at > CATEGORY_KNN_REBUILD:
+        cursor = mysql.connection.cursor()
+        ### Most recent categorized products, manual and AI assignments alike
+        cursor.execute("""
+            SELECT product_name, category_id FROM product_suggestions
+            WHERE category_id IS NOT NULL
+            ORDER BY id DESC LIMIT %s
+        """, (category_classifier.max_products,))
+        products = cursor.fetchall()
+        cursor.close()
+        category_classifier.build(get_category_index()["paths"], products)
+        category_classifier_state["built_at"] = time.monotonic()
+        print(f"🧭 Local category classifier built: {category_classifier.stats()}")
+    return category_classifier
+
+### Function that predicts the category of a product and saves it, returns the category ID or None
+def auto_assign_category(product_id, product_name, product_description, user_id=None, source="product detail page"):
+    category_id, path = None, None
+    ### Try the local classifier first
+    if CATEGORY_KNN_ENABLED:
+        category_id, details = get_category_classifier().predict(product_name, product_description)
+        print(f"🧭 Local classifier: {details}")
+        if category_id:
+            path = get_category_index()["paths"].get(category_id)
+            source = f"{source} (local classifier)"
+
+    ### Low confidence: get the category path from the AI using the product name and description
+    if not category_id:
+        path = classify_category_path(product_name, product_description)
+
+        ### Get the category ID from the path (in-memory index first, then the tree walk in the DB)
+        category_id = get_category_index()["ids"].get(normalize_category_path(path)) if path else None
+        if not category_id:
+            category_id = resolve_category_id_from_path(path)
+        ### The AI answer becomes a new example for the local classifier
+        if category_id and CATEGORY_KNN_ENABLED:
+            category_classifier.add_example(product_name, category_id)
+    ### If category ID is found
+    if category_id:
+        print(f"Updating product_suggestions with category_id={category_id}")
+        cursor = mysql.connection.cursor()
+        ### Query to update the category ID in the product_suggestions table
+        cursor.execute("""
+            UPDATE product_suggestions SET category_id = %s WHERE id = %s
+        """, (category_id, product_id))
+        mysql.connection.commit()
+        cursor.close()
+        ### Log the category assignment
+        log_action(
+            LogType.CATEGORY_PREDICTED,
+            f"Auto-assigned category {category_id} to product '{product_name}' via {source}.",
+            user_id=user_id
+        )
+        ### Terminal output
+        print("✅ Category assignment successful.")
+    else:
+        ### Log the failure
+        log_action(
+            LogType.CATEGORY_ASSIGNMENT_FAILED,
+            f"Failed to assign category to product '{product_name}' (ID: {product_id}). Path: {path}",
+            user_id=user_id
+        )
+    return category_id
+
 ### Function to get the category path by ID
 def get_category_path_by_id(category_id):
     ### Initialize an empty list for the path
@@ -1380,11 +2610,12 @@ def end_chat():
             f"Conversation ended with ID: {conversation_id}",
             user_id=session.get("user_id")
         )
-        ### Generate a title for the conversation using AI
-        final_title = generate_ai_title_from_keywords(conversation_id)
-        print("Generated Title:", final_title)
-        ### Update the conversation title in the database
-        update_conversation_title(conversation_id, final_title)        
+        ### Generate a final title for the conversation using AI in the background
+        job_runner.enqueue("generate_title", {
+            "conversation_id": conversation_id,
+            "user_id": session.get("user_id"),
+            "force": True
+        })
         ### Redirection to index page
         return redirect(url_for('index'))
     ### Catch exceptions and print error message end redirect to 404 page
@@ -1509,16 +2740,15 @@ def generate_title(conversation_id):
     if not user_id:
         return redirect(url_for("login"))
 
-    ### Get the conversation title from the conversation ID
-    title = generate_ai_title_from_keywords(conversation_id)
-    ### Update the conversation title in the database
-    update_conversation_title(conversation_id, title)
+    ### Generate (or reuse, when the keywords didn't change) the conversation title
+    title = generate_conversation_title(conversation_id)
     ### Log the title edit
-    log_action(
-        LogType.CONVERSATION_TITLE_EDITED,
-        f"Title updated for conversation {conversation_id}: {title}",
-        user_id=user_id
-    )
+    if title:
+        log_action(
+            LogType.CONVERSATION_TITLE_EDITED,
+            f"Title updated for conversation {conversation_id}: {title}",
+            user_id=user_id
+        )
     
     return redirect(url_for("view_conversation", conversation_id=conversation_id))
 
@@ -1579,36 +2809,8 @@ def assign_category_from_detail(product_id):
     ### Unpacking the row in local variables
     product_name, product_description = row
 
-    ### Get the category path using the product name and description
-    path = get_deep_category_path(product_name, product_description)
-
-    ### Get the category ID from the path
-    category_id = resolve_category_id_from_path(path)
-    ### If category ID is found
-    if category_id:
-        print(f"Updating product_suggestions with category_id={category_id}")
-        cursor = mysql.connection.cursor()
-        ### Query to update the category ID in the product_suggestions table
-        cursor.execute("""
-            UPDATE product_suggestions SET category_id = %s WHERE id = %s
-        """, (category_id, product_id))
-        mysql.connection.commit()
-        cursor.close()
-        ### Log the category assignment
-        log_action(
-            LogType.CATEGORY_PREDICTED,
-            f"Auto-assigned category {category_id} to product '{product_name}' via product detail page.",
-            user_id=session.get("user_id")
-        )
-        ### Terminal output
-        print("✅ Category assignment successful.")
-    else:
-        ### Log the failure
-        log_action(
-            LogType.CATEGORY_ASSIGNMENT_FAILED,
-            f"Failed to assign category to product '{product_name}' (ID: {product_id}). Path: {path}",
-            user_id=session.get("user_id")
-        )
+    ### Predict and save the category
+    auto_assign_category(product_id, product_name, product_description, session.get("user_id"), source="product detail page")
     ### Redirect to the product detail page
     return redirect(url_for("product_detail", product_id=product_id))
 
@@ -1676,6 +2878,9 @@ def manual_category_assign(product_id):
                 WHERE id = %s
             """, (selected_id, product_id))
             mysql.connection.commit()
+            ### Teach the local classifier right away, no rebuild needed
+            if CATEGORY_KNN_ENABLED:
+                get_category_classifier().add_example(product_name, int(selected_id))
             ### Log the category assignment
             log_action(
                 LogType.PRODUCT_CATEGORY_ASSIGNED_MANUAL,
@@ -1704,8 +2909,6 @@ def manual_category_assign(product_id):
 @app.route('/register', methods=['GET', 'POST'])
 ### Function called when register is requested
 def register():
-    ### Get country list from the database
-    countries = load_countries_from_db()
     ### Delete session variables if they exist
     session.pop('user_id', None)  
     session.pop('username', None)
@@ -1714,8 +2917,9 @@ def register():
     ### Create a new RegistrationForm instance
     form = RegistrationForm()
     form.submit.label.text = "Sign Up"
-    form.country.choices = [('', '-- Select --')] + [(c["code"], c["name"]) for c in countries] 
-    form.gender.choices = [('', '-- Select --'), ('male', 'Male'), ('female', 'Female'), ('other', 'Other')]
+    ### Choice lists prebuilt by the reference data registry
+    form.country.choices = reference_data.countries().choices
+    form.gender.choices = GENDER_CHOICES
 
     ### If the request method is POST
     if form.validate_on_submit():
@@ -1735,6 +2939,8 @@ def register():
         ### Insert new user into the database
         cursor.execute("INSERT INTO users (name, surname, username, email, password, country, age, gender) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
         (name, surname, username, email, hashed_password, country, age, gender))
+        ### Welcome email, queued with the new user
+        queue_email(cursor, "WELCOME", email, {"username": username, "name": name})
 
         mysql.connection.commit()
 
@@ -1750,7 +2956,6 @@ def register():
         session.permanent = True        
         ### Log the user registration
         log_action(LogType.USER_REGISTERED, f"New user registered: {username}", user_id=user[0])
-        send_email_from_template("WELCOME", email, {"username": username,"name": name})
         ### Redirect to the registration success page
         return redirect(url_for('register_success'))
     return render_template('register.html', form=form)
@@ -1783,7 +2988,7 @@ def login():
 
         cursor = mysql.connection.cursor()
         ### Query to get the user information from the database
-        cursor.execute("SELECT id, username, password, name, surname FROM users WHERE username = %s", (username,))
+        cursor.execute("SELECT id, username, password, name, surname, context_version FROM users WHERE username = %s", (username,))
         user = cursor.fetchone()
         cursor.close()
         ### If user is found and the password matches
@@ -1794,6 +2999,7 @@ def login():
             session['surname'] = user[4]
             session['is_google_user'] = False
             session['is_admin'] = (user[1].lower() == "admin")
+            session['profile_version'] = user[5]
             session.permanent = True
             ### Log the user login
             log_action(LogType.USER_LOGGED_IN, f"User logged in: {username}", user_id=user[0])
@@ -1843,7 +3049,7 @@ def google_login():
         cursor = conn.cursor()
 
         ### Query to check if the user already exists in the database
-        cursor.execute("SELECT id, username, name, surname FROM users WHERE email = %s", (email,))
+        cursor.execute("SELECT id, username, name, surname, context_version FROM users WHERE email = %s", (email,))
         ### Save result of the query in existing_user
         existing_user = cursor.fetchone()
         print("🔍 Existing user:", existing_user)
@@ -1854,6 +3060,9 @@ def google_login():
             session['username'] = existing_user[1]
             session['name'] = existing_user[2]
             session['surname'] = existing_user[3]
+            ### The profile is read again on the first message
+            profile_cache.invalidate(existing_user[0])
+            session['profile_version'] = existing_user[4]
         ### If user does not exist, create a new username
         else:
             print("🆕 New user. Creating username...")
@@ -1876,15 +3085,11 @@ def google_login():
             """, (first_name, last_name, username, email, None, None, None))
 
             print("📝 Insert executed. rowcount:", cursor.rowcount)
+            ### Welcome email to the new user, queued with the new user
+            queue_email(cursor, "GOOGLE_LOGIN", email, {"username": username})
 
             conn.commit()
             print("💾 Commit complete.")
-            ### Send a welcome email to the new user
-            try:
-                send_email_from_template("GOOGLE_LOGIN", email, {"username": username})
-                print("📧 Welcome email sent")
-            except Exception as e:
-                print("⚠️ Email send error:", e)
             ### Query to get the new user ID
             cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
             new_user = cursor.fetchone()
@@ -1899,6 +3104,7 @@ def google_login():
             session['username'] = username
             session['name'] = first_name
             session['surname'] = last_name
+            session['profile_version'] = 0
         ### Set session variables for Google user
         session['is_google_user'] = True
         session.permanent = True
@@ -1977,12 +3183,11 @@ def edit_profile():
         return redirect(url_for('login'))
     ### Get user_id from session
     user_id = session['user_id']
-    ### Get country list from the database
-    countries = load_countries_from_db()
     ### Init a new EditProfileForm instance
     form = EditProfileForm() 
-    form.country.choices = [('', '-- Select --')] + [(c["code"], c["name"]) for c in countries]
-    form.gender.choices = [('', '-- Select --'), ('male', 'Male'), ('female', 'Female'), ('other', 'Other')]
+    ### Choice lists prebuilt by the reference data registry
+    form.country.choices = reference_data.countries().choices
+    form.gender.choices = GENDER_CHOICES
 
     cursor = mysql.connection.cursor()
 
@@ -2017,10 +3222,13 @@ def edit_profile():
         ### Query to update the user information in the database
         cursor.execute("""
             UPDATE users 
-            SET name = %s, surname = %s, country = %s, age = %s, gender = %s, email = %s
+            SET name = %s, surname = %s, country = %s, age = %s, gender = %s, email = %s,
+                context_version = LAST_INSERT_ID(context_version + 1)
             WHERE id = %s
         """, (name, surname, country, age, gender, email, user_id))
         mysql.connection.commit()
+        ### The cached chat context of the user is out of date
+        profile_changed(user_id, cursor.lastrowid)
         cursor.close()
         ### Update session variables
         session['name'] = name
@@ -2082,15 +3290,20 @@ def change_username():
                     error_message = "Username already taken."
                 else:
                     ### Update the username in the database if it is available
-                    cursor.execute("UPDATE users SET username = %s WHERE id = %s", (new_username, user_id))
-                    mysql.connection.commit()
-                    cursor.close()
-
-                    ### Send email to confirm username change
-                    send_email_from_template("USERNAME_CHANGED", email, {
+                    cursor.execute("""
+                        UPDATE users SET username = %s, context_version = LAST_INSERT_ID(context_version + 1)
+                        WHERE id = %s
+                    """, (new_username, user_id))
+                    context_version = cursor.lastrowid
+                    ### Email to confirm the username change, queued with the change
+                    queue_email(cursor, "USERNAME_CHANGED", email, {
                         "old_username": current_username,
                         "new_username": new_username
                     })
+                    mysql.connection.commit()
+                    ### The cached chat context of the user is out of date
+                    profile_changed(user_id, context_version)
+                    cursor.close()
 
                     ### Log the username change action
                     log_action(LogType.USERNAME_CHANGED,
@@ -2127,16 +3340,16 @@ def delete_profile():
 
         ### Delete the user account
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
-        mysql.connection.commit()
-
-        ### Send an account deletion confirmation email to the user
+        ### Account deletion confirmation email, queued with the deletion
         variables = {
             "name": name,
             "surname": surname,
             "username": username
         }
-        ### Send email to confirm account deletion
-        send_email_from_template("ACCOUNT_DELETED", email, variables)
+        queue_email(cursor, "ACCOUNT_DELETED", email, variables)
+        mysql.connection.commit()
+        ### Forget the cached chat context of the user
+        profile_cache.invalidate(user_id)
 
         ### Log the account deletion action
         log_action(LogType.USER_DELETED, f"User deleted their account: {username} (ID: {user_id})", user_id=user_id)
@@ -2252,11 +3465,14 @@ def reset_password(token):
         cursor = mysql.connection.cursor()
         ### Query to update the password in the database
         cursor.execute("UPDATE users SET password = %s WHERE id = %s", (hashed_password, user_id))
-        mysql.connection.commit()
         ### Query to get the user information from the database
         cursor.execute("SELECT username, name, surname FROM users WHERE id = %s", (user_id,))
         ### Save result of the query in user_data
         user_data = cursor.fetchone()
+        ### Email to confirm the password change, queued with the change
+        if user_data:
+            queue_email(cursor, "PASSWORDCHANGED", email, {"username": user_data[0]})
+        mysql.connection.commit()
         cursor.close()
         ### if user_data is not empty
         if user_data:
@@ -2269,8 +3485,6 @@ def reset_password(token):
             session['surname'] = surname
             session['is_google_user'] = False
             session.permanent = True
-            ### Send email to confirm password change
-            send_email_from_template("PASSWORDCHANGED", email, {"username": username})
             ### Log the password change action
             log_action(LogType.PASSWORD_CHANGED, f"Password successfully changed for user: {username}", user_id=user_id)
         ### Redirect to the index page
@@ -2316,6 +3530,82 @@ def contact_success():
 ### 10.Logging & Admin Monitoring
 
 
+### Function to parse a date/time filter (ISO format, e.g. from a datetime-local input), None when empty
+def parse_datetime_filter(value):
+    return datetime.fromisoformat(value) if value else None
+
+### Function to read the log filters of a request: log type, user, time range and message substring
+### Non-admins only ever see their own logs.
+def log_filters_from_request(args, is_admin, user_id):
+    return {
+        "log_name": args.get("log_type") or None,
+        "user_id": (args.get("user_id", type=int) if is_admin else user_id),
+        "since": parse_datetime_filter(args.get("from")),
+        "until": parse_datetime_filter(args.get("to")),
+        "message": args.get("q") or None
+    }
+
+### Function to read one page of app_logs, newest first
+### after is the decoded cursor of the previous page; returns (logs, cursor of the next page or None)
+def query_log_page(filters, after=None, limit=PAGE_SIZE, connection=None):
+    conditions, params = [], []
+    if filters.get("log_name"):
+        log_type = audit_logger.log_types().get(filters["log_name"])
+        if log_type is None:
+            return [], None
+        conditions.append("al.log_type_id = %s")
+        params.append(log_type[0])
+    if filters.get("user_id") is not None:
+        conditions.append("al.user_id = %s")
+        params.append(filters["user_id"])
+    if filters.get("since"):
+        conditions.append("al.timestamp >= %s")
+        params.append(filters["since"])
+    if filters.get("until"):
+        conditions.append("al.timestamp < %s")
+        params.append(filters["until"])
+    if filters.get("message"):
+        conditions.append("al.message LIKE %s")
+        params.append(like_pattern(filters["message"]))
+    if after:
+        condition, condition_params = after_cursor(after, "al.timestamp", "al.id")
+        conditions.append(condition)
+        params.extend(condition_params)
+
+    cursor = (connection or mysql.connection).cursor()
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    ### Query, one row more than the page tells whether there is a next page
+    ### Rows come from app_logs and from the log types kept past its retention (app_logs_retained),
+    ### each side is limited on its own index before they are merged
+    cursor.execute(f"""
+        SELECT 
+            al.id,
+            al.user_id,
+            al.message,
+            al.timestamp,
+            lt.log_name,
+            lt.isActive
+        FROM (
+            (SELECT al.id, al.user_id, al.log_type_id, al.message, al.timestamp FROM app_logs al {where}
+             ORDER BY al.timestamp DESC, al.id DESC LIMIT %s)
+            UNION ALL
+            (SELECT al.id, al.user_id, al.log_type_id, al.message, al.timestamp FROM app_logs_retained al {where}
+             ORDER BY al.timestamp DESC, al.id DESC LIMIT %s)
+        ) al
+        JOIN 
+            log_types lt ON al.log_type_id = lt.log_type_id
+        ORDER BY 
+            al.timestamp DESC, al.id DESC
+        LIMIT %s
+    """, params + [limit + 1] + params + [limit + 1, limit + 1])
+    rows = cursor.fetchall()
+    cursor.close()
+
+    columns = ['id', 'user_id', 'message', 'timestamp', 'log_name', 'isActive']
+    logs = [dict(zip(columns, row)) for row in rows[:limit]]
+    next_cursor = encode_cursor(logs[-1]["timestamp"], logs[-1]["id"]) if len(rows) > limit else None
+    return logs, next_cursor
+
 ### Route for viewing logs
 @app.route('/logs')
 ### Function called when logs is requested
@@ -2323,51 +3613,183 @@ def view_logs():
     ### Getting user_id and is_admin from session
     user_id = session.get("user_id")
     is_admin = session.get("is_admin")
+    if not user_id:
+        return redirect(url_for("login"))
 
+    ### One page of logs matching the filters, the next page starts after the cursor
+    try:
+        filters = log_filters_from_request(request.args, is_admin, user_id)
+        after = decode_cursor(request.args["after"]) if request.args.get("after") else None
+    except ValueError as e:
+        return f"Invalid log filter: {e}", 400
+    logs, next_cursor = query_log_page(filters, after, page_size(request.args.get("limit")))
+
+    ### Link to the next page keeps the filters
+    next_url = None
+    if next_cursor:
+        next_url = url_for("view_logs", **{**request.args.to_dict(), "after": next_cursor})
+    ### Render logs
+    return render_template(
+        "logs.html",
+        logs=logs,
+        next_url=next_url,
+        filters=request.args,
+        log_types=sorted(audit_logger.log_types()),
+        is_admin=is_admin
+    )
+
+### Route for the logs as JSON, one page per request (?after=<next_cursor>)
+### or every matching log streamed as JSON lines, page by page (?format=ndjson)
+@app.route("/api/logs")
+### Function called when /api/logs is requested
+def api_logs():
+    user_id = session.get("user_id")
+    is_admin = session.get("is_admin")
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        filters = log_filters_from_request(request.args, is_admin, user_id)
+        after = decode_cursor(request.args["after"]) if request.args.get("after") else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = page_size(request.args.get("limit"))
+
+    if request.args.get("format") == "ndjson":
+        ### Only one page is in memory at a time
+        def generate(after):
+            while True:
+                logs, next_cursor = query_log_page(filters, after, limit)
+                for log in logs:
+                    yield json.dumps(log) + "\n"
+                if not next_cursor:
+                    return
+                after = decode_cursor(next_cursor)
+        return Response(stream_with_context(generate(after)), mimetype="application/x-ndjson")
+
+    logs, next_cursor = query_log_page(filters, after, limit)
+    return jsonify({"logs": logs, "next_cursor": next_cursor})
+
+### Function to read the counts of some log types per hour or per day from the rollups
+### Filters: types (comma separated, default every LogType), from/to (default the last 7 days), bucket (hour or day)
+def log_rollups_from_request(args):
+    bucket = args.get("bucket") or "hour"
+    if bucket not in ROLLUP_BUCKETS:
+        raise ValueError(f"Unknown bucket: {bucket}")
+    log_names = [name.strip().upper() for name in (args.get("types") or "").split(",") if name.strip()]
+    known_names = [log_type.value for log_type in LogType]
+    unknown = [name for name in log_names if name not in known_names]
+    if unknown:
+        raise ValueError(f"Unknown log types: {', '.join(unknown)}")
+    log_names = log_names or known_names
+    until = parse_datetime_filter(args.get("to")) or hour_bucket(utc_now()) + timedelta(hours=1)
+    since = parse_datetime_filter(args.get("from")) or until - timedelta(days=7)
+
+    ### Log types missing from the log_types table have no rollups, their series is all zeros
+    types = audit_logger.log_types()
     cursor = mysql.connection.cursor()
-    ### If user is admin, fetch all logs
-    if is_admin:
-        cursor.execute("""
-            SELECT 
-                al.id,
-                al.user_id,
-                al.message,
-                al.timestamp,
-                lt.log_name,
-                lt.isActive
-            FROM 
-                app_logs al
-            JOIN 
-                log_types lt ON al.log_type_id = lt.log_type_id
-            ORDER BY 
-                al.timestamp DESC;
-        """)
-    ### If user is not admin, fetch only their logs
-    else:
-        cursor.execute("""
-            SELECT 
-                al.id,
-                al.user_id,
-                al.message,
-                al.timestamp,
-                lt.log_name,
-                lt.isActive
-            FROM 
-                app_logs al
-            JOIN 
-                log_types lt ON al.log_type_id = lt.log_type_id
-            WHERE
-                al.user_id = %s
-            ORDER BY 
-                al.timestamp DESC;
-        """, (user_id,))
-    ### Save result of the query in logs
-    logs = cursor.fetchall()
+    buckets, values = rollup_series(
+        cursor, [types[name][0] for name in log_names if name in types], since, until, bucket
+    )
     cursor.close()
+    series = {name: values[types[name][0]] if name in types else [0] * len(buckets) for name in log_names}
+    return {
+        "bucket": bucket,
+        "from": since.isoformat(),
+        "to": until.isoformat(),
+        "buckets": [value.isoformat() for value in buckets],
+        "series": series,
+        "totals": {name: sum(counts) for name, counts in series.items()}
+    }
 
-    columns = ['id', 'user_id', 'message', 'timestamp', 'log_name', 'isActive']
-    ### Render logs
-    return render_template("logs.html", logs=[dict(zip(columns, row)) for row in logs])
+### Route for the counts of the log types over time, read from the hourly rollups
+@app.route("/api/logs/rollups")
+### Function called when /api/logs/rollups is requested
+def api_log_rollups():
+    ### Only admins can see the log statistics
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    started = time.perf_counter()
+    try:
+        rollups = log_rollups_from_request(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    rollups["query_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return jsonify(rollups)
+
+### Route for the dashboard charting the log types over time (the data comes from /api/logs/rollups)
+@app.route("/admin/log-stats")
+### Function called when /admin/log-stats is requested
+def log_stats_dashboard():
+    ### Only admins can see the log statistics
+    if not session.get("is_admin"):
+        return redirect(url_for("login"))
+    return render_template(
+        "log_stats.html",
+        log_types=[log_type.value for log_type in LogType],
+        buckets=list(ROLLUP_BUCKETS),
+        filters=request.args
+    )
+
+### Query selecting the email logs with what is needed to render them ({body} selects the template body or NULL)
+EMAIL_LOG_SELECT = """
+    SELECT 
+        el.id,
+        el.template_name,
+        el.recipient_email,
+        el.user_id,
+        el.status,
+        el.error_message,
+        el.sent_at,
+        el.subject,
+        {body},
+        el.content_compressed,
+        el.variables,
+        v.subject,
+        {version_body}
+    FROM email_logs el
+    LEFT JOIN email_template_versions v ON v.id = el.template_version_id
+"""
+
+### Function to turn an email logs row into the dict used by the templates
+def email_log_row(row):
+    log_id, template_name, recipient_email, log_user_id, status, error_message, sent_at = row[:7]
+    subject, body = email_log_content(row[7], row[8], row[9], row[10], row[11], row[12])
+    return {
+        "id": log_id,
+        "template_name": template_name,
+        "recipient_email": recipient_email,
+        "user_id": log_user_id,
+        "subject": subject,
+        "body": body,
+        "status": status,
+        "error_message": error_message,
+        "sent_at": sent_at
+    }
+
+### Function to read one page of email logs, newest first (user_id None reads every user's logs)
+### Bodies are not read nor rendered, they are rendered when a single log is viewed.
+### Returns (logs, cursor of the next page or None)
+def query_email_log_page(user_id=None, after=None, limit=PAGE_SIZE):
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append("el.user_id = %s")
+        params.append(user_id)
+    if after:
+        condition, condition_params = after_cursor(after, "el.sent_at", "el.id")
+        conditions.append(condition)
+        params.extend(condition_params)
+    cursor = mysql.connection.cursor()
+    cursor.execute(
+        EMAIL_LOG_SELECT.format(body="NULL", version_body="NULL")
+        + (" WHERE " + " AND ".join(conditions) if conditions else "")
+        + " ORDER BY el.sent_at DESC, el.id DESC LIMIT %s",
+        params + [limit + 1]
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    logs = [email_log_row(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(logs[-1]["sent_at"], logs[-1]["id"]) if len(rows) > limit else None
+    return logs, next_cursor
 
 ### Route for viewing email logs
 @app.route("/email-logs")
@@ -2376,54 +3798,464 @@ def email_logs():
     ### Save user_id and is_admin from session
     user_id = session.get("user_id")
     is_admin = session.get("is_admin")
+    if not user_id:
+        return redirect(url_for("login"))
 
+    ### Admins see every email log (or one user's with ?user_id=), users only their own
+    owner_id = request.args.get("user_id", type=int) if is_admin else user_id
+    try:
+        after = decode_cursor(request.args["after"]) if request.args.get("after") else None
+    except ValueError as e:
+        return str(e), 400
+    logs, next_cursor = query_email_log_page(owner_id, after, page_size(request.args.get("limit")))
+
+    ### Link to the next page keeps the filters
+    next_url = None
+    if next_cursor:
+        next_url = url_for("email_logs", **{**request.args.to_dict(), "after": next_cursor})
+    return render_template("email_logs.html", logs=logs, next_url=next_url, filters=request.args, is_admin=is_admin)
+
+### Route for one email log with its body
+@app.route("/email-logs/<int:log_id>")
+### Function called when an email log is requested
+def email_log_detail(log_id):
+    user_id = session.get("user_id")
+    if not user_id:
+        return redirect(url_for("login"))
     cursor = mysql.connection.cursor()
-    ### If user is admin, fetch all email logs
-    if is_admin:
+    cursor.execute(EMAIL_LOG_SELECT.format(body="el.body", version_body="v.body") + " WHERE el.id = %s", (log_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    ### Users can only see their own email logs
+    if not row or (not session.get("is_admin") and row[3] != user_id):
+        return "Email log not found", 404
+    return render_template("email_log_detail.html", log=email_log_row(row))
+
+### Route for the AI client counters (latency and retries per call site) and the background job counters
+@app.route("/api/llm/stats")
+### Function called when /api/llm/stats is requested
+def llm_stats():
+    ### Only admins can see the AI client counters
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    stats = llm_client.stats()
+    stats["title_generation"] = title_flight.stats()
+    ### Background jobs run the title generations and the product categorizations
+    stats["background_jobs"] = job_runner.stats()
+    return jsonify(stats)
+
+### Route for the LLM cache counters
+@app.route("/api/cache/stats")
+### Function called when /api/cache/stats is requested
+def cache_stats():
+    ### Only admins can see the cache counters
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "conversation_cache": conversation_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "reference_data": reference_data.stats()
+    })
+
+### Route for the stage timings of the chat pipeline
+@app.route("/api/chat/stats")
+### Function called when /api/chat/stats is requested
+def chat_stats():
+    ### Only admins can see the pipeline timings
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({**chat_pipeline_stats.snapshot(), "db_pool": db_pool.stats()})
+
+### Route for the MySQL statement counters of chat turns (enabled with DB_STATEMENT_STATS)
+@app.route("/api/db/stats")
+### Function called when /api/db/stats is requested
+def db_stats():
+    ### Only admins can see the DB counters
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    turns = db_turn_stats["turns"]
+    return jsonify({
+        "enabled": DB_STATEMENT_STATS,
+        "turns": turns,
+        "statements_per_turn": round(db_turn_stats["statements"] / turns, 2) if turns else 0.0,
+        "commits_per_turn": round(db_turn_stats["commits"] / turns, 2) if turns else 0.0,
+        "last_turn": db_turn_stats["last"],
+        "audit_log": audit_logger.stats()
+    })
+
+### Route for the email outbox: emails per status and the counters of this worker's sender
+@app.route("/api/email/outbox")
+### Function called when /api/email/outbox is requested
+def email_outbox_stats():
+    ### Only admins can see the email outbox
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    with db_pool.connection() as connection:
+        counts = email_outbox.counts(connection)
+    return jsonify({"outbox": counts, "sender": email_outbox.stats()})
+
+### Route to enable or disable a log type: POST {"active": true|false}
+@app.route("/api/log_types/<log_name>", methods=["POST"])
+### Function called when /api/log_types/<log_name> is requested
+def set_log_type_active(log_name):
+    ### Only admins can change the log types
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    active = bool((request.get_json(silent=True) or {}).get("active"))
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("UPDATE log_types SET isActive = %s WHERE log_name = %s", (active, log_name))
+        if not cursor.rowcount and log_name not in audit_logger.log_types():
+            cursor.close()
+            return jsonify({"error": "Unknown log type"}), 404
+        ### Bump the version so every worker reads the log types again
         cursor.execute("""
-            SELECT 
-                id,
-                template_name,
-                recipient_email,
-                subject,
-                body,
-                status,
-                error_message,
-                sent_at
-            FROM email_logs
-            ORDER BY sent_at DESC
+            INSERT INTO reference_data_versions (name, version) VALUES ('log_types', 1)
+            ON DUPLICATE KEY UPDATE version = version + 1
         """)
-    ### If user is not admin, fetch only their email logs
-    else:
-        cursor.execute("SELECT email FROM users WHERE id = %s", (user_id,))
-        user_email = cursor.fetchone()
-        ### If user_email is not found, close the cursor and return 404
-        if not user_email:
-            cursor.close()
-            return "User email not found", 404
-        
+        connection.commit()
+        cursor.close()
+    audit_logger.refresh_types()
+    print(f"🧾 Log type {log_name} {'enabled' if active else 'disabled'}")
+    return jsonify({"log_name": log_name, "active": active})
+
+### Route to reload the countries on every worker after the countries table was edited
+@app.route("/api/reference/countries/reload", methods=["POST"])
+### Function called when /api/reference/countries/reload is requested
+def reload_countries():
+    ### Only admins can reload the reference data
+    if not session.get("is_admin"):
+        return jsonify({"error": "Forbidden"}), 403
+    ### Bumps the stored version: this worker reloads now, the others at their next version check
+    with db_pool.connection() as connection:
+        snapshot = reference_data.bump(connection)
+    print(f"🌍 Countries reloaded by admin (version {snapshot.version})")
+    return jsonify(reference_data.stats())
+
+###--------------------------------------------------
+### 11.Command Line Interface
+
+### Folder with the numbered SQL migrations
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+### Function to split a migration file into single statements (comment lines are ignored)
+def split_sql_statements(sql):
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+### Command that applies pending SQL migrations in order: flask migrate
+@app.cli.command("migrate")
+def migrate():
+    cursor = mysql.connection.cursor()
+    ### Table that remembers which migrations were already applied
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name VARCHAR(255) PRIMARY KEY,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT name FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+
+    ### Apply every .sql file not applied yet, in file name order
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        if not name.endswith(".sql") or name in applied:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, name), encoding="utf-8") as migration_file:
+            statements = split_sql_statements(migration_file.read())
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+        mysql.connection.commit()
+        print(f"✅ Applied migration {name}")
+    cursor.close()
+
+### Command that times GET /register without and with the reference data registry: flask bench-register --requests 200
+### "before" drops the snapshot before every request, so each page reads the countries table like it used to.
+@app.cli.command("bench-register")
+@click.option("--requests", "count", default=200, help="GET /register requests per run.")
+def bench_register(count):
+    client = app.test_client()
+    for label, reload_every_request in (("before", True), ("after", False)):
+        timings = []
+        for _ in range(count):
+            if reload_every_request:
+                reference_data.snapshot = None
+            started = time.perf_counter()
+            response = client.get("/register")
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                print(f"❌ GET /register returned {response.status_code}")
+                return
+        timings.sort()
+        print(f"{label:<7} requests={count} "
+              f"p50={timings[len(timings) // 2]:.2f}ms "
+              f"p95={timings[min(len(timings) - 1, int(len(timings) * 0.95))]:.2f}ms "
+              f"mean={sum(timings) / len(timings):.2f}ms")
+    print(f"Reference data loads: {reference_data.loads}")
+
+### Function that returns the size of a table in bytes (data and indexes, as estimated by InnoDB)
+def table_size(cursor, table_name):
+    cursor.execute("""
+        SELECT DATA_LENGTH + INDEX_LENGTH FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, (table_name,))
+    result = cursor.fetchone()
+    return int(result[0] or 0) if result else 0
+
+### Command that compresses the subject and body of the email logs written before compact storage: flask compact-email-logs
+### --optimize rebuilds the table afterwards so the freed space is given back.
+@app.cli.command("compact-email-logs")
+@click.option("--chunk-size", default=1000, help="Rows compressed per transaction.")
+@click.option("--optimize", is_flag=True, help="Run OPTIMIZE TABLE email_logs at the end.")
+def compact_email_logs(chunk_size, optimize):
+    cursor = mysql.connection.cursor()
+    size_before = table_size(cursor, "email_logs")
+    last_id, compacted = 0, 0
+    while True:
         cursor.execute("""
-            SELECT 
-                id,
-                template_name,
-                recipient_email,
-                subject,
-                body,
-                status,
-                error_message,
-                sent_at
-            FROM email_logs
-            WHERE recipient_email = %s
-            ORDER BY sent_at DESC
-        """, (user_email[0],))
+            SELECT id, subject, body FROM email_logs
+            WHERE id > %s AND body IS NOT NULL AND content_compressed IS NULL AND template_version_id IS NULL
+            ORDER BY id LIMIT %s
+        """, (last_id, chunk_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany(
+            "UPDATE email_logs SET content_compressed = %s, subject = NULL, body = NULL WHERE id = %s",
+            [(pack_content(subject, body), log_id) for log_id, subject, body in rows]
+        )
+        mysql.connection.commit()
+        last_id = rows[-1][0]
+        compacted += len(rows)
+        print(f"🗜️ {compacted} email logs compressed")
+    if optimize:
+        cursor.execute("OPTIMIZE TABLE email_logs")
+        cursor.fetchall()
+    size_after = table_size(cursor, "email_logs")
+    cursor.close()
+    print(f"🏁 {compacted} email logs compressed, table size {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB")
 
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
+### Function to add synthetic app_logs rows for the benchmarks, spread over the last year
+def seed_app_logs(rows, batch_size=10000):
+    cursor = mysql.connection.cursor()
+    cursor.execute("SELECT id FROM users ORDER BY id LIMIT 1000")
+    user_ids = [row[0] for row in cursor.fetchall()] or [None]
+    log_type_ids = [log_type_id for log_type_id, _ in audit_logger.log_types().values()]
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rng = random.Random(0)
+    for start in range(0, rows, batch_size):
+        batch = [
+            (rng.choice(user_ids), rng.choice(log_type_ids), f"Benchmark log entry {number}",
+             now - timedelta(seconds=rng.randrange(365 * 24 * 3600)))
+            for number in range(start, min(rows, start + batch_size))
+        ]
+        cursor.executemany("""
+            INSERT INTO app_logs (user_id, log_type_id, message, timestamp) VALUES (%s, %s, %s, %s)
+        """, batch)
+        mysql.connection.commit()
+        print(f"🌱 {start + len(batch)}/{rows} rows")
+    cursor.close()
+
+### Command that times the keyset pages of the log viewer: flask bench-logs --seed 10000000 --pages 20
+### Every scenario reads --pages consecutive pages; the time of the last page shows that deep pages cost the same.
+@app.cli.command("bench-logs")
+@click.option("--seed", default=0, help="Synthetic app_logs rows to insert first.")
+@click.option("--pages", default=20, help="Consecutive pages read by each scenario.")
+@click.option("--limit", default=PAGE_SIZE, help="Rows per page.")
+def bench_logs(seed, pages, limit):
+    if seed:
+        seed_app_logs(seed)
+    cursor = mysql.connection.cursor()
+    ### Estimated row count (COUNT(*) on millions of rows is slow itself)
+    cursor.execute("""
+        SELECT TABLE_ROWS FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'app_logs'
+    """)
+    print(f"app_logs has about {cursor.fetchone()[0]} rows")
+    cursor.execute("SELECT user_id FROM app_logs WHERE user_id IS NOT NULL ORDER BY timestamp DESC LIMIT 1")
+    recent_user = cursor.fetchone()
     cursor.close()
 
-    logs = [dict(zip(columns, row)) for row in rows]
-    return render_template("email_logs.html", logs=logs)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    scenarios = {
+        "all": {},
+        "user": {"user_id": recent_user[0] if recent_user else None},
+        "type": {"log_name": LogType.AI_REPLY_GENERATED.value},
+        "last_week": {"since": now - timedelta(days=7)},
+        "message": {"message": "conversation"}
+    }
+    for name, filters in scenarios.items():
+        timings, rows, after = [], 0, None
+        for _ in range(pages):
+            started = time.perf_counter()
+            logs, next_cursor = query_log_page(filters, after, limit)
+            timings.append((time.perf_counter() - started) * 1000)
+            rows += len(logs)
+            if not next_cursor:
+                break
+            after = decode_cursor(next_cursor)
+        ordered = sorted(timings)
+        print(f"{name:<10} pages={len(timings)} rows={rows} "
+              f"first={timings[0]:.1f}ms last={timings[-1]:.1f}ms "
+              f"p50={ordered[len(ordered) // 2]:.1f}ms max={ordered[-1]:.1f}ms")
+
+### Command that partitions app_logs by month (run once, it rebuilds the table): flask logs-partition
+@app.cli.command("logs-partition")
+def logs_partition():
+    log_retention.partition_table(mysql.connection, datetime.now(timezone.utc).replace(tzinfo=None))
+
+### Command that applies the log retention policy (run daily, e.g. from cron): flask logs-retention
+### Adds the partitions of the coming months, archives and removes the expired rows; --dry-run only counts them.
+@app.cli.command("logs-retention")
+@click.option("--dry-run", is_flag=True, help="Count what would be archived without changing anything.")
+def logs_retention(dry_run):
+    started = time.perf_counter()
+    summary = log_retention.run(
+        mysql.connection,
+        audit_logger.refresh_types(),
+        datetime.now(timezone.utc).replace(tzinfo=None),
+        dry_run=dry_run
+    )
+    print(f"🏁 Retention {'dry run ' if dry_run else ''}done in {time.perf_counter() - started:.1f}s: "
+          f"{summary['archived']} rows archived, {summary['retained']} kept longer, {summary['deleted']} deleted, "
+          f"partitions dropped {summary['partitions_dropped'] or '-'}, added {summary['partitions_added'] or '-'}")
+
+### Command that searches the log archives, one JSON line per matching log: flask logs-search-archive --type LOGIN_FAILED --user 42
+@app.cli.command("logs-search-archive")
+@click.option("--type", "log_name", default=None, help="Log type name.")
+@click.option("--user", "user_id", type=int, default=None, help="User id.")
+@click.option("--from", "since", default=None, help="Oldest timestamp (ISO format).")
+@click.option("--to", "until", default=None, help="Timestamp the logs are older than (ISO format).")
+@click.option("--q", "message", default=None, help="Message contains (case insensitive).")
+@click.option("--limit", default=0, help="Stop after this many logs (0 for all).")
+@click.option("--count", "count_only", is_flag=True, help="Only print the number of matching logs.")
+def logs_search_archive(log_name, user_id, since, until, message, limit, count_only):
+    records = scan_archives(
+        log_retention.archive_dir,
+        limit=limit or None,
+        log_name=log_name.upper() if log_name else None,
+        user_id=user_id,
+        since=parse_datetime_filter(since),
+        until=parse_datetime_filter(until),
+        message=message
+    )
+    if count_only:
+        click.echo(sum(1 for _ in records))
+        return
+    for record in records:
+        click.echo(json.dumps(record, ensure_ascii=False))
+
+### Command that builds the hourly rollups from the logs already stored: flask rollups-backfill --chunk-hours 24
+### Complete hours only by default (until the start of the current hour); running it again changes nothing.
+@app.cli.command("rollups-backfill")
+@click.option("--from", "since", default=None, help="First hour (ISO format), default the oldest log.")
+@click.option("--to", "until", default=None, help="Hour to stop before (ISO format), default the current hour.")
+@click.option("--chunk-hours", default=24, help="Hours of logs aggregated per pass.")
+def rollups_backfill(since, until, chunk_hours):
+    until = parse_datetime_filter(until) or hour_bucket(utc_now())
+    since = parse_datetime_filter(since)
+    if since is None:
+        cursor = mysql.connection.cursor()
+        cursor.execute("SELECT LEAST(COALESCE((SELECT MIN(timestamp) FROM app_logs), %s), "
+                       "COALESCE((SELECT MIN(timestamp) FROM app_logs_retained), %s))", (until, until))
+        since = cursor.fetchone()[0]
+        cursor.close()
+    started = time.perf_counter()
+    rows = backfill_rollups(
+        mysql.connection, since, until, chunk_hours,
+        progress=lambda end, count: print(f"📊 Rollups built up to {end} ({count} rows written)")
+    )
+    print(f"🏁 Rollups backfilled from {since} to {until} in {time.perf_counter() - started:.1f}s ({rows} rows written)")
+
+### Command that shows the email outbox, sends what is due (--drain) or queues the dead emails again (--retry-dead)
+### flask email-outbox --drain
+@app.cli.command("email-outbox")
+@click.option("--drain", is_flag=True, help="Send every due email now, batch by batch.")
+@click.option("--retry-dead", is_flag=True, help="Queue the dead emails again.")
+def email_outbox_command(drain, retry_dead):
+    with db_pool.connection() as connection:
+        if retry_dead:
+            print(f"🔁 {email_outbox.retry_dead(connection)} dead emails queued again")
+    if drain:
+        started = time.perf_counter()
+        while email_outbox.drain():
+            pass
+        smtp_sender.close()
+        print(f"📮 Outbox drained in {time.perf_counter() - started:.1f}s: "
+              f"{email_outbox.sent} sent, {email_outbox.failed} failed ({email_outbox.dead} dead), "
+              f"{smtp_sender.connects} SMTP connection(s)")
+    with db_pool.connection() as connection:
+        print(f"📬 Outbox: {email_outbox.counts(connection) or 'empty'}")
+
+### Command that runs a local SMTP stand-in printing the emails it receives: flask smtp-stand-in --port 1025
+### Run the app with SMTP_HOST=localhost SMTP_PORT=1025 SMTP_SECURITY=none to send to it.
+@app.cli.command("smtp-stand-in")
+@click.option("--host", default="localhost", help="Address to listen on.")
+@click.option("--port", default=1025, help="Port to listen on.")
+@click.option("--reject", multiple=True, help="Recipient refused with 550 (repeatable).")
+@click.option("--drop-every", default=0, help="Close the connection after every N emails.")
+def smtp_stand_in(host, port, reject, drop_every):
+    server = SmtpStandIn(host, port, reject=reject, drop_every=drop_every)
+    print(f"📭 SMTP stand-in listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"📭 SMTP stand-in stopped, {len(server.messages)} emails received")
+
+### Command that compares the two category classification modes: flask bench-category --limit 10
+@app.cli.command("bench-category")
+@click.option("--limit", default=10, help="Number of recent product suggestions to classify.")
+def bench_category(limit):
+    cursor = mysql.connection.cursor()
+    cursor.execute("""
+        SELECT product_name, product_description FROM product_suggestions
+        ORDER BY id DESC LIMIT %s
+    """, (limit,))
+    products = cursor.fetchall()
+    cursor.close()
+    if not products:
+        print("No product suggestions to classify.")
+        return
 
+    results = {}
+    ### Each mode uses its own call site, so the client counters give its calls and tokens
+    for mode, call_site in (("per_level", "category"), ("single_shot", "category_single")):
+        stats = llm_client.metrics[call_site]
+        calls, tokens = stats.calls, stats.input_tokens + stats.output_tokens
+        started = time.perf_counter()
+        results[mode] = [classify_category_path(name, description, mode=mode) for name, description in products]
+        elapsed = time.perf_counter() - started
+        calls, tokens = stats.calls - calls, stats.input_tokens + stats.output_tokens - tokens
+        resolved = sum(1 for path in results[mode] if path)
+        print(f"{mode:<12} products={len(products)} resolved={resolved} "
+              f"calls={calls} ({calls / len(products):.1f}/product) "
+              f"tokens={tokens} ({tokens / len(products):.0f}/product) "
+              f"wall={elapsed:.1f}s ({elapsed / len(products):.2f}s/product)")
+
+    same = sum(1 for a, b in zip(results["per_level"], results["single_shot"]) if a and b and normalize_category_path(a) == normalize_category_path(b))
+    print(f"Both modes agree on {same}/{len(products)} products")
+
+### Command that categorizes every product without a category: flask categorize-products
+@app.cli.command("categorize-products")
+@click.option("--chunk-size", default=200, help="Rows read per keyset page.")
+@click.option("--batch-size", default=8, help="Products packed in one AI prompt.")
+@click.option("--concurrency", default=4, help="AI prompts in flight at the same time.")
+@click.option("--rate", default=2.0, help="Maximum AI prompts started per second.")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint and start from the first product.")
+@click.option("--retries", default=2, help="Retries of a failed AI batch before its products count as failed.")
+def categorize_products_command(chunk_size, batch_size, concurrency, rate, restart, retries):
+    totals = bulk_categorize_products(chunk_size, batch_size, concurrency, rate, restart, retries=retries)
+    print(f"🏁 {totals['products']} products in {totals['seconds']}s "
+          f"({totals['products_per_second']} products/s): "
+          f"{totals['local']} local, {totals['ai']} AI ({totals['ai_calls']} calls, "
+          f"{totals['tokens_per_product']} tokens/product), {totals['unresolved']} unresolved, "
+          f"{totals['failed']} failed (asked again by the next run)")
 
 ###--------------------------------------------------
 ### M.Main Entry Point
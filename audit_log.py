@@ -0,0 +1,263 @@
+### Asynchronous, batched writer of the app_logs audit trail
+### log() never touches the database: the log type is resolved from an in-memory map of
+### log_types (id and isActive), disabled types are dropped right away and the entry goes into a
+### bounded queue. A background worker writes the queue with executemany when a batch is full or
+### every flush_interval seconds; whatever is still queued is written when the process stops.
+### Each batch also adds its counts to the hourly log_rollups, in the same transaction (see log_rollups.py).
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from log_rollups import rollup_counts, add_rollups
+
+class AuditLogger:
+    def __init__(self, connect, spawn, run=None, batch_size=200, flush_interval=1.0,
+                 max_queue=10000, types_check_interval=30.0, max_retries=3):
+        ### Context manager lending a DB connection
+        self.connect = connect
+        ### Function used to start the writer (socketio.start_background_task works with eventlet and threads)
+        self.spawn = spawn
+        ### Function running a blocking DB call, run(fn, *args) (e.g. in eventlet's native thread pool)
+        self.run = run or (lambda fn, *args: fn(*args))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.types_check_interval = types_check_interval
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.wakeup = threading.Event()
+        ### Serializes the writes of the worker and of close()
+        self.flush_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.started = False
+        self.closed = False
+        ### Log types by name: (log_type_id, is_active), with the version they were read at
+        self.types = None
+        self.types_version = None
+        self.types_checked_at = 0.0
+        self.types_lock = threading.Lock()
+        ### Batch that failed to be written, retried before the queue
+        self.retry_batch = []
+        self.retry_count = 0
+        ### Counters
+        self.enqueued = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped_full = 0
+        self.dropped_inactive = 0
+        self.dropped_unknown = 0
+        self.dropped_failed = 0
+        self.high_watermark = 0
+        self.last_flush_ms = 0.0
+
+    ###----------------------------------------------------------------------
+    ### Log types
+
+    ### Function to read the version of the log types (bumped whenever an admin changes one)
+    @staticmethod
+    def read_types_version(cursor):
+        cursor.execute("SELECT version FROM reference_data_versions WHERE name = 'log_types'")
+        result = cursor.fetchone()
+        return result[0] if result else 0
+
+    ### Function to read every log type with its isActive flag
+    def load_types(self, connection):
+        cursor = connection.cursor()
+        try:
+            version = self.read_types_version(cursor)
+            cursor.execute("SELECT log_name, log_type_id, isActive FROM log_types")
+            types = {log_name: (log_type_id, bool(is_active)) for log_name, log_type_id, is_active in cursor.fetchall()}
+        finally:
+            cursor.close()
+        self.types, self.types_version = types, version
+        self.types_checked_at = time.monotonic()
+        return types
+
+    ### Function that returns the log type map, read the first time and again when its version changed
+    ### The version is checked at most every types_check_interval seconds.
+    def log_types(self):
+        types = self.types
+        if types is not None and time.monotonic() - self.types_checked_at < self.types_check_interval:
+            return types
+        if types is None:
+            with self.types_lock:
+                if self.types is None:
+                    with self.connect() as connection:
+                        self.run(self.load_types, connection)
+                return self.types
+        ### Version check due: one caller checks it, the others keep using the current map meanwhile
+        if not self.types_lock.acquire(blocking=False):
+            return types
+        try:
+            with self.connect() as connection:
+                self.run(self.reload_types_if_changed, connection)
+        except Exception as e:
+            ### Keep logging with the current map, the version is checked again later
+            self.types_checked_at = time.monotonic()
+            print(f"⚠️ Log types version check failed: {e}")
+        finally:
+            self.types_lock.release()
+        return self.types
+
+    ### Function to read the log types again when their version changed
+    def reload_types_if_changed(self, connection):
+        cursor = connection.cursor()
+        try:
+            version = self.read_types_version(cursor)
+        finally:
+            cursor.close()
+        if version != self.types_version:
+            self.load_types(connection)
+        else:
+            self.types_checked_at = time.monotonic()
+
+    ### Function to read the log types again right away (after this worker changed one)
+    def refresh_types(self):
+        with self.types_lock:
+            with self.connect() as connection:
+                return self.run(self.load_types, connection)
+
+    ###----------------------------------------------------------------------
+    ### Queue
+
+    ### Function to queue an audit entry, returns False when it was dropped
+    ### Entries of disabled or unknown log types are dropped before they are queued;
+    ### when the queue is full the entry is dropped and counted instead of blocking the request.
+    def log(self, log_name, message, user_id=None):
+        entry = self.log_types().get(log_name)
+        if entry is None:
+            self.dropped_unknown += 1
+            print(f"Error: Log type {log_name} not found in log_types table.")
+            return False
+        log_type_id, is_active = entry
+        if not is_active:
+            self.dropped_inactive += 1
+            return False
+        ### The time of the action, not of the write
+        timestamp = datetime.now(timezone.utc).replace(tzinfo=None)
+        try:
+            self.queue.put_nowait((user_id, log_type_id, message, timestamp))
+        except queue.Full:
+            self.dropped_full += 1
+            return False
+        self.enqueued += 1
+        size = self.queue.qsize()
+        self.high_watermark = max(self.high_watermark, size)
+        self.start()
+        if size >= self.batch_size:
+            self.wakeup.set()
+        return True
+
+    ### Function to start the writer once per process
+    def start(self):
+        if self.started or self.closed:
+            return
+        with self.start_lock:
+            if self.started:
+                return
+            self.started = True
+            self.spawn(self.work)
+            print("🧾 Audit log writer started")
+
+    ### Writer loop
+    def work(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                while self.flush() >= self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"❌ Audit log flush failed: {e}")
+
+    ### Function to take the next batch: the failed batch first, then up to batch_size queued entries
+    def next_batch(self):
+        if self.retry_batch:
+            return self.retry_batch
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    ### Function to write one batch with executemany, returns the number of entries written
+    ### A failed batch is retried by the next flush, up to max_retries times, then dropped and counted.
+    def flush(self):
+        with self.flush_lock:
+            batch = self.next_batch()
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            try:
+                with self.connect() as connection:
+                    self.run(self.write, connection, batch)
+            except Exception:
+                self.failed_flushes += 1
+                self.retry_count += 1
+                if self.retry_count > self.max_retries:
+                    self.dropped_failed += len(batch)
+                    self.retry_batch, self.retry_count = [], 0
+                else:
+                    self.retry_batch = batch
+                raise
+            self.retry_batch, self.retry_count = [], 0
+            self.written += len(batch)
+            self.flushes += 1
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            return len(batch)
+
+    ### Function that inserts a batch of entries in one statement, counts it in the rollups and commits both
+    @staticmethod
+    def write(connection, batch):
+        cursor = connection.cursor()
+        try:
+            ### Explicit transaction: the pooled connections are in autocommit mode
+            cursor.execute("START TRANSACTION")
+            cursor.executemany("""
+                INSERT INTO app_logs (user_id, log_type_id, message, timestamp)
+                VALUES (%s, %s, %s, %s)
+            """, batch)
+            add_rollups(cursor, rollup_counts(batch))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    ### Function to stop the writer and write everything still queued (registered with atexit)
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        failures = 0
+        while True:
+            try:
+                if not self.flush():
+                    break
+            except Exception as e:
+                failures += 1
+                if failures > self.max_retries:
+                    print(f"❌ Audit log entries lost on shutdown: {e}")
+                    break
+        print(f"🧾 Audit log closed, {self.written} entries written")
+
+    ### Function that returns the writer counters (queue depth and drops show the backpressure)
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "max_queue": self.queue.maxsize,
+            "high_watermark": self.high_watermark,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "flushes": self.flushes,
+            "average_batch": round(self.written / self.flushes, 1) if self.flushes else 0.0,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "failed_flushes": self.failed_flushes,
+            "dropped_full": self.dropped_full,
+            "dropped_inactive": self.dropped_inactive,
+            "dropped_unknown": self.dropped_unknown,
+            "dropped_failed": self.dropped_failed,
+            "log_types_version": self.types_version
+        }
@@ -0,0 +1,120 @@
+### Local nearest-neighbour category classifier
+### Every category full path and every already categorized product name is a row
+### of a numpy matrix; a product is classified by its top-k most similar rows.
+import re
+import threading
+### Vector maths
+import numpy as np
+### Stateless vectorizer, no fitting needed
+from sklearn.feature_extraction.text import HashingVectorizer, ENGLISH_STOP_WORDS
+
+### Function to split a text into simple lexical tokens (lower case, no stop words, no plural "s")
+def lexical_tokens(text):
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", (text or "").lower()):
+        if word in ENGLISH_STOP_WORDS or len(word) < 2:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+class NearestCategoryClassifier:
+    def __init__(self, n_features=2048, max_products=4000, top_k=5, min_similarity=0.3, min_margin=0.1):
+        self.top_k = top_k
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.max_products = max_products
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features,
+            tokenizer=lexical_tokens,
+            token_pattern=None,
+            lowercase=False,
+            ngram_range=(1, 2),
+            alternate_sign=False,
+            norm="l2"
+        )
+        self.lock = threading.Lock()
+        ### Category rows never change between builds, product rows are a ring buffer after them
+        self.matrix = np.zeros((0, n_features), dtype=np.float32)
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.category_rows = 0
+        self.product_rows = 0
+        self.next_product_row = 0
+
+    ### Function to vectorize texts into L2 normalised rows
+    def vectorize(self, texts):
+        return self.vectorizer.transform(texts).toarray().astype(np.float32)
+
+    ### Function to (re)build the matrix from {category_id: full path} and [(product name, category_id)]
+    def build(self, category_paths, products):
+        products = list(products)[:self.max_products]
+        category_ids = list(category_paths)
+        texts = [category_paths[cat_id] for cat_id in category_ids] + [name for name, _ in products]
+        labels = category_ids + [cat_id for _, cat_id in products]
+        ### Room for max_products product rows so incremental updates don't reallocate
+        matrix = np.zeros((len(category_ids) + self.max_products, self.vectorizer.n_features), dtype=np.float32)
+        if texts:
+            matrix[:len(texts)] = self.vectorize(texts)
+        label_array = np.zeros(len(matrix), dtype=np.int64)
+        label_array[:len(labels)] = labels
+        with self.lock:
+            self.matrix = matrix
+            self.labels = label_array
+            self.category_rows = len(category_ids)
+            self.product_rows = len(products)
+            self.next_product_row = len(products) % self.max_products if self.max_products else 0
+
+    ### Function to add a categorized product without rebuilding (manual or AI assignment)
+    def add_example(self, product_name, category_id):
+        if not self.max_products or not product_name:
+            return
+        vector = self.vectorize([product_name])[0]
+        with self.lock:
+            row = self.category_rows + self.next_product_row
+            self.matrix[row] = vector
+            self.labels[row] = category_id
+            self.next_product_row = (self.next_product_row + 1) % self.max_products
+            self.product_rows = min(self.product_rows + 1, self.max_products)
+
+    ### Function to predict the category of a product
+    ### Returns (category_id or None when not confident, details for logging)
+    def predict(self, product_name, product_description=""):
+        ### The name is repeated so it weighs more than the description
+        vector = self.vectorize([f"{product_name} {product_name} {product_description or ''}"])[0]
+        with self.lock:
+            used = self.category_rows + self.product_rows
+            if not used or not vector.any():
+                return None, {"reason": "empty"}
+            ### Similarity with every row in one matrix-vector product
+            similarities = self.matrix[:used] @ vector
+            labels = self.labels[:used]
+        k = min(self.top_k, used)
+        top = np.argpartition(-similarities, k - 1)[:k]
+
+        ### Sum the similarities of the neighbours of each category
+        scores = {}
+        for row in top:
+            scores[int(labels[row])] = scores.get(int(labels[row]), 0.0) + float(similarities[row])
+        ranked = sorted(scores.items(), key=lambda item: -item[1])
+        best_id, best_score = ranked[0]
+        second_score = ranked[1][1] if len(ranked) > 1 else 0.0
+        best_similarity = float(similarities[top].max())
+        margin = (best_score - second_score) / best_score if best_score > 0 else 0.0
+        details = {
+            "category_id": best_id,
+            "similarity": round(best_similarity, 3),
+            "margin": round(margin, 3)
+        }
+        ### Only confident predictions are returned, the caller falls back to the AI otherwise
+        if best_similarity < self.min_similarity or margin < self.min_margin:
+            return None, details
+        return best_id, details
+
+    ### Function that returns the size of the index
+    def stats(self):
+        return {
+            "categories": self.category_rows,
+            "products": self.product_rows,
+            "max_products": self.max_products
+        }
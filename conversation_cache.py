@@ -0,0 +1,177 @@
+### In-process cache of conversation state
+### The conversation row and its newest messages are kept in memory so a chat turn doesn't re-read them.
+### Durable fields are written through (the DB is updated first, then the entry); every durable
+### write bumps conversations.version, so an entry whose version doesn't match the row was changed
+### by another worker and is dropped. last_activity_at changes on every message and is only
+### needed for the inactivity timeout, so it is kept in memory and written behind in bulk.
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+### Function that returns the current UTC time the way MySQL returns DATETIME values (naive)
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+### Cached state of one conversation
+class ConversationState:
+    __slots__ = ("conversation_id", "user_id", "title", "keywords", "is_active",
+                 "last_activity_at", "version", "recent_messages")
+
+    def __init__(self, conversation_id, user_id, title, keywords, is_active, last_activity_at, version, recent_messages=None):
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.title = title
+        self.keywords = keywords or ""
+        self.is_active = bool(is_active)
+        self.last_activity_at = last_activity_at
+        self.version = version
+        ### Newest messages as (sender_type, content, token_count), None until they are loaded
+        self.recent_messages = recent_messages
+
+class ConversationCache:
+    def __init__(self, capacity=2048, max_messages=50):
+        self.capacity = capacity
+        self.max_messages = max_messages
+        self.entries = OrderedDict()
+        ### last_activity_at values waiting to be written, by conversation
+        self.pending_activity = {}
+        self.lock = threading.Lock()
+        ### Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conflicts = 0
+        self.activity_flushes = 0
+        self.activity_rows = 0
+
+    ### Function to get the state of a conversation, None when it isn't cached
+    def get(self, conversation_id):
+        with self.lock:
+            state = self.entries.get(conversation_id)
+            if state is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(conversation_id)
+            self.hits += 1
+            return state
+
+    ### Function to cache a state read from (or just written to) the database, evicting the least recently used
+    def put(self, state):
+        with self.lock:
+            ### An activity not flushed yet is newer than the row
+            pending = self.pending_activity.get(state.conversation_id)
+            if pending and (state.last_activity_at is None or pending > state.last_activity_at):
+                state.last_activity_at = pending
+            if state.recent_messages is not None:
+                state.recent_messages = deque(state.recent_messages, maxlen=self.max_messages)
+            self.entries[state.conversation_id] = state
+            self.entries.move_to_end(state.conversation_id)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return state
+
+    ### Function to drop a conversation, the next read loads it from the database
+    def invalidate(self, conversation_id, conflict=False):
+        with self.lock:
+            self.entries.pop(conversation_id, None)
+            if conflict:
+                self.conflicts += 1
+
+    ### Function to write through durable fields after an UPDATE that bumped the row version
+    ### expected_version is the version the UPDATE was based on; if the entry is at another
+    ### version it is out of date and is dropped instead.
+    def apply(self, conversation_id, expected_version, **fields):
+        with self.lock:
+            state = self.entries.get(conversation_id)
+            if state is None:
+                return
+            if state.version != expected_version:
+                self.entries.pop(conversation_id, None)
+                self.conflicts += 1
+                return
+            for name, value in fields.items():
+                setattr(state, name, value)
+            state.version = expected_version + 1
+
+    ### Function to add new messages to the cached history (only when the history is loaded)
+    def add_messages(self, conversation_id, messages):
+        with self.lock:
+            state = self.entries.get(conversation_id)
+            if state is not None and state.recent_messages is not None:
+                state.recent_messages.extend(messages)
+
+    ### Function to get a copy of the cached newest messages, None when they aren't loaded
+    def get_messages(self, conversation_id):
+        with self.lock:
+            state = self.entries.get(conversation_id)
+            if state is None or state.recent_messages is None:
+                return None
+            return list(state.recent_messages)
+
+    ### Function to store the newest messages read from the database
+    def set_messages(self, conversation_id, messages):
+        with self.lock:
+            state = self.entries.get(conversation_id)
+            if state is not None:
+                state.recent_messages = deque(messages, maxlen=self.max_messages)
+
+    ### Function to record activity on a conversation, written to the database by flush_activity
+    def touch(self, conversation_id, when=None):
+        when = when or utc_now()
+        with self.lock:
+            self.pending_activity[conversation_id] = when
+            state = self.entries.get(conversation_id)
+            if state is not None:
+                state.last_activity_at = when
+
+    ### Function to write every pending last_activity_at in one UPDATE, returns the number of conversations
+    ### The pending values are put back when the write fails, unless a newer one arrived meanwhile.
+    def flush_activity(self, connection):
+        with self.lock:
+            pending, self.pending_activity = self.pending_activity, {}
+        if not pending:
+            return 0
+        ids = list(pending)
+        cases = " ".join(["WHEN %s THEN %s"] * len(ids))
+        params = [value for conversation_id in ids for value in (conversation_id, pending[conversation_id])]
+        cursor = connection.cursor()
+        try:
+            ### GREATEST keeps a newer timestamp written by another worker
+            cursor.execute(f"""
+                UPDATE conversations
+                SET last_activity_at = GREATEST(COALESCE(last_activity_at, '1970-01-01'), CASE conversation_id {cases} END)
+                WHERE conversation_id IN ({", ".join(["%s"] * len(ids))})
+            """, params + ids)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            with self.lock:
+                for conversation_id, when in pending.items():
+                    newer = self.pending_activity.get(conversation_id)
+                    if newer is None or newer < when:
+                        self.pending_activity[conversation_id] = when
+            raise
+        finally:
+            cursor.close()
+        with self.lock:
+            self.activity_flushes += 1
+            self.activity_rows += len(ids)
+        return len(ids)
+
+    ### Function that returns the cache counters
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "conflicts": self.conflicts,
+                "pending_activity": len(self.pending_activity),
+                "activity_flushes": self.activity_flushes,
+                "activity_rows": self.activity_rows
+            }
@@ -0,0 +1,66 @@
+### Small pool of MySQL connections for work running outside the request's own connection
+### (concurrent stages of a request, background threads).
+import queue
+import threading
+from contextlib import contextmanager
+
+class ConnectionPool:
+    def __init__(self, connect, size=4, timeout=10.0):
+        ### Function that opens a new connection
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    ### Context manager lending a connection; it is closed instead of returned when the block fails
+    @contextmanager
+    def connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        except Exception:
+            self.discard(connection)
+            raise
+        else:
+            self.idle.put(connection)
+
+    ### Function to take an idle connection, open one while under the size limit, or wait for one
+    def checkout(self):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            ### Idle connections may have been closed by the server (wait_timeout)
+            try:
+                connection.ping()
+                return connection
+            except Exception:
+                self.discard(connection)
+        with self.lock:
+            can_open = self.created < self.size
+            if can_open:
+                self.created += 1
+        if not can_open:
+            return self.idle.get(timeout=self.timeout)
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    ### Function to close a broken connection and free its place
+    def discard(self, connection):
+        with self.lock:
+            self.created -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    ### Function that returns the pool counters
+    def stats(self):
+        return {"size": self.size, "open": self.created, "idle": self.idle.qsize()}
@@ -0,0 +1,81 @@
+### Compact storage of the email_logs rows
+### A sent email is stored as the version of the template it was rendered from plus its variables
+### (zlib-compressed JSON); subject and body are rendered again only when a log is viewed.
+### When the variables can't be stored as JSON the rendering couldn't be repeated, so the rendered
+### subject and body are stored zlib-compressed instead.
+import hashlib
+import json
+import threading
+import zlib
+from functools import lru_cache
+from jinja2 import Template
+
+### Function to compress a JSON value
+def pack_json(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+
+### Function to read a value written by pack_json
+def unpack_json(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+### Function to pack the variables of an email, None when they don't survive a JSON round trip
+def pack_variables(variables):
+    try:
+        if json.loads(json.dumps(variables)) != variables:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return pack_json(variables)
+
+### Function to pack a rendered subject and body
+def pack_content(subject, body):
+    return pack_json({"subject": subject, "body": body})
+
+### Function that compiles a template text once
+@lru_cache(maxsize=256)
+def compile_template(text):
+    return Template(text)
+
+### Function to render a stored template text with the stored variables
+def render_stored(text, variables_blob):
+    return compile_template(text).render(**unpack_json(variables_blob))
+
+### Versions of the email templates, one row per distinct (subject, body) of a template
+### The id of a version is cached, so logging an email normally doesn't read the versions table.
+### A new version is stored and committed on a connection of its own before its id is cached: the
+### transaction of the email log may still roll back, the version row must not.
+class TemplateVersions:
+    def __init__(self, connect):
+        ### Context manager lending a DB connection (in autocommit mode)
+        self.connect = connect
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    ### Function to get the fingerprint of a template text
+    @staticmethod
+    def content_hash(subject, body):
+        return hashlib.sha256(f"{subject}\0{body}".encode("utf-8")).hexdigest()
+
+    ### Function to get the id of the version of a template, stored the first time it is seen
+    def version_id(self, template_name, subject, body):
+        key = (template_name, self.content_hash(subject, body))
+        with self.lock:
+            version_id = self.ids.get(key)
+        if version_id is not None:
+            return version_id
+        with self.connect() as connection:
+            cursor = connection.cursor()
+            try:
+                ### LAST_INSERT_ID(id) makes lastrowid the id of the existing row when the version is already stored
+                cursor.execute("""
+                    INSERT INTO email_template_versions (template_name, content_hash, subject, body)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+                """, (template_name, key[1], subject, body))
+                version_id = cursor.lastrowid
+                connection.commit()
+            finally:
+                cursor.close()
+        with self.lock:
+            self.ids[key] = version_id
+        return version_id
@@ -0,0 +1,321 @@
+### Transactional outbox of the emails sent by the app
+### Requests don't talk to SMTP: they insert an email_outbox row with the same transaction as the change
+### the email is about (a new user, a changed username...), so an email is queued if and only if the change
+### is committed. A background sender claims pending rows in batches with SELECT ... FOR UPDATE SKIP LOCKED
+### (several workers can share the table), sends them over one long-lived authenticated SMTP connection and
+### records every attempt in email_logs. Failed sends are retried with a growing delay; after max_attempts the
+### row is marked dead and stays in the table for inspection (flask email-outbox --retry-dead queues it again).
+import json
+import os
+import smtplib
+import socket
+import threading
+import time
+from email.mime.text import MIMEText
+
+### Errors after which the SMTP connection is opened again and the email sent once more
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+
+### Function to queue an email with the caller's cursor, the email is sent once the caller commits
+def enqueue_email(cursor, template_name, recipient_email, variables, max_attempts=5):
+    cursor.execute("""
+        INSERT INTO email_outbox (template_name, recipient_email, variables, max_attempts)
+        VALUES (%s, %s, %s, %s)
+    """, (template_name, recipient_email, json.dumps(variables or {}), max_attempts))
+    return cursor.lastrowid
+
+### One SMTP connection kept open between emails
+### The connection (TLS handshake and login) is opened by the first email and reused by the next ones;
+### when the server dropped it, it is opened again and the email sent once more. Idle connections are
+### closed after idle_timeout seconds, before the server drops them itself.
+class SmtpSender:
+    def __init__(self, host, port, username=None, password=None, sender_email=None, sender_name="Botify",
+                 security="ssl", timeout=30.0, idle_timeout=60.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender_email = sender_email or username
+        self.sender_name = sender_name
+        ### ssl (SMTP over TLS), starttls, or none (local SMTP stand-in)
+        self.security = security
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+        ### Counters
+        self.connects = 0
+        self.reconnects = 0
+        self.sent = 0
+
+    ### Function that opens and authenticates the connection
+    def connect(self):
+        if self.security == "ssl":
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == "starttls":
+                server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        self.server = server
+        self.connects += 1
+
+    ### Function to close the connection, ignoring a server that is already gone
+    def close(self):
+        server, self.server = self.server, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    ### Function to close the connection when it has not been used for idle_timeout seconds
+    def close_if_idle(self):
+        with self.lock:
+            if self.server is not None and time.monotonic() - self.last_used > self.idle_timeout:
+                self.close()
+
+    ### Function that builds the message of an email
+    def message(self, recipient_email, subject, body):
+        message = MIMEText(body)
+        message["Subject"] = subject
+        message["From"] = f"{self.sender_name} <{self.sender_email}>"
+        message["To"] = recipient_email
+        return message
+
+    ### Function that sends an email, opening the connection again once if the server dropped it
+    def send(self, recipient_email, subject, body):
+        message = self.message(recipient_email, subject, body)
+        with self.lock:
+            for attempt in range(2):
+                if self.server is None:
+                    self.connect()
+                try:
+                    self.server.send_message(message)
+                    break
+                except RECONNECT_ERRORS:
+                    self.close()
+                    if attempt:
+                        raise
+                    self.reconnects += 1
+            self.last_used = time.monotonic()
+            self.sent += 1
+
+    ### Function that returns the connection counters
+    def stats(self):
+        return {
+            "host": f"{self.host}:{self.port}",
+            "connected": self.server is not None,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "sent": self.sent
+        }
+
+class EmailOutbox:
+    def __init__(self, connect, spawn, smtp, render, record, run=None, batch_size=20, poll_interval=5.0,
+                 lease_seconds=300, retry_delay=30):
+        ### Context manager lending a DB connection
+        self.connect = connect
+        ### Function used to start the sender (socketio.start_background_task works with eventlet and threads)
+        self.spawn = spawn
+        self.smtp = smtp
+        ### render(connection, template_name, variables) -> (template, subject, body); any error marks the email dead
+        self.render = render
+        ### record(connection, template_name, recipient_email, subject, body, status, error, template, variables) writes email_logs
+        self.record = record
+        ### Function running a blocking DB call, run(fn, *args) (e.g. in eventlet's native thread pool)
+        self.run = run or (lambda fn, *args: fn(*args))
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.wakeup = threading.Event()
+        self.start_lock = threading.Lock()
+        self.started = False
+        self.closed = False
+        ### Counters
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+        self.batches = 0
+
+    ### Function to start the sender once per process
+    def start(self):
+        if self.started or self.closed:
+            return
+        with self.start_lock:
+            if self.started:
+                return
+            self.started = True
+            self.spawn(self.work)
+            print(f"📮 Email outbox sender started ({self.worker_id})")
+
+    ### Function to wake the sender up (after a request queued emails and committed)
+    def wake(self):
+        self.start()
+        self.wakeup.set()
+
+    ### Sender loop
+    def work(self):
+        while not self.closed:
+            try:
+                handled = self.drain()
+            except Exception as e:
+                print(f"❌ Email outbox error: {e}")
+                handled = 0
+            ### Sleep until an email is queued or the poll interval passes (a full batch means more may be waiting)
+            if handled < self.batch_size:
+                self.smtp.close_if_idle()
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+    ### Function to stop the sender and close the SMTP connection (registered with atexit)
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.smtp.close()
+
+    ###----------------------------------------------------------------------
+    ### Claiming and delivering
+
+    ### Function to claim up to batch_size pending emails, returns their rows
+    ### Emails left in 'sending' by a sender that died are pending again after lease_seconds,
+    ### or dead when that was their last attempt.
+    def claim(self, connection):
+        cursor = connection.cursor()
+        try:
+            ### Explicit transaction: the pooled connections are in autocommit mode
+            cursor.execute("START TRANSACTION")
+            cursor.execute("""
+                UPDATE email_outbox
+                SET status = IF(attempts >= max_attempts, 'dead', 'pending'),
+                    last_error = IF(attempts >= max_attempts, 'The sender stopped during the last attempt', last_error),
+                    locked_by = NULL, locked_at = NULL
+                WHERE status = 'sending' AND locked_at < NOW() - INTERVAL %s SECOND
+            """, (self.lease_seconds,))
+            cursor.execute("""
+                SELECT id, template_name, recipient_email, variables, attempts, max_attempts
+                FROM email_outbox
+                WHERE status = 'pending' AND run_after <= NOW()
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (self.batch_size,))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute(f"""
+                    UPDATE email_outbox
+                    SET status = 'sending', attempts = attempts + 1, locked_by = %s, locked_at = NOW()
+                    WHERE id IN ({", ".join(["%s"] * len(rows))})
+                """, [self.worker_id] + [row[0] for row in rows])
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        return rows
+
+    ### Function that stores the outcome of one attempt: the outbox row and its email_logs entry, in one transaction
+    def finish(self, connection, row, subject, body, template, variables, error=None, permanent=False):
+        email_id, template_name, recipient_email, _, attempts, max_attempts = row
+        gave_up = error is not None and (permanent or attempts + 1 >= max_attempts)
+        status = "sent" if error is None else ("dead" if gave_up else "pending")
+        cursor = connection.cursor()
+        try:
+            cursor.execute("START TRANSACTION")
+            cursor.execute("""
+                UPDATE email_outbox
+                SET status = %s, last_error = %s, locked_by = NULL, locked_at = NULL,
+                    run_after = IF(%s = 'pending', NOW() + INTERVAL %s SECOND, run_after),
+                    sent_at = IF(%s = 'sent', NOW(), NULL)
+                WHERE id = %s
+            """, (status, error, status, self.retry_delay * (2 ** attempts), status, email_id))
+            log_error = None
+            if error is not None:
+                log_error = f"Attempt {attempts + 1}/{max_attempts}{', gave up' if gave_up else ''}: {error}"
+            self.record(connection, template_name, recipient_email, subject, body,
+                        "SUCCESS" if error is None else "FAILED", log_error, template, variables)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        return status
+
+    ### Function that renders and sends one claimed email, returns its new status
+    def deliver(self, connection, row):
+        _, template_name, recipient_email, variables, _, _ = row
+        try:
+            variables = json.loads(variables) if variables else {}
+            template, subject, body = self.run(self.render, connection, template_name, variables)
+        except Exception as e:
+            ### A missing or broken template fails the same way next time: sending again wouldn't help
+            print(f"⚠️ Email {template_name} to {recipient_email} can't be rendered: {e}")
+            return self.run(self.finish, connection, row, None, None, None, variables, str(e)[:2000], True)
+        try:
+            self.smtp.send(recipient_email, subject, body)
+        except Exception as e:
+            print(f"⚠️ Email {template_name} to {recipient_email} failed: {e}")
+            ### A refused recipient is refused again by the next attempt
+            permanent = isinstance(e, smtplib.SMTPRecipientsRefused)
+            return self.run(self.finish, connection, row, subject, body, template, variables, str(e)[:2000], permanent)
+        return self.run(self.finish, connection, row, subject, body, template, variables)
+
+    ### Function that claims one batch and delivers it, returns the number of emails handled
+    def drain(self):
+        with self.connect() as connection:
+            rows = self.run(self.claim, connection)
+            for row in rows:
+                status = self.deliver(connection, row)
+                if status == "sent":
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                    self.dead += status == "dead"
+        if rows:
+            self.batches += 1
+        return len(rows)
+
+    ###----------------------------------------------------------------------
+    ### Inspection
+
+    ### Function to queue the dead emails again, returns how many were queued
+    @staticmethod
+    def retry_dead(connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("""
+                UPDATE email_outbox SET status = 'pending', attempts = 0, run_after = NOW()
+                WHERE status = 'dead'
+            """)
+            connection.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    ### Function that returns the number of emails per status
+    @staticmethod
+    def counts(connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status")
+            return {status: count for status, count in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    ### Function that returns the sender counters
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "running": self.started and not self.closed,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dead": self.dead,
+            "batches": self.batches,
+            "smtp": self.smtp.stats()
+        }
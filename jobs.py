@@ -0,0 +1,148 @@
+### Background job runner backed by the background_jobs table
+### Jobs are rows in MySQL so they survive restarts; a small pool of in-process
+### workers claims them with SELECT ... FOR UPDATE SKIP LOCKED, which lets several
+### gunicorn workers share the same table without running a job twice.
+import json
+import os
+import socket
+import threading
+import traceback
+
+class JobRunner:
+    def __init__(self, app, mysql, spawn, workers=2, poll_interval=2.0, lease_seconds=300, retry_delay=10):
+        self.app = app
+        self.mysql = mysql
+        ### Function used to start a worker (socketio.start_background_task works with eventlet and threads)
+        self.spawn = spawn
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.handlers = {}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.wakeup = threading.Event()
+        self.started = False
+        self.start_lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+
+    ### Decorator that registers the handler of a job type, handler(payload)
+    def job(self, job_type):
+        def register(handler):
+            self.handlers[job_type] = handler
+            return handler
+        return register
+
+    ### Function to add a job to the queue (uses the connection of the current app context)
+    def enqueue(self, job_type, payload=None, max_attempts=3):
+        if job_type not in self.handlers:
+            raise ValueError(f"Unknown job type: {job_type}")
+        cursor = self.mysql.connection.cursor()
+        cursor.execute("""
+            INSERT INTO background_jobs (job_type, payload, max_attempts)
+            VALUES (%s, %s, %s)
+        """, (job_type, json.dumps(payload or {}), max_attempts))
+        self.mysql.connection.commit()
+        job_id = cursor.lastrowid
+        cursor.close()
+        ### Make sure a worker is running and wake it up
+        self.start()
+        self.wakeup.set()
+        return job_id
+
+    ### Function to start the worker pool once per process
+    def start(self):
+        if self.started:
+            return
+        with self.start_lock:
+            if self.started:
+                return
+            self.started = True
+            for _ in range(self.workers):
+                self.spawn(self.work)
+            print(f"🧵 Job runner started with {self.workers} worker(s) ({self.worker_id})")
+
+    ### Worker loop
+    def work(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    ran = self.run_next()
+            except Exception as e:
+                print(f"❌ Job worker error: {e}")
+                ran = False
+            ### Sleep until a job is enqueued or the poll interval passes
+            if not ran:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+    ### Function to put back jobs whose worker died while running them
+    def requeue_stale(self, cursor):
+        cursor.execute("""
+            UPDATE background_jobs
+            SET status = 'pending', locked_by = NULL, locked_at = NULL
+            WHERE status = 'running' AND locked_at < NOW() - INTERVAL %s SECOND
+        """, (self.lease_seconds,))
+
+    ### Function to claim and run one job, returns False when the queue is empty
+    def run_next(self):
+        connection = self.mysql.connection
+        cursor = connection.cursor()
+        self.requeue_stale(cursor)
+        ### Claim the oldest runnable job, skipping the ones other workers hold
+        cursor.execute("""
+            SELECT id, job_type, payload, attempts, max_attempts
+            FROM background_jobs
+            WHERE status = 'pending' AND run_after <= NOW()
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """)
+        row = cursor.fetchone()
+        if not row:
+            connection.commit()
+            cursor.close()
+            return False
+        job_id, job_type, payload, attempts, max_attempts = row
+        cursor.execute("""
+            UPDATE background_jobs
+            SET status = 'running', attempts = attempts + 1, locked_by = %s, locked_at = NOW()
+            WHERE id = %s
+        """, (self.worker_id, job_id))
+        connection.commit()
+
+        try:
+            handler = self.handlers[job_type]
+            handler(json.loads(payload) if payload else {})
+        except Exception as e:
+            ### Retry later with a growing delay, or give up after max_attempts
+            self.failed += 1
+            print(f"❌ Job {job_id} ({job_type}) failed: {e}")
+            connection.rollback()
+            gave_up = attempts + 1 >= max_attempts
+            cursor.execute("""
+                UPDATE background_jobs
+                SET status = %s, last_error = %s, locked_by = NULL, locked_at = NULL,
+                    run_after = NOW() + INTERVAL %s SECOND, finished_at = IF(%s, NOW(), NULL)
+                WHERE id = %s
+            """, ("failed" if gave_up else "pending", traceback.format_exc()[-2000:],
+                  self.retry_delay * (2 ** attempts), gave_up, job_id))
+        else:
+            self.processed += 1
+            cursor.execute("""
+                UPDATE background_jobs
+                SET status = 'done', locked_by = NULL, locked_at = NULL, finished_at = NOW()
+                WHERE id = %s
+            """, (job_id,))
+        connection.commit()
+        cursor.close()
+        return True
+
+    ### Function that returns the runner counters
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "workers": self.workers if self.started else 0,
+            "processed": self.processed,
+            "failed": self.failed
+        }
@@ -0,0 +1,44 @@
+### Keyset pagination helpers for the log viewers
+### Pages are ordered by (timestamp, id) descending; a page ends with an opaque cursor holding the
+### (timestamp, id) of its last row, and the next page starts strictly after it. Unlike OFFSET,
+### reading page 1000 costs the same as reading page 1 when (timestamp, id) is indexed.
+import base64
+from datetime import datetime
+
+### Default and maximum number of rows of a page
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+### Function to build the cursor of the row a page ended with
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+### Function to read a cursor back into (timestamp, id), raises ValueError when it is not valid
+def decode_cursor(token):
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError("Invalid page cursor")
+
+### Function to get the WHERE condition selecting the rows after a cursor, (sql, params)
+### The OR form lets MySQL use a range scan on the (timestamp, id) index.
+def after_cursor(cursor, timestamp_column, id_column):
+    timestamp, row_id = cursor
+    return (
+        f"({timestamp_column} < %s OR ({timestamp_column} = %s AND {id_column} < %s))",
+        [timestamp, timestamp, row_id]
+    )
+
+### Function to get a page size from a request argument, within 1..MAX_PAGE_SIZE
+def page_size(value, default=PAGE_SIZE):
+    try:
+        return max(1, min(MAX_PAGE_SIZE, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+### Function to escape a substring for LIKE '%...%'
+def like_pattern(text):
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
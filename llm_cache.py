@@ -0,0 +1,86 @@
+### Persistent cache for LLM chat replies backed by diskcache
+import hashlib
+import json
+import re
+### Disk backed cache shared by all workers on the same host
+from diskcache import Cache
+
+### Function to normalise a user message so trivial variations share a cache entry
+def normalize_message(text):
+    ### Lower case and collapse whitespace
+    text = re.sub(r"\s+", " ", (text or "").lower()).strip()
+    ### Ignore trailing punctuation ("best laptop?" == "best laptop")
+    return text.rstrip(" ?!.")
+
+### Function to hash a conversation history (list of {"role", "content"} dicts)
+def hash_history(conversation_history):
+    payload = json.dumps(
+        [[msg["role"], msg["content"]] for msg in conversation_history or []],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+### Response cache placed in front of the chat model
+### Entries expire after `ttl` seconds and the least recently used ones are
+### evicted once the cache grows past `size_limit` bytes.
+class ResponseCache:
+    ### Context fields appended to the system prompt, they change the answer
+    CONTEXT_FIELDS = ("age", "gender", "country", "keywords")
+
+    def __init__(self, directory, ttl=86400, size_limit=256 * 1024 * 1024, namespace="", enabled=True):
+        self.ttl = ttl
+        self.namespace = namespace
+        self.enabled = enabled
+        self.bypassed = 0
+        self.cache = Cache(
+            directory,
+            size_limit=size_limit,
+            eviction_policy="least-recently-used"
+        )
+        ### Hits and misses are counted by diskcache itself so they are shared across workers
+        self.cache.stats(enable=True)
+
+    ### Function to build the cache key of a chat request
+    def make_key(self, user_message, user_context=None, conversation_history=None):
+        user_context = user_context or {}
+        context = {field: user_context.get(field) for field in self.CONTEXT_FIELDS}
+        if context["keywords"]:
+            context["keywords"] = sorted(context["keywords"])
+        payload = json.dumps({
+            "namespace": self.namespace,
+            "message": normalize_message(user_message),
+            "context": context,
+            "history": hash_history(conversation_history)
+        }, sort_keys=True, ensure_ascii=False, default=str)
+        return "reply:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    ### Function to read a cached reply, returns None on miss or when bypassed
+    def get(self, key, bypass=False):
+        if not self.enabled or bypass:
+            self.bypassed += 1
+            return None
+        return self.cache.get(key)
+
+    ### Function to store a reply
+    def set(self, key, reply):
+        if not self.enabled:
+            return
+        self.cache.set(key, reply, expire=self.ttl)
+
+    ### Function to drop every cached reply
+    def clear(self):
+        self.cache.clear()
+
+    ### Function that returns the cache counters
+    def stats(self):
+        hits, misses = self.cache.stats()
+        lookups = hits + misses
+        return {
+            "enabled": self.enabled,
+            "hits": hits,
+            "misses": misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.cache),
+            "size_bytes": self.cache.volume()
+        }
@@ -0,0 +1,614 @@
+### Client layer in front of the LangChain chat model
+### Adds per-call deadlines, jittered exponential backoff on 429/5xx,
+### a global limit of in-flight requests, circuit breakers, hedged requests
+### and per call site metrics.
+import queue
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+
+### Raised when a call can't complete before its deadline
+class LLMTimeoutError(TimeoutError):
+    pass
+
+### Text of the <think> blocks of a reasoning model (an unfinished block runs to the end)
+THINK_PATTERN = re.compile(r"<think>(.*?)(?:</think>|$)", re.DOTALL)
+
+### Raised without calling the provider while the circuit breaker of a task is open
+class CircuitOpenError(Exception):
+    pass
+
+### Function to read the HTTP status code of a provider error, if any
+def get_status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+### Function to check if an error is worth retrying (rate limited or server error)
+def is_retryable(error):
+    status = get_status_code(error)
+    return status is not None and (status == 429 or status >= 500)
+
+### Function to read the Retry-After header (seconds) of a rate limited response
+def get_retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+### Spaces out calls so no more than `rate` start per second (shared by threads)
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_start = 0.0
+        self.lock = threading.Lock()
+
+    ### Function that blocks until the caller may start its call
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+### Circuit breaker of a task
+### Opens after `failure_threshold` consecutive failures or latency SLO breaches, rejects calls
+### while open, then lets `half_open_max_calls` probes through after `reset_timeout` seconds:
+### a good probe closes the circuit, a bad one opens it again.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, latency_slo=None, reset_timeout=30.0, half_open_max_calls=1):
+        self.failure_threshold = failure_threshold
+        self.latency_slo = latency_slo
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.strikes = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.lock = threading.Lock()
+        ### Counters
+        self.times_opened = 0
+        self.rejected = 0
+        self.slow_calls = 0
+
+    ### Function to check if a call may go to the provider
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probes = 0
+            if self.state == self.HALF_OPEN:
+                if self.probes >= self.half_open_max_calls:
+                    self.rejected += 1
+                    return False
+                self.probes += 1
+            return True
+
+    ### Function to record the outcome of an allowed call (latency in seconds)
+    def record(self, latency, error=None):
+        slow = error is None and self.latency_slo is not None and latency > self.latency_slo
+        bad = error is not None or slow
+        with self.lock:
+            if slow:
+                self.slow_calls += 1
+            if not bad:
+                self.strikes = 0
+                self.state = self.CLOSED
+                return
+            self.strikes += 1
+            if self.state == self.HALF_OPEN or self.strikes >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    print(f"⚡ Circuit opened after {self.strikes} failure(s) or slow call(s)")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    ### Function that returns the state and counters
+    def snapshot(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "strikes": self.strikes,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "slow_calls": self.slow_calls,
+                "latency_slo_s": self.latency_slo
+            }
+
+### Route of a task: the backend serving it, its latency SLO (seconds), output token cap, deadline,
+### and the route retried when its output fails validation (usually the big model)
+class TaskRoute:
+    def __init__(self, provider, model=None, slo=None, max_tokens=None, timeout=None, escalate_to=None):
+        self.provider = provider
+        self.model = model or type(provider).__name__
+        self.slo = slo
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.escalate_to = escalate_to
+
+### SLO and escalation counters of one task
+class TaskStats:
+    def __init__(self):
+        self.calls = 0
+        self.slo_breaches = 0
+        self.validation_failures = 0
+        self.escalations = 0
+        self.escalation_failures = 0
+
+    ### Function that returns the counters as a dict
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "slo_breaches": self.slo_breaches,
+            "validation_failures": self.validation_failures,
+            "escalations": self.escalations,
+            "escalation_failures": self.escalation_failures,
+            "escalation_rate": round(self.escalations / self.calls, 4) if self.calls else 0.0
+        }
+
+### Latency and retry counters of one call site
+class CallSiteStats:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        ### Output tokens and time spent in <think> blocks vs in the answer
+        self.reasoning_tokens = 0
+        self.answer_tokens = 0
+        self.reasoning_seconds = 0.0
+        self.reasoning_truncated = 0
+        self.latencies_ms = deque(maxlen=500)
+        ### Time to the first chunk of streamed calls
+        self.first_chunk_ms = deque(maxlen=500)
+
+    ### Function to get a percentile (0-1) of a latency sample
+    @staticmethod
+    def percentile(sample, p):
+        values = sorted(sample)
+        return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+    ### Function that returns the counters as a dict
+    def snapshot(self):
+        latencies = sorted(self.latencies_ms)
+        def percentile(p):
+            return round(self.percentile(latencies, p), 1)
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "latency_ms_p50": percentile(0.5),
+            "latency_ms_p95": percentile(0.95),
+            "latency_ms_max": round(latencies[-1], 1) if latencies else 0.0,
+            "first_chunk_ms_p95": round(self.percentile(self.first_chunk_ms, 0.95), 1),
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_win_rate": round(self.hedge_wins / self.hedges, 4) if self.hedges else 0.0,
+            "reasoning_tokens": self.reasoning_tokens,
+            "answer_tokens": self.answer_tokens,
+            "reasoning_share": round(self.reasoning_tokens / (self.reasoning_tokens + self.answer_tokens), 4)
+                if self.reasoning_tokens + self.answer_tokens else 0.0,
+            "reasoning_seconds": round(self.reasoning_seconds, 2),
+            "reasoning_truncated": self.reasoning_truncated
+        }
+
+### Client wrapping a LangChain chat model (ChatGroq)
+### The chat model keeps its HTTP client (and pooled keep-alive connections) between calls,
+### so a single LLMClient should be shared by the whole process.
+### `routes` maps a task name to its TaskRoute (backend, SLO, token cap); tasks not listed use chat_model.
+### `breakers` maps a task name to its CircuitBreaker; calls of `hedge_tasks` still running after the
+### rolling p95 latency of their call site start a second request, for at most `hedge_budget` of the calls.
+class LLMClient:
+    def __init__(self, chat_model, max_concurrency=8, timeout=60.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, routes=None, breakers=None,
+                 hedge_tasks=(), hedge_budget=0.1, hedge_min_samples=20):
+        self.chat_model = chat_model
+        self.routes = routes or {}
+        self.task_metrics = defaultdict(TaskStats)
+        self.breakers = breakers or {}
+        self.hedge_tasks = set(hedge_tasks)
+        self.hedge_budget = hedge_budget
+        self.hedge_min_samples = hedge_min_samples
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_concurrency = max_concurrency
+        ### Global limit of in-flight requests (a green semaphore under eventlet)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.metrics = defaultdict(CallSiteStats)
+
+    ### Function to compute the delay before a retry (full jitter exponential backoff)
+    def backoff(self, attempt, error=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = get_retry_after(error) if error is not None else None
+        return max(delay, retry_after or 0)
+
+    ### Function to get the time left before the deadline, raises when it is over
+    @staticmethod
+    def remaining(deadline, call_site):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise LLMTimeoutError(f"LLM call '{call_site}' exceeded its deadline")
+        return left
+
+    ### Function to take a concurrency slot before the deadline
+    def acquire(self, deadline, call_site):
+        if not self.slots.acquire(timeout=self.remaining(deadline, call_site)):
+            raise LLMTimeoutError(f"LLM call '{call_site}' waited too long for a free slot")
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    ### Function to run `attempt(timeout)` with retries on 429/5xx until the deadline
+    def call_with_retries(self, attempt, deadline, call_site):
+        stats = self.metrics[call_site]
+        tries = 0
+        while True:
+            try:
+                return attempt(self.remaining(deadline, call_site))
+            except Exception as e:
+                if not is_retryable(e) or tries >= self.max_retries:
+                    raise
+                delay = self.backoff(tries, e)
+                ### Don't sleep past the deadline
+                if time.monotonic() + delay >= deadline:
+                    raise
+                tries += 1
+                stats.retries += 1
+                print(f"🔁 LLM call '{call_site}' failed with {get_status_code(e)}, retry {tries} in {delay:.2f}s")
+                time.sleep(delay)
+
+    ### Function to add the token usage reported by the provider (LangChain usage_metadata)
+    def record_usage(self, call_site, message):
+        usage = getattr(message, "usage_metadata", None) or {}
+        stats = self.metrics[call_site]
+        stats.input_tokens += usage.get("input_tokens", 0)
+        stats.output_tokens += usage.get("output_tokens", 0)
+
+    ### Function to split the output of a call between reasoning (<think>) and answer tokens
+    ### Uses the reasoning count of the provider when reported (e.g. hidden reasoning), otherwise shares the
+    ### reported output tokens by text length, or estimates 4 characters per token without usage.
+    ### reasoning_seconds is measured on streams and estimated from the token share otherwise.
+    def record_reasoning(self, call_site, text, usage=None, latency=None, reasoning_seconds=None, truncated=False):
+        stats = self.metrics[call_site]
+        usage = usage or {}
+        text = text or ""
+        reasoning_chars = sum(len(block) for block in THINK_PATTERN.findall(text))
+        output_tokens = usage.get("output_tokens") or 0
+        reported = (usage.get("output_token_details") or {}).get("reasoning")
+        if reported is not None:
+            reasoning = reported
+            answer = max(0, output_tokens - reported)
+        elif output_tokens and text:
+            reasoning = round(output_tokens * reasoning_chars / len(text))
+            answer = output_tokens - reasoning
+        else:
+            reasoning = reasoning_chars // 4
+            answer = (len(text) - reasoning_chars) // 4
+        stats.reasoning_tokens += reasoning
+        stats.answer_tokens += answer
+        if reasoning_seconds is None and latency is not None and reasoning + answer:
+            reasoning_seconds = latency * reasoning / (reasoning + answer)
+        stats.reasoning_seconds += reasoning_seconds or 0.0
+        if truncated:
+            stats.reasoning_truncated += 1
+
+    ### Function to keep track of the text, usage and end of reasoning of a stream
+    @staticmethod
+    def observe_chunk(streamed, chunk):
+        streamed["text"].append(chunk.content or "")
+        streamed["usage"] = getattr(chunk, "usage_metadata", None) or streamed["usage"]
+        if (getattr(chunk, "response_metadata", None) or {}).get("reasoning_truncated"):
+            streamed["truncated"] = True
+        if streamed["think_closed_at"] is None and "</think>" in "".join(streamed["text"][-2:]):
+            streamed["think_closed_at"] = time.monotonic()
+
+    ### Function to record the outcome of a call
+    def record(self, call_site, started, error=None):
+        stats = self.metrics[call_site]
+        stats.calls += 1
+        stats.latencies_ms.append((time.monotonic() - started) * 1000)
+        if isinstance(error, LLMTimeoutError):
+            stats.timeouts += 1
+        if error is not None:
+            stats.failures += 1
+
+    ### Function to get the route of a task (its escalation route when escalate is set), None for the default model
+    def route(self, task, escalate=False):
+        route = self.routes.get(task)
+        if escalate:
+            return route.escalate_to if route is not None else None
+        return route
+
+    ### Function to check if a task has a bigger model to escalate to
+    def can_escalate(self, task):
+        return self.route(task, escalate=True) is not None
+
+    ### Function to resolve the model, call site, deadline and extra model arguments of a call
+    def prepare(self, task, call_site, timeout, escalate):
+        route = self.route(task, escalate)
+        if escalate and route is None:
+            raise ValueError(f"Task '{task}' has no escalation route")
+        model = route.provider if route is not None else self.chat_model
+        timeout = timeout or (route.timeout if route is not None else None) or self.timeout
+        options = {"max_tokens": route.max_tokens} if route is not None and route.max_tokens else {}
+        if task is not None:
+            stats = self.task_metrics[task]
+            if escalate:
+                stats.escalations += 1
+            else:
+                stats.calls += 1
+        ### Escalated calls get their own latency metrics
+        if escalate:
+            call_site = f"{call_site}_escalated"
+        return route, model, call_site, timeout, options
+
+    ### Function to count a call slower than the SLO of its route
+    def record_slo(self, task, route, latency):
+        if task is not None and route is not None and route.slo is not None and latency > route.slo:
+            self.task_metrics[task].slo_breaches += 1
+
+    ### Function to get a validated answer: validate(response) returns the answer or None when it is unusable,
+    ### in which case the task's escalation route (the big model) is asked the same prompt
+    def invoke_validated(self, messages, validate, call_site="default", timeout=None, task=None):
+        answer = validate(self.invoke(messages, call_site=call_site, timeout=timeout, task=task))
+        if answer is None and self.record_validation_failure(task):
+            answer = validate(self.invoke(messages, call_site=call_site, timeout=timeout, task=task, escalate=True))
+            if answer is None:
+                self.record_validation_failure(task, escalated=True)
+        return answer
+
+    ### Function to count an unusable answer, returns True when the task can escalate
+    def record_validation_failure(self, task, escalated=False):
+        if task is None:
+            return False
+        stats = self.task_metrics[task]
+        if escalated:
+            stats.escalation_failures += 1
+            return False
+        stats.validation_failures += 1
+        return self.can_escalate(task)
+
+    ### Function to reject a call right away when the circuit of its task is open
+    def check_breaker(self, task, call_site):
+        breaker = self.breakers.get(task)
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for task '{task}', call '{call_site}' rejected")
+        return breaker
+
+    ### Function to get the delay (seconds) after which a call is hedged, None when it must not be
+    def hedge_delay(self, task, call_site, sample):
+        stats = self.metrics[call_site]
+        if task not in self.hedge_tasks or len(sample) < self.hedge_min_samples:
+            return None
+        ### Budget: hedged calls stay below hedge_budget of all calls
+        if stats.hedges >= self.hedge_budget * stats.calls:
+            return None
+        return stats.percentile(sample, 0.95) / 1000
+
+    ### Function to run attempt(timeout) and, when it takes longer than `delay`, race a second copy of it
+    ### Returns the first successful result; results coming later are passed to discard() (e.g. to close a stream).
+    def hedged(self, attempt, delay, deadline, call_site, discard=None):
+        stats = self.metrics[call_site]
+        results = queue.Queue()
+
+        def run(hedge):
+            try:
+                results.put((hedge, attempt(self.remaining(deadline, call_site)), None))
+            except Exception as e:
+                results.put((hedge, None, e))
+            finally:
+                ### The hedge holds its own concurrency slot
+                if hedge:
+                    self.release()
+
+        ### Function that waits in the background for the copies still running and cleans up their results
+        def discard_pending(count):
+            if not count or discard is None:
+                return
+            def drain():
+                for _ in range(count):
+                    _, late, _ = results.get()
+                    if late is not None:
+                        discard(late)
+            threading.Thread(target=drain, daemon=True).start()
+
+        ### Seconds left before the deadline; once it passed the waits below time out at once and
+        ### the copies still running are discarded (remaining() would raise before they are)
+        def left():
+            return max(0.0, deadline - time.monotonic())
+
+        threading.Thread(target=run, args=(False,), daemon=True).start()
+        pending = 1
+        try:
+            outcome = results.get(timeout=min(delay, left()))
+        except queue.Empty:
+            outcome = None
+            ### Only hedge when a slot is free right now and time is left, never queue behind other calls
+            if left() > 0 and self.slots.acquire(blocking=False):
+                with self.lock:
+                    self.in_flight += 1
+                stats.hedges += 1
+                threading.Thread(target=run, args=(True,), daemon=True).start()
+                pending += 1
+
+        error = None
+        while True:
+            if outcome is None:
+                try:
+                    outcome = results.get(timeout=left())
+                except queue.Empty:
+                    ### The copies still running may open a stream after the deadline, close it when they do
+                    discard_pending(pending)
+                    raise LLMTimeoutError(f"LLM call '{call_site}' exceeded its deadline")
+            pending -= 1
+            hedge, result, failure = outcome
+            outcome = None
+            if failure is None:
+                if hedge:
+                    stats.hedge_wins += 1
+                break
+            ### Keep the first error, used for the retry decision when every copy fails
+            error = error or failure
+            if not pending:
+                raise error
+
+        ### Wait for the losing copy in the background and clean up its result
+        discard_pending(pending)
+        return result
+
+    ### Function to get a full completion, returns the model message
+    ### With escalate set the task's escalation route is used instead of its own.
+    def invoke(self, messages, call_site="default", timeout=None, task=None, escalate=False):
+        breaker = self.check_breaker(task, call_site)
+        route, model, call_site, timeout, options = self.prepare(task, call_site, timeout, escalate)
+        started = time.monotonic()
+        deadline = started + (timeout or self.timeout)
+        error = None
+        try:
+            self.acquire(deadline, call_site)
+        except Exception as e:
+            if breaker is not None:
+                breaker.record(time.monotonic() - started, e)
+            raise
+        try:
+            def attempt(left):
+                delay = self.hedge_delay(task, call_site, self.metrics[call_site].latencies_ms)
+                if delay is None:
+                    return model.invoke(messages, timeout=left, **options)
+                return self.hedged(lambda remaining: model.invoke(messages, timeout=remaining, **options), delay, deadline, call_site)
+            response = self.call_with_retries(attempt, deadline, call_site)
+            self.record_usage(call_site, response)
+            self.record_reasoning(
+                call_site, response.content, getattr(response, "usage_metadata", None),
+                latency=time.monotonic() - started,
+                truncated=bool((getattr(response, "response_metadata", None) or {}).get("reasoning_truncated"))
+            )
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release()
+            self.record(call_site, started, error)
+            self.record_slo(task, route, time.monotonic() - started)
+            if breaker is not None:
+                breaker.record(time.monotonic() - started, error)
+
+    ### Function to stream a completion chunk by chunk
+    ### Retries are only possible until the first chunk arrives; the timeout applies to each read.
+    def stream(self, messages, call_site="default", timeout=None, task=None):
+        breaker = self.check_breaker(task, call_site)
+        route, model, call_site, timeout, options = self.prepare(task, call_site, timeout, False)
+        started = time.monotonic()
+        deadline = started + (timeout or self.timeout)
+        error = None
+        ### The breaker judges streams on their time to first chunk
+        first_chunk_at = None
+        ### Streamed text, usage and the end of the <think> block, for the reasoning counters
+        streamed = {"text": [], "usage": None, "think_closed_at": None, "truncated": False}
+        try:
+            self.acquire(deadline, call_site)
+        except Exception as e:
+            if breaker is not None:
+                breaker.record(time.monotonic() - started, e)
+            raise
+        chunks = None
+        try:
+            ### Opening the stream sends the request, so the first chunk is read inside the retry loop
+            def open_stream(left):
+                stream = model.stream(messages, timeout=left, **options)
+                try:
+                    return stream, next(stream)
+                except StopIteration:
+                    return stream, None
+                except Exception:
+                    stream.close()
+                    raise
+            ### Hedging races the opening of a second stream, the losing stream is closed
+            def attempt(left):
+                delay = self.hedge_delay(task, call_site, self.metrics[call_site].first_chunk_ms)
+                if delay is None:
+                    return open_stream(left)
+                return self.hedged(open_stream, delay, deadline, call_site, discard=lambda opened: opened[0].close())
+            chunks, first = self.call_with_retries(attempt, deadline, call_site)
+            first_chunk_at = time.monotonic()
+            self.metrics[call_site].first_chunk_ms.append((first_chunk_at - started) * 1000)
+            if first is None:
+                return
+            self.record_usage(call_site, first)
+            self.observe_chunk(streamed, first)
+            yield first
+            ### Closing this generator early (GeneratorExit) closes the provider stream in finally
+            for chunk in chunks:
+                ### Usage is usually reported on the last chunk only
+                self.record_usage(call_site, chunk)
+                self.observe_chunk(streamed, chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if chunks is not None:
+                chunks.close()
+            self.release()
+            self.record(call_site, started, error)
+            text = "".join(streamed["text"])
+            ### Reasoning lasts until </think>, or the whole stream when it stopped inside the block
+            reasoning_seconds = 0.0
+            if streamed["think_closed_at"]:
+                reasoning_seconds = streamed["think_closed_at"] - started
+            elif THINK_PATTERN.search(text):
+                reasoning_seconds = time.monotonic() - started
+            self.record_reasoning(call_site, text, streamed["usage"], reasoning_seconds=reasoning_seconds,
+                                  truncated=streamed["truncated"])
+            ### Streams are held to the SLO on their time to first chunk
+            self.record_slo(task, route, (first_chunk_at or time.monotonic()) - started)
+            if breaker is not None:
+                breaker.record((first_chunk_at or time.monotonic()) - started, error)
+
+    ### Function that returns the counters of every call site
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "routes": {
+                task: {
+                    "model": route.model,
+                    "slo_s": route.slo,
+                    "max_tokens": route.max_tokens,
+                    "escalate_to": route.escalate_to.model if route.escalate_to is not None else None,
+                    **self.task_metrics[task].snapshot()
+                }
+                for task, route in self.routes.items()
+            },
+            "breakers": {task: breaker.snapshot() for task, breaker in self.breakers.items()},
+            "hedging": {"tasks": sorted(self.hedge_tasks), "budget": self.hedge_budget},
+            "call_sites": {name: stats.snapshot() for name, stats in self.metrics.items()}
+        }
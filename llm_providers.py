@@ -0,0 +1,281 @@
+### AI backends usable by LLMClient next to ChatGroq
+### Every provider has the LangChain chat model interface the client relies on:
+### invoke(messages, timeout=...) -> AIMessage and stream(messages, timeout=...) -> AIMessageChunk iterator.
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+### Function to turn LangChain messages into (role, content) pairs
+def message_pairs(messages):
+    roles = {"system": "system", "human": "user", "ai": "assistant"}
+    return [(roles.get(message.type, "user"), message.content) for message in messages]
+
+### Function to get a stable key of a prompt, used by the stub and the recorder
+def prompt_key(messages):
+    payload = json.dumps(message_pairs(messages), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+### Function to build the usage metadata LangChain attaches to a message
+def usage(input_tokens, output_tokens):
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+###-------------------------------------------------------------------------
+### llama.cpp backend
+
+### Model loaded once in every pool process
+_llama = None
+
+### Function run when a pool process starts: loads the GGUF model
+def _llama_init(model_path, n_ctx, n_threads):
+    global _llama
+    from llama_cpp import Llama
+    _llama = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, verbose=False)
+
+### Function run in a pool process: one chat completion, returns (content, input tokens, output tokens)
+### The completion is streamed so it stops at the deadline (time.time(), shared by the processes) instead of
+### running on after the caller gave up and holding the process the next calls wait for.
+def _llama_chat(pairs, max_tokens, temperature, deadline=None):
+    if deadline is not None and time.time() >= deadline:
+        raise TimeoutError("llama.cpp call started after its deadline")
+    parts, output_tokens = [], 0
+    stream = _llama.create_chat_completion(
+        messages=[{"role": role, "content": content} for role, content in pairs],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True
+    )
+    for chunk in stream:
+        parts.append(chunk["choices"][0]["delta"].get("content") or "")
+        output_tokens += 1
+        if deadline is not None and time.time() >= deadline:
+            stream.close()
+            raise TimeoutError("llama.cpp generation stopped at its deadline")
+    ### Streamed completions carry no usage, the prompt is tokenized for it
+    input_tokens = len(_llama.tokenize("\n".join(content for _, content in pairs).encode("utf-8")))
+    return "".join(parts), input_tokens, output_tokens
+
+### Local llama.cpp model for short tasks (titles, categories)
+### Generation runs in a process pool so it never blocks the web worker's event loop.
+class LlamaCppProvider:
+    def __init__(self, model_path, processes=1, n_ctx=4096, n_threads=None, max_tokens=256, temperature=0.2):
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.pool = ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_llama_init,
+            initargs=(model_path, n_ctx, n_threads)
+        )
+
+    def invoke(self, messages, timeout=None, max_tokens=None, **kwargs):
+        deadline = None if timeout is None else time.time() + timeout
+        future = self.pool.submit(
+            _llama_chat, message_pairs(messages), max_tokens or self.max_tokens, self.temperature, deadline
+        )
+        try:
+            ### Raises TimeoutError when the deadline passes, the generation stops there too
+            content, input_tokens, output_tokens = future.result(timeout=timeout)
+        except TimeoutError:
+            ### Still queued behind another call: it never starts
+            future.cancel()
+            raise
+        return AIMessage(content=content, usage_metadata=usage(input_tokens, output_tokens))
+
+    ### The completion comes back from the pool in one piece
+    def stream(self, messages, timeout=None, **kwargs):
+        message = self.invoke(messages, timeout=timeout, **kwargs)
+        yield AIMessageChunk(content=message.content, usage_metadata=message.usage_metadata)
+
+###-------------------------------------------------------------------------
+### Deterministic stub backend
+
+### Stub for load tests: no network, latency and output length drawn from configurable
+### distributions seeded by the prompt, so the same prompt always behaves the same.
+### Responses recorded by RecordingProvider are replayed when the prompt matches.
+class StubProvider:
+    def __init__(self, task, latency_ms=800, latency_jitter_ms=200, token_ms=10,
+                 tokens=120, tokens_jitter=30, seed=0, replay_path=None):
+        self.task = task
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.token_ms = token_ms
+        self.tokens = tokens
+        self.tokens_jitter = tokens_jitter
+        self.seed = seed
+        self.recordings = {}
+        if replay_path:
+            self.load(replay_path)
+
+    ### Function to load recorded responses (JSON lines written by RecordingProvider)
+    def load(self, path):
+        try:
+            with open(path, encoding="utf-8") as recordings:
+                for line in recordings:
+                    record = json.loads(line)
+                    self.recordings[record["key"]] = record
+        except FileNotFoundError:
+            print(f"⚠️ No recordings to replay at {path}")
+
+    ### Function to get a canned answer in the format the task expects
+    def fake_content(self, messages, rng, tokens):
+        prompt = message_pairs(messages)[0][1] if messages else ""
+        if self.task == "title":
+            return "<TITLE>Stub Title For Product Recommendation Chat</TITLE>"
+        if self.task == "category":
+            ### Pick the first option offered in the prompt (path list or JSON list of names)
+            match = re.search(r"^\s*- (.+)$", prompt, re.MULTILINE) or re.search(r'"([^"]+)"', prompt)
+            choice = match.group(1).strip() if match else "Unknown"
+            if "<CATEGORY>" not in prompt:
+                return choice
+            ### Batch prompts number their products, one answer line each
+            numbers = re.findall(r"^\s*(\d+)\. ", prompt, re.MULTILINE)
+            if numbers:
+                return "\n".join(f"{number}. <CATEGORY>{choice}</CATEGORY>" for number in numbers)
+            return f"<CATEGORY>{choice}</CATEGORY>"
+        words = max(1, tokens // 3)
+        return "\n".join(
+            f"<PRODUCT> - Stub Product {number} - " + " ".join(rng.choice(["solid", "budget", "premium", "reliable", "compact"]) for _ in range(words))
+            for number in range(1, 4)
+        )
+
+    ### Function to draw the response of a prompt: (content, first token delay s, per token delay s, output tokens)
+    ### max_tokens caps the generated length like the real APIs do (recordings are replayed as they are)
+    def plan(self, messages, max_tokens=None):
+        key = prompt_key(messages)
+        rng = random.Random(f"{self.seed}:{key}")
+        recorded = self.recordings.get(key)
+        if recorded:
+            content = recorded["content"]
+            tokens = recorded.get("output_tokens") or max(1, len(content) // 4)
+            first_token = recorded.get("latency_ms", self.latency_ms) / 1000
+            return content, first_token, 0.0, tokens
+        tokens = max(1, int(rng.gauss(self.tokens, self.tokens_jitter)))
+        if max_tokens:
+            tokens = min(tokens, max_tokens)
+        first_token = max(0.0, rng.gauss(self.latency_ms, self.latency_jitter_ms)) / 1000
+        return self.fake_content(messages, rng, tokens), first_token, self.token_ms / 1000, tokens
+
+    def invoke(self, messages, timeout=None, max_tokens=None, **kwargs):
+        content, first_token, per_token, tokens = self.plan(messages, max_tokens)
+        delay = first_token + per_token * tokens
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("Stub response slower than the deadline")
+        time.sleep(delay)
+        input_tokens = sum(len(text) for _, text in message_pairs(messages)) // 4
+        return AIMessage(content=content, usage_metadata=usage(input_tokens, tokens))
+
+    def stream(self, messages, timeout=None, max_tokens=None, **kwargs):
+        content, first_token, per_token, tokens = self.plan(messages, max_tokens)
+        time.sleep(first_token)
+        ### Split the content in roughly `tokens` pieces
+        size = max(1, len(content) // tokens)
+        for start in range(0, len(content), size):
+            if start:
+                time.sleep(per_token)
+            yield AIMessageChunk(content=content[start:start + size])
+        input_tokens = sum(len(text) for _, text in message_pairs(messages)) // 4
+        yield AIMessageChunk(content="", usage_metadata=usage(input_tokens, tokens))
+
+###-------------------------------------------------------------------------
+### Reasoning budget
+
+### Wraps a reasoning model (DeepSeek R1) and cuts its <think> block after `budget_tokens` tokens:
+### the stream is closed, the block is closed and the model is asked to continue from there
+### (assistant prefill), so it answers right away instead of reasoning further.
+class ReasoningBudgetProvider:
+    THINK_OPEN = "<think>"
+    THINK_CLOSE = "</think>"
+
+    def __init__(self, provider, budget_tokens, chars_per_token=4):
+        self.provider = provider
+        self.budget_chars = budget_tokens * chars_per_token
+
+    ### Function to get the length of an unfinished <think> block, None when no block is open
+    def open_think_length(self, text):
+        start = text.find(self.THINK_OPEN)
+        if start < 0 or text.find(self.THINK_CLOSE, start) >= 0:
+            return None
+        return len(text) - start - len(self.THINK_OPEN)
+
+    def stream(self, messages, timeout=None, **kwargs):
+        started = time.monotonic()
+        seen = ""
+        stream = self.provider.stream(messages, timeout=timeout, **kwargs)
+        try:
+            for chunk in stream:
+                seen += chunk.content or ""
+                yield chunk
+                think_length = self.open_think_length(seen)
+                if think_length is not None and think_length > self.budget_chars:
+                    break
+            else:
+                return
+        finally:
+            stream.close()
+
+        ### Budget exhausted: close the block and let the model continue with the answer
+        closing = f"\n{self.THINK_CLOSE}\n\n"
+        yield AIMessageChunk(content=closing, response_metadata={"reasoning_truncated": True})
+        left = None if timeout is None else max(0.1, timeout - (time.monotonic() - started))
+        yield from self.provider.stream(messages + [AIMessage(content=seen + closing)], timeout=left, **kwargs)
+
+    ### Completions are streamed under the hood so the <think> block can be cut
+    def invoke(self, messages, timeout=None, **kwargs):
+        parts, usage_metadata, truncated = [], None, False
+        for chunk in self.stream(messages, timeout=timeout, **kwargs):
+            parts.append(chunk.content or "")
+            truncated = truncated or bool((getattr(chunk, "response_metadata", None) or {}).get("reasoning_truncated"))
+            ### Add up the usage of the original and the continuation requests
+            chunk_usage = getattr(chunk, "usage_metadata", None)
+            if chunk_usage:
+                usage_metadata = usage(
+                    chunk_usage.get("input_tokens", 0) + (usage_metadata or {}).get("input_tokens", 0),
+                    chunk_usage.get("output_tokens", 0) + (usage_metadata or {}).get("output_tokens", 0)
+                )
+        return AIMessage(
+            content="".join(parts),
+            usage_metadata=usage_metadata,
+            response_metadata={"reasoning_truncated": truncated}
+        )
+
+###-------------------------------------------------------------------------
+### Recorder
+
+### Wraps a real provider and appends every response to a JSON lines file for StubProvider replay
+class RecordingProvider:
+    def __init__(self, provider, path):
+        self.provider = provider
+        self.path = path
+        self.lock = threading.Lock()
+
+    ### Function to append one recording
+    def save(self, messages, content, started, usage_metadata=None):
+        record = {
+            "key": prompt_key(messages),
+            "content": content,
+            "latency_ms": round((time.monotonic() - started) * 1000),
+            "output_tokens": (usage_metadata or {}).get("output_tokens")
+        }
+        with self.lock, open(self.path, "a", encoding="utf-8") as recordings:
+            recordings.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def invoke(self, messages, timeout=None, **kwargs):
+        started = time.monotonic()
+        message = self.provider.invoke(messages, timeout=timeout, **kwargs)
+        self.save(messages, message.content, started, getattr(message, "usage_metadata", None))
+        return message
+
+    def stream(self, messages, timeout=None, **kwargs):
+        started = time.monotonic()
+        parts, usage_metadata = [], None
+        for chunk in self.provider.stream(messages, timeout=timeout, **kwargs):
+            parts.append(chunk.content or "")
+            usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+            yield chunk
+        ### Only complete streams are recorded
+        self.save(messages, "".join(parts), started, usage_metadata)
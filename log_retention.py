@@ -0,0 +1,402 @@
+### Retention and archival of the app_logs audit trail
+### app_logs is range-partitioned by month on timestamp (one partition pYYYYMM per month and pmax for
+### anything later). Expired months are streamed to gzip-compressed JSONL archives and then removed with
+### ALTER TABLE ... DROP PARTITION, which costs the same for ten rows or ten million.
+### Log types can be kept shorter or longer than the default number of months:
+### - shorter: their rows are archived and deleted in chunks from the months that are still kept
+### - longer: before a month is dropped their rows are copied into app_logs_retained (small, not
+###   partitioned) and they are archived and deleted from there once their own retention has passed
+### Every row is written to an archive before it is removed from the database.
+import gzip
+import json
+import os
+from datetime import datetime
+from itertools import islice
+from MySQLdb.cursors import SSCursor
+
+### Partitioned table and table holding the rows of the log types kept longer than the default
+LOG_TABLE = "app_logs"
+RETAINED_TABLE = "app_logs_retained"
+### Partition catching every row later than the last monthly partition
+MAX_PARTITION = "pmax"
+ARCHIVE_SUFFIX = ".jsonl.gz"
+
+### Function that returns the first moment of the month of a datetime
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+### Function to move the first day of a month by a number of months
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+### Function that returns the name of the partition of a month, e.g. p202604
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+### Function that returns the partition definition of a month (rows before the first day of the next month)
+def partition_definition(month):
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN ('{add_months(month, 1):%Y-%m-%d %H:%M:%S}')"
+
+### Function to read a retention policy, "LOGIN_FAILED=24,PRODUCT_VIEWED=1" -> {log type: months}
+### Raises ValueError for unknown log types and for values that are not whole months >= 1.
+def parse_policy(text, log_names):
+    policy = {}
+    for item in filter(None, (part.strip() for part in (text or "").split(","))):
+        log_name, _, months = item.partition("=")
+        log_name = log_name.strip().upper()
+        if log_name not in log_names:
+            raise ValueError(f"Unknown log type in retention policy: {log_name}")
+        try:
+            policy[log_name] = int(months)
+        except ValueError:
+            raise ValueError(f"Retention of {log_name} must be a number of months: {months!r}")
+        if policy[log_name] < 1:
+            raise ValueError(f"Retention of {log_name} must be at least 1 month")
+    return policy
+
+###----------------------------------------------------------------------
+### Archives
+
+### Function to write records to a gzip JSONL archive, returns the number of records written
+### The file is written under a temporary name and synced before it is renamed, so an archive that
+### exists is complete; nothing is written when there are no records.
+def write_archive(path, records):
+    temporary_path = path + ".tmp"
+    count = 0
+    with open(temporary_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            for record in records:
+                archive.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                count += 1
+        raw.flush()
+        os.fsync(raw.fileno())
+    if count:
+        os.replace(temporary_path, path)
+    else:
+        os.remove(temporary_path)
+    return count
+
+### Function that returns the archive files of a folder in name order
+def archive_paths(directory):
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(ARCHIVE_SUFFIX)]
+
+### Generator of the records of one archive
+def read_archive(path):
+    with gzip.open(path, "rt", encoding="utf-8") as archive:
+        for line in archive:
+            if line.strip():
+                yield json.loads(line)
+
+### Generator of the records of several archives, one file open at a time
+def read_archives(paths):
+    for path in paths:
+        yield from read_archive(path)
+
+### Generator of the records matching the filters of the log viewer
+def matching_records(records, log_name=None, user_id=None, since=None, until=None, message=None):
+    message = message.lower() if message else None
+    for record in records:
+        if log_name and record.get("log_type") != log_name:
+            continue
+        if user_id is not None and record.get("user_id") != user_id:
+            continue
+        if since or until:
+            timestamp = datetime.fromisoformat(record["timestamp"])
+            if (since and timestamp < since) or (until and timestamp >= until):
+                continue
+        if message and message not in (record.get("message") or "").lower():
+            continue
+        yield record
+
+### Function that scans the archives of a folder lazily: files -> records -> filters -> limit
+def scan_archives(directory, limit=None, **filters):
+    records = matching_records(read_archives(archive_paths(directory)), **filters)
+    return islice(records, limit) if limit else records
+
+###----------------------------------------------------------------------
+### Retention
+
+class LogRetention:
+    def __init__(self, archive_dir, default_months=6, policy=None, months_ahead=3, chunk_size=5000):
+        self.archive_dir = archive_dir
+        ### Months a log is kept when its type has no entry in the policy
+        self.default_months = default_months
+        ### Months kept per log type name
+        self.policy = policy or {}
+        ### Empty monthly partitions kept ready after the current month
+        self.months_ahead = months_ahead
+        ### Rows deleted per statement when a log type expires before its month does
+        self.chunk_size = chunk_size
+
+    ### Function that returns the number of months a log type is kept
+    def months_for(self, log_name):
+        return self.policy.get(log_name, self.default_months)
+
+    ### Function that returns the first timestamp still kept for a retention in months
+    ### Retention counts whole months: with 6 months, in October everything before April 1st expires.
+    @staticmethod
+    def cutoff(months, now):
+        return add_months(month_start(now), -months)
+
+    ###----------------------------------------------------------------------
+    ### Partitions
+
+    ### Function that returns the partitions of app_logs as (name, upper bound), None for MAXVALUE
+    ### The list is empty when the table isn't partitioned.
+    @staticmethod
+    def partitions(cursor):
+        cursor.execute("""
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+        """, (LOG_TABLE,))
+        return [
+            (name, None if description == "MAXVALUE" else datetime.fromisoformat(description.strip("'")))
+            for name, description in cursor.fetchall()
+        ]
+
+    ### Function that partitions app_logs by month, from its oldest row to months_ahead after the current month
+    ### Partitioned InnoDB tables can't have foreign keys, and every unique key must contain the
+    ### partitioning column: the foreign keys of app_logs are dropped and the primary key becomes
+    ### (id, timestamp). The table is rebuilt once, by a single ALTER TABLE.
+    def partition_table(self, connection, now):
+        cursor = connection.cursor()
+        try:
+            if self.partitions(cursor):
+                print(f"ℹ️ {LOG_TABLE} is already partitioned")
+                return False
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.KEY_COLUMN_USAGE
+                WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME = %s
+            """, (LOG_TABLE,))
+            if cursor.fetchone()[0]:
+                raise RuntimeError(f"Other tables reference {LOG_TABLE}, it can't be partitioned")
+            cursor.execute("""
+                SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND NON_UNIQUE = 0 AND INDEX_NAME <> 'PRIMARY'
+            """, (LOG_TABLE,))
+            unique_keys = [row[0] for row in cursor.fetchall()]
+            if unique_keys:
+                raise RuntimeError(f"Unique keys {', '.join(unique_keys)} of {LOG_TABLE} don't contain timestamp")
+
+            cursor.execute("""
+                SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+                WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            """, (LOG_TABLE,))
+            for (constraint_name,) in cursor.fetchall():
+                cursor.execute(f"ALTER TABLE {LOG_TABLE} DROP FOREIGN KEY `{constraint_name}`")
+                print(f"🔓 Dropped foreign key {constraint_name} of {LOG_TABLE}")
+
+            cursor.execute(f"SELECT MIN(timestamp) FROM {LOG_TABLE}")
+            oldest = cursor.fetchone()[0] or now
+            month, last = month_start(oldest), add_months(month_start(now), self.months_ahead)
+            definitions = []
+            while month <= last:
+                definitions.append(partition_definition(month))
+                month = add_months(month, 1)
+            definitions.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN (MAXVALUE)")
+
+            ### RANGE COLUMNS needs DATETIME (not TIMESTAMP), and primary key columns can't be NULL
+            cursor.execute(f"""
+                ALTER TABLE {LOG_TABLE}
+                    MODIFY timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    DROP PRIMARY KEY,
+                    ADD PRIMARY KEY (id, timestamp)
+                PARTITION BY RANGE COLUMNS (timestamp) (
+                    {", ".join(definitions)}
+                )
+            """)
+        finally:
+            cursor.close()
+        print(f"🗂️ {LOG_TABLE} partitioned into {len(definitions)} partitions")
+        return True
+
+    ### Function that splits pmax so that the next months_ahead months have their own partition
+    ### pmax is normally empty, which makes the reorganization instant.
+    def add_partitions(self, connection, now):
+        cursor = connection.cursor()
+        try:
+            monthly = [upper for name, upper in self.partitions(cursor) if upper is not None]
+            if not monthly:
+                return []
+            month, last = monthly[-1], add_months(month_start(now), self.months_ahead)
+            months = []
+            while month <= last:
+                months.append(month)
+                month = add_months(month, 1)
+            if months:
+                cursor.execute(f"""
+                    ALTER TABLE {LOG_TABLE} REORGANIZE PARTITION {MAX_PARTITION} INTO (
+                        {", ".join(partition_definition(month) for month in months)},
+                        PARTITION {MAX_PARTITION} VALUES LESS THAN (MAXVALUE)
+                    )
+                """)
+        finally:
+            cursor.close()
+        return [partition_name(month) for month in months]
+
+    ###----------------------------------------------------------------------
+    ### Export and removal
+
+    ### Function that streams the rows of a table (or of one of its partitions) matching a condition into a new archive
+    ### A server-side cursor reads the rows one by one, so memory use doesn't depend on the partition size.
+    def export(self, connection, table, label, condition, params, type_names, now, partition=None):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{table}-{label}-{now:%Y%m%d%H%M%S}{ARCHIVE_SUFFIX}")
+        source = f"{table} PARTITION ({partition})" if partition else table
+        cursor = connection.cursor(SSCursor)
+        try:
+            cursor.execute(f"""
+                SELECT id, user_id, log_type_id, message, timestamp FROM {source} WHERE {condition}
+            """, params)
+            count = write_archive(path, (
+                {
+                    "id": log_id,
+                    "user_id": user_id,
+                    "log_type_id": log_type_id,
+                    "log_type": type_names.get(log_type_id),
+                    "message": message,
+                    "timestamp": timestamp.isoformat()
+                }
+                for log_id, user_id, log_type_id, message, timestamp in cursor
+            ))
+        finally:
+            cursor.close()
+        return (path if count else None), count
+
+    ### Function that deletes the rows matching a condition in chunks, one short transaction per chunk
+    def delete_rows(self, connection, table, condition, params):
+        cursor = connection.cursor()
+        deleted = 0
+        try:
+            while True:
+                cursor.execute(f"DELETE FROM {table} WHERE {condition} LIMIT %s", list(params) + [self.chunk_size])
+                connection.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < self.chunk_size:
+                    return deleted
+        finally:
+            cursor.close()
+
+    ### Function to count the rows matching a condition (dry runs)
+    @staticmethod
+    def count_rows(connection, source, condition, params):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"SELECT COUNT(*) FROM {source} WHERE {condition}", params)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    ### Function that archives, then deletes, the rows of a table matching a condition
+    def archive_and_delete(self, connection, table, label, condition, params, type_names, now, summary, dry_run):
+        if dry_run:
+            count = self.count_rows(connection, table, condition, params)
+            print(f"🔎 {count} rows of {table} ({label}) would be archived and deleted")
+            summary["archived"] += count
+            return
+        path, count = self.export(connection, table, label, condition, params, type_names, now)
+        if not count:
+            return
+        summary["archives"].append(path)
+        summary["archived"] += count
+        summary["deleted"] += self.delete_rows(connection, table, condition, params)
+        print(f"📦 {count} rows of {table} ({label}) archived to {path} and deleted")
+
+    ###----------------------------------------------------------------------
+    ### Retention run
+
+    ### Function that applies the retention policy once, returns a summary of what was done
+    ### log_types maps the log type names to (log_type_id, is_active), see AuditLogger.log_types().
+    def run(self, connection, log_types, now, dry_run=False):
+        type_names = {log_type_id: log_name for log_name, (log_type_id, _) in log_types.items()}
+        summary = {"partitions_added": [], "partitions_dropped": [], "archives": [],
+                   "archived": 0, "retained": 0, "deleted": 0}
+        cursor = connection.cursor()
+        try:
+            partitions = self.partitions(cursor)
+        finally:
+            cursor.close()
+        if not partitions:
+            raise RuntimeError(f"{LOG_TABLE} is not partitioned, run flask logs-partition first")
+        default_cutoff = self.cutoff(self.default_months, now)
+
+        ### 1. Partitions for the coming months
+        if not dry_run:
+            summary["partitions_added"] = self.add_partitions(connection, now)
+
+        ### 2. Log types kept shorter than the default, within the months that are still kept
+        for log_name, months in sorted(self.policy.items()):
+            if months >= self.default_months or log_name not in log_types:
+                continue
+            self.archive_and_delete(
+                connection, LOG_TABLE, log_name,
+                "log_type_id = %s AND timestamp >= %s AND timestamp < %s",
+                [log_types[log_name][0], default_cutoff, self.cutoff(months, now)],
+                type_names, now, summary, dry_run
+            )
+
+        ### 3. Expired months: archive, copy the rows kept longer, drop the partition
+        kept = [
+            (log_types[log_name][0], self.cutoff(months, now))
+            for log_name, months in sorted(self.policy.items())
+            if months > self.default_months and log_name in log_types
+        ]
+        kept_condition = " OR ".join("(log_type_id = %s AND timestamp >= %s)" for _ in kept) or "FALSE"
+        kept_params = [value for pair in kept for value in pair]
+        ### COALESCE keeps rows without a log type in the archive (NOT NULL would skip them)
+        archived_condition = f"NOT COALESCE({kept_condition}, FALSE)"
+        for partition, upper in partitions:
+            if upper is None or upper > default_cutoff:
+                continue
+            source = f"{LOG_TABLE} PARTITION ({partition})"
+            if dry_run:
+                archived = self.count_rows(connection, source, archived_condition, kept_params)
+                retained = self.count_rows(connection, source, kept_condition, kept_params) if kept else 0
+                print(f"🔎 {partition}: {archived} rows would be archived, {retained} kept, then the partition dropped")
+                summary["archived"] += archived
+                summary["retained"] += retained
+                summary["partitions_dropped"].append(partition)
+                continue
+            path, archived = self.export(connection, LOG_TABLE, partition, archived_condition, kept_params,
+                                         type_names, now, partition=partition)
+            cursor = connection.cursor()
+            try:
+                retained = 0
+                if kept:
+                    ### IGNORE: rows already copied by an interrupted run keep their copy
+                    cursor.execute(f"""
+                        INSERT IGNORE INTO {RETAINED_TABLE} (id, user_id, log_type_id, message, timestamp)
+                        SELECT id, user_id, log_type_id, message, timestamp FROM {source} WHERE {kept_condition}
+                    """, kept_params)
+                    retained = cursor.rowcount
+                    connection.commit()
+                cursor.execute(f"ALTER TABLE {LOG_TABLE} DROP PARTITION {partition}")
+            finally:
+                cursor.close()
+            if path:
+                summary["archives"].append(path)
+            summary["archived"] += archived
+            summary["retained"] += retained
+            summary["partitions_dropped"].append(partition)
+            print(f"🗑️ {partition}: {archived} rows archived, {retained} kept, partition dropped")
+
+        ### 4. Rows kept longer whose own retention has now passed
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"SELECT DISTINCT log_type_id FROM {RETAINED_TABLE}")
+            retained_types = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        for log_type_id in retained_types:
+            log_name = type_names.get(log_type_id)
+            self.archive_and_delete(
+                connection, RETAINED_TABLE, log_name or f"type{log_type_id}",
+                "log_type_id = %s AND timestamp < %s",
+                [log_type_id, self.cutoff(self.months_for(log_name), now)],
+                type_names, now, summary, dry_run
+            )
+        return summary
@@ -0,0 +1,92 @@
+### Hourly counters of the audit trail: one log_rollups row per (hour, log type)
+### The audit log writer already holds entries in memory and writes them in batches; each batch adds its
+### counts to the rollups in the same transaction as the app_logs rows, so counters and logs never disagree
+### and a retried batch isn't counted twice. Charts read the rollups instead of aggregating app_logs,
+### and the counters outlive the log rows removed by the retention.
+from collections import Counter
+from datetime import datetime, timedelta
+
+### Bucket sizes served by rollup_series(), the SQL expression truncating an hour bucket, and the step between buckets
+ROLLUP_BUCKETS = {
+    "hour": ("bucket", timedelta(hours=1)),
+    "day": ("CAST(DATE(bucket) AS DATETIME)", timedelta(days=1))
+}
+### Longest series served, in buckets
+MAX_BUCKETS = 24 * 93
+
+### Function that returns the hour a timestamp belongs to
+def hour_bucket(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+### Function that returns the first bucket of a given size containing a timestamp
+def truncate(timestamp, bucket):
+    if bucket == "day":
+        return datetime(timestamp.year, timestamp.month, timestamp.day)
+    return hour_bucket(timestamp)
+
+### Function to count a batch of audit entries (user_id, log_type_id, message, timestamp) by (hour, log type)
+def rollup_counts(batch):
+    counts = Counter((hour_bucket(timestamp), log_type_id) for _, log_type_id, _, timestamp in batch)
+    return [(bucket, log_type_id, count) for (bucket, log_type_id), count in counts.items()]
+
+### Function that adds counts to the rollups (the caller commits)
+def add_rollups(cursor, counts):
+    if counts:
+        cursor.executemany("""
+            INSERT INTO log_rollups (bucket, log_type_id, count) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+        """, counts)
+
+### Function to rebuild the rollups of [since, until) from the stored logs, one chunk_hours pass per transaction
+### A count is never lowered: logs already removed by the retention were counted when they were written,
+### and running the backfill again changes nothing. progress(until_of_pass, rows) is called after every pass.
+def backfill_rollups(connection, since, until, chunk_hours=24, progress=None):
+    cursor = connection.cursor()
+    start, total = hour_bucket(since), 0
+    try:
+        while start < until:
+            end = min(until, start + timedelta(hours=chunk_hours))
+            cursor.execute("""
+                INSERT INTO log_rollups (bucket, log_type_id, count)
+                SELECT DATE_FORMAT(timestamp, '%%Y-%%m-%%d %%H:00:00'), log_type_id, COUNT(*)
+                FROM (
+                    SELECT timestamp, log_type_id FROM app_logs WHERE timestamp >= %s AND timestamp < %s
+                    UNION ALL
+                    SELECT timestamp, log_type_id FROM app_logs_retained WHERE timestamp >= %s AND timestamp < %s
+                ) logs
+                WHERE log_type_id IS NOT NULL
+                GROUP BY 1, 2
+                ON DUPLICATE KEY UPDATE count = GREATEST(count, VALUES(count))
+            """, (start, end, start, end))
+            connection.commit()
+            total += cursor.rowcount
+            if progress:
+                progress(end, cursor.rowcount)
+            start = end
+    finally:
+        cursor.close()
+    return total
+
+### Function to read the series of some log types: (bucket list, {log_type_id: counts aligned with the buckets})
+### Buckets without a rollup row count 0, so every series has one value per bucket.
+def rollup_series(cursor, log_type_ids, since, until, bucket="hour"):
+    expression, step = ROLLUP_BUCKETS[bucket]
+    buckets, current = [], truncate(since, bucket)
+    while current < until and len(buckets) < MAX_BUCKETS:
+        buckets.append(current)
+        current += step
+    values = {log_type_id: [0] * len(buckets) for log_type_id in log_type_ids}
+    if not buckets or not values:
+        return buckets, values
+    positions = {value: position for position, value in enumerate(buckets)}
+    cursor.execute(f"""
+        SELECT {expression} AS period, log_type_id, SUM(count)
+        FROM log_rollups
+        WHERE bucket >= %s AND bucket < %s AND log_type_id IN ({", ".join(["%s"] * len(values))})
+        GROUP BY period, log_type_id
+    """, [buckets[0], current] + list(values))
+    for period, log_type_id, count in cursor.fetchall():
+        position = positions.get(period)
+        if position is not None:
+            values[log_type_id][position] = int(count)
+    return buckets, values
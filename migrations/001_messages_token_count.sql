@@ -0,0 +1,8 @@
+-- Token count of every message, computed once by save_message()
+ALTER TABLE messages ADD COLUMN token_count INT NULL;
+
+-- Approximate counts for existing messages (about 4 characters per token)
+UPDATE messages SET token_count = CEIL(CHAR_LENGTH(content) / 4) WHERE token_count IS NULL;
+
+-- History is read newest first within a conversation
+CREATE INDEX idx_messages_conversation_message ON messages (conversation_id, message_id);
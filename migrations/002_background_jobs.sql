@@ -0,0 +1,16 @@
+-- Durable queue of background jobs (see jobs.JobRunner)
+CREATE TABLE IF NOT EXISTS background_jobs (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    job_type VARCHAR(64) NOT NULL,
+    payload JSON NOT NULL,
+    status ENUM('pending', 'running', 'done', 'failed') NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 3,
+    run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_by VARCHAR(128) NULL,
+    locked_at DATETIME NULL,
+    last_error TEXT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at DATETIME NULL,
+    INDEX idx_background_jobs_claim (status, run_after, id)
+);
@@ -0,0 +1,9 @@
+-- Progress of resumable batch jobs (last processed id per job)
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    name VARCHAR(64) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Uncategorized products are read in id order
+CREATE INDEX idx_product_suggestions_category_id ON product_suggestions (category_id, id);
@@ -0,0 +1,3 @@
+-- Fingerprint of the keyword set the current title was generated from
+-- (titles are only regenerated when conversations.keywords changes)
+ALTER TABLE conversations ADD COLUMN title_keywords_hash CHAR(64) NULL;
@@ -0,0 +1,3 @@
+-- Version of the conversation row, bumped by every write of a durable field
+-- (keywords, title, is_active); workers compare it with their cached copy of the row
+ALTER TABLE conversations ADD COLUMN version INT UNSIGNED NOT NULL DEFAULT 0;
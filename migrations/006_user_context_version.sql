@@ -0,0 +1,3 @@
+-- Version of the user's profile, bumped by every profile change
+-- (workers compare it with their cached chat context of the user)
+ALTER TABLE users ADD COLUMN context_version INT UNSIGNED NOT NULL DEFAULT 0;
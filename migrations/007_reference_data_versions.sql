@@ -0,0 +1,7 @@
+-- Version of each kind of reference data, bumped by admins after editing the table
+-- (workers reload their in-memory copy when it changes)
+CREATE TABLE IF NOT EXISTS reference_data_versions (
+    name VARCHAR(64) PRIMARY KEY,
+    version INT UNSIGNED NOT NULL DEFAULT 0
+);
+INSERT IGNORE INTO reference_data_versions (name, version) VALUES ('countries', 0);
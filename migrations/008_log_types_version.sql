@@ -0,0 +1,3 @@
+-- Version of the log types, bumped when an admin enables or disables one
+-- (workers read their log type map again when it changes)
+INSERT IGNORE INTO reference_data_versions (name, version) VALUES ('log_types', 0);
@@ -0,0 +1,5 @@
+-- Keyset pagination of the log viewer: every page is read newest first on (timestamp, id),
+-- optionally within one user or one log type
+CREATE INDEX idx_app_logs_timestamp_id ON app_logs (timestamp, id);
+CREATE INDEX idx_app_logs_user_timestamp_id ON app_logs (user_id, timestamp, id);
+CREATE INDEX idx_app_logs_type_timestamp_id ON app_logs (log_type_id, timestamp, id);
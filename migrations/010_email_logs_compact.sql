@@ -0,0 +1,27 @@
+-- Every distinct subject/body of an email template, referenced by the email logs
+CREATE TABLE IF NOT EXISTS email_template_versions (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    template_name VARCHAR(100) NOT NULL,
+    content_hash CHAR(64) NOT NULL,
+    subject TEXT NOT NULL,
+    body MEDIUMTEXT NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_email_template_versions (template_name, content_hash)
+);
+
+-- Email logs keep the template version and the variables (zlib-compressed JSON) instead of the
+-- rendered subject and body; content_compressed holds subject and body when they can't be rendered again
+ALTER TABLE email_logs
+    ADD COLUMN user_id INT NULL,
+    ADD COLUMN template_version_id INT NULL,
+    ADD COLUMN variables VARBINARY(4096) NULL,
+    ADD COLUMN content_compressed MEDIUMBLOB NULL,
+    MODIFY subject TEXT NULL,
+    MODIFY body MEDIUMTEXT NULL;
+
+-- Owner of the existing logs, the viewer looks logs up by user instead of by email address
+UPDATE email_logs el JOIN users u ON u.email = el.recipient_email SET el.user_id = u.id WHERE el.user_id IS NULL;
+
+-- Keyset pagination of the viewer, for one user or for everybody
+CREATE INDEX idx_email_logs_user_sent_id ON email_logs (user_id, sent_at, id);
+CREATE INDEX idx_email_logs_sent_id ON email_logs (sent_at, id);
@@ -0,0 +1,4 @@
+-- Rows of the log types kept longer than the default retention, copied out of app_logs before
+-- their month's partition is dropped (see log_retention.py); app_logs itself is partitioned by
+-- flask logs-partition, which rebuilds the table and is run on purpose rather than by migrate
+CREATE TABLE IF NOT EXISTS app_logs_retained LIKE app_logs;
@@ -0,0 +1,8 @@
+-- Number of audit log entries per hour and log type, added to by every batch the audit writer
+-- inserts; flask rollups-backfill builds it from the logs written before
+CREATE TABLE IF NOT EXISTS log_rollups (
+    bucket DATETIME NOT NULL,
+    log_type_id INT NOT NULL,
+    count BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, log_type_id)
+);
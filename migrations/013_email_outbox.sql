@@ -0,0 +1,18 @@
+-- Emails waiting to be sent, inserted in the transaction of the change they are about and sent by the
+-- background sender (see email_outbox.py); 'dead' emails gave up after max_attempts
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    template_name VARCHAR(100) NOT NULL,
+    recipient_email VARCHAR(255) NOT NULL,
+    variables JSON NOT NULL,
+    status ENUM('pending', 'sending', 'sent', 'dead') NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 5,
+    run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_by VARCHAR(128) NULL,
+    locked_at DATETIME NULL,
+    last_error TEXT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sent_at DATETIME NULL,
+    INDEX idx_email_outbox_claim (status, run_after, id)
+);
@@ -0,0 +1,63 @@
+### Runs the steps of a request as a small dependency graph
+### Every stage is submitted to an executor and starts as soon as the stages it depends on are done,
+### so independent stages run concurrently and the request waits only for its slowest path.
+import time
+from collections import defaultdict, deque
+
+class Pipeline:
+    def __init__(self, executor):
+        self.executor = executor
+        self.stages = {}
+
+    ### Function to add a stage; fn receives the results of the `after` stages as keyword arguments
+    ### Stages must be added after the stages they depend on.
+    def stage(self, name, fn, after=()):
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        self.stages[name] = (fn, tuple(after))
+        return self
+
+    ### Function to run every stage, returns (results by stage, milliseconds by stage, wall milliseconds)
+    def run(self):
+        started = time.perf_counter()
+        futures = {}
+        timings = {}
+
+        def run_stage(name, fn, after):
+            inputs = {dependency: futures[dependency].result() for dependency in after}
+            stage_started = time.perf_counter()
+            try:
+                return fn(**inputs)
+            finally:
+                timings[name] = (time.perf_counter() - stage_started) * 1000
+
+        for name, (fn, after) in self.stages.items():
+            futures[name] = self.executor.submit(run_stage, name, fn, after)
+        results = {name: future.result() for name, future in futures.items()}
+        return results, timings, (time.perf_counter() - started) * 1000
+
+### Rolling timings of the stages of a pipeline
+class PipelineStats:
+    def __init__(self, size=500):
+        self.size = size
+        self.stages = defaultdict(lambda: deque(maxlen=self.size))
+        self.runs = 0
+
+    ### Function to add the timings of one run (wall time and any extra step such as the AI call)
+    def record(self, timings, wall_ms, **extra_ms):
+        self.runs += 1
+        for name, ms in {**timings, **extra_ms}.items():
+            self.stages[name].append(ms)
+        self.stages["pre_llm_wall"].append(wall_ms)
+        self.stages["pre_llm_sum"].append(sum(timings.values()))
+
+    ### Function that returns p50/p95 milliseconds of every stage
+    def snapshot(self):
+        def percentile(values, p):
+            return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else 0.0
+        stages = {}
+        for name, sample in list(self.stages.items()):
+            values = sorted(sample)
+            stages[name] = {"ms_p50": percentile(values, 0.5), "ms_p95": percentile(values, 0.95)}
+        return {"runs": self.runs, "stages": stages}
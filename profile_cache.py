@@ -0,0 +1,95 @@
+### Per-user cache of the profile part of the chat context (age, gender, country and its prompt sentence)
+### Entries carry users.context_version, which every profile change bumps. Callers pass the version
+### they know (kept in the session at login and after an edit): an entry older than that version was
+### changed on another gunicorn worker and is read again, otherwise the chat path reads no profile rows.
+### A newer entry is kept: a session holding an older version (e.g. the profile was edited in another
+### browser) would otherwise read the same newer row again on every message.
+import threading
+from collections import OrderedDict
+
+### Function to build the system prompt sentence describing the user
+def profile_sentence(age, gender, country):
+    sentence = ""
+    if age:
+        ### Age of the user
+        sentence += f" The user is {age} years old."
+    if gender:
+        ### gender of the user
+        sentence += f" The user is a {gender}."
+    if country:
+        ### Country of the user
+        sentence += f" The user is from {country}."
+    return sentence
+
+### Cached profile of one user
+class ProfileContext:
+    __slots__ = ("user_id", "version", "age", "gender", "country", "prompt")
+
+    def __init__(self, user_id, version, age, gender, country):
+        self.user_id = user_id
+        self.version = version
+        self.age = age
+        self.gender = gender
+        self.country = country
+        ### Prompt sentence built once per profile version
+        self.prompt = profile_sentence(age, gender, country)
+
+    ### Function that returns the fields used by the prompt and the reply caches
+    def as_context(self):
+        return {"age": self.age, "gender": self.gender, "country": self.country, "profile_prompt": self.prompt}
+
+class ProfileCache:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        ### Counters
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    ### Function to get the profile of a user, None when it isn't cached or is older than version
+    ### (version None accepts any cached entry, for sessions started before versions were stored)
+    def get(self, user_id, version=None):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and version is not None and entry.version < version:
+                del self.entries[user_id]
+                self.stale += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+    ### Function to cache a profile read from the database, evicting the least recently used
+    def put(self, entry):
+        with self.lock:
+            self.entries[entry.user_id] = entry
+            self.entries.move_to_end(entry.user_id)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return entry
+
+    ### Function to drop the profile of a user after a change
+    def invalidate(self, user_id):
+        with self.lock:
+            if self.entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    ### Function that returns the cache counters
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "stale": self.stale,
+                "invalidations": self.invalidations
+            }
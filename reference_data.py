@@ -0,0 +1,113 @@
+### Registry of reference data read from small tables that almost never change (countries)
+### Every worker loads a snapshot once and serves it from memory: an ordered tuple, an index by code
+### and the prebuilt WTForms choices. Admins bump the version stored in reference_data_versions;
+### workers check it at most every check_interval seconds and swap in a fresh snapshot in one assignment,
+### so readers always see a complete snapshot (the old one or the new one).
+import threading
+import time
+
+### Empty first choice of the select fields
+EMPTY_CHOICE = ('', '-- Select --')
+### Gender options of the registration and profile forms
+GENDER_CHOICES = (EMPTY_CHOICE, ('male', 'Male'), ('female', 'Female'), ('other', 'Other'))
+
+### Immutable snapshot of the countries table
+class CountrySnapshot:
+    __slots__ = ("version", "countries", "names", "choices")
+
+    def __init__(self, version, rows):
+        self.version = version
+        ### (code, name) pairs ordered by name
+        self.countries = tuple((code, name) for code, name in rows)
+        self.names = {code: name for code, name in self.countries}
+        ### WTForms choices: the empty choice, then the countries
+        self.choices = (EMPTY_CHOICE,) + self.countries
+
+class ReferenceData:
+    def __init__(self, connect, check_interval=60.0):
+        ### Context manager lending a DB connection for the (rare) reads of the registry
+        self.connect = connect
+        self.check_interval = check_interval
+        self.snapshot = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        ### Counters
+        self.loads = 0
+        self.checks = 0
+
+    ### Function to read the stored version of a kind of reference data (0 when it was never bumped)
+    @staticmethod
+    def read_version(cursor, name):
+        cursor.execute("SELECT version FROM reference_data_versions WHERE name = %s", (name,))
+        result = cursor.fetchone()
+        return result[0] if result else 0
+
+    ### Function to load a new snapshot of the countries and swap it in
+    def load(self, connection):
+        cursor = connection.cursor()
+        try:
+            version = self.read_version(cursor, "countries")
+            cursor.execute("SELECT code, name FROM countries ORDER BY name")
+            snapshot = CountrySnapshot(version, cursor.fetchall())
+        finally:
+            cursor.close()
+        self.snapshot = snapshot
+        self.checked_at = time.monotonic()
+        self.loads += 1
+        print(f"🌍 Loaded {len(snapshot.countries)} countries (version {version})")
+        return snapshot
+
+    ### Function that returns the current snapshot, loading it the first time and reloading it when the version changed
+    def countries(self):
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() - self.checked_at < self.check_interval:
+            return snapshot
+        if snapshot is None:
+            with self.lock:
+                if self.snapshot is None:
+                    with self.connect() as connection:
+                        self.load(connection)
+                return self.snapshot
+        ### Version check due: one request checks it, the others keep using the current snapshot meanwhile
+        if not self.lock.acquire(blocking=False):
+            return snapshot
+        try:
+            with self.connect() as connection:
+                cursor = connection.cursor()
+                try:
+                    version = self.read_version(cursor, "countries")
+                finally:
+                    cursor.close()
+                self.checks += 1
+                if version != self.snapshot.version:
+                    return self.load(connection)
+            self.checked_at = time.monotonic()
+            return self.snapshot
+        finally:
+            self.lock.release()
+
+    ### Function to bump the version of the countries (after the table was edited) and reload this worker
+    ### The other workers reload within check_interval seconds.
+    def bump(self, connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO reference_data_versions (name, version) VALUES ('countries', 1)
+                ON DUPLICATE KEY UPDATE version = version + 1
+            """)
+            connection.commit()
+        finally:
+            cursor.close()
+        with self.lock:
+            return self.load(connection)
+
+    ### Function that returns the registry counters
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            "version": snapshot.version if snapshot else None,
+            "countries": len(snapshot.countries) if snapshot else 0,
+            "loads": self.loads,
+            "version_checks": self.checks,
+            "check_interval": self.check_interval
+        }
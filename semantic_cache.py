@@ -0,0 +1,130 @@
+### In-memory semantic cache for near-duplicate product queries
+import hashlib
+import re
+import threading
+import time
+from collections import deque
+### Vector maths
+import numpy as np
+### Stateless vectorizer, no fitting needed
+from sklearn.feature_extraction.text import HashingVectorizer, ENGLISH_STOP_WORDS
+
+### Words users use interchangeably in product queries
+SYNONYMS = {
+    "cheap": "budget", "affordable": "budget", "inexpensive": "budget", "low-cost": "budget",
+    "notebook": "laptop", "notebooks": "laptop", "laptops": "laptop",
+    "phone": "smartphone", "phones": "smartphone", "smartphones": "smartphone", "mobile": "smartphone",
+    "earphones": "earbuds", "headphone": "headphones",
+    "top": "best", "good": "best", "great": "best",
+    "gamer": "gaming", "games": "gaming", "game": "gaming",
+}
+
+### Words that appear in most prompts without describing the product
+FILLER_WORDS = {"best", "buy", "need", "want", "looking", "recommend", "recommendation", "suggest", "suggestion", "product", "products"}
+
+### Function to turn a prompt into normalised tokens
+def tokenize(text):
+    words = re.findall(r"[a-z0-9][a-z0-9\-]*", text.lower())
+    tokens = []
+    for word in words:
+        word = SYNONYMS.get(word, word)
+        ### Skip stop words and words that don't describe the product
+        if word in ENGLISH_STOP_WORDS or word in FILLER_WORDS or len(word) < 2:
+            continue
+        tokens.append(word)
+    return tokens
+
+### Function to turn the user context into a signature, replies are only shared between equal contexts
+def context_signature(user_context):
+    user_context = user_context or {}
+    text = "|".join(str(user_context.get(field) or "") for field in ("age", "gender", "country"))
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little", signed=True)
+
+### Semantic cache of recent first-turn prompts.
+### Prompts are stored as L2 normalised rows of a fixed-size matrix used as a ring
+### buffer, so a lookup is a single matrix-vector product over every stored prompt.
+class SemanticCache:
+    def __init__(self, capacity=512, threshold=0.85, n_features=4096, enabled=True):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.enabled = enabled
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features,
+            tokenizer=tokenize,
+            token_pattern=None,
+            lowercase=False,
+            ngram_range=(1, 1),
+            alternate_sign=False,
+            norm="l2"
+        )
+        self.matrix = np.zeros((capacity, n_features), dtype=np.float32)
+        self.contexts = np.zeros(capacity, dtype=np.int64)
+        self.entries = [None] * capacity
+        ### Number of rows in use and the next row to overwrite
+        self.size = 0
+        self.next_row = 0
+        self.lock = threading.Lock()
+        ### Counters
+        self.lookups = 0
+        self.hits = 0
+        self.latencies_ms = deque(maxlen=1000)
+
+    ### Function to vectorize a prompt
+    def vectorize(self, text):
+        return self.vectorizer.transform([text]).toarray()[0].astype(np.float32)
+
+    ### Function to find a cached entry similar to the prompt, returns (entry, similarity) or (None, best similarity)
+    def lookup(self, text, user_context=None):
+        if not self.enabled:
+            return None, 0.0
+        started = time.perf_counter()
+        vector = self.vectorize(text)
+        signature = context_signature(user_context)
+        entry, best = None, 0.0
+        with self.lock:
+            if self.size and vector.any():
+                ### Cosine similarity with every stored prompt in one product (rows are normalised)
+                similarities = self.matrix[:self.size] @ vector
+                ### Ignore prompts asked with a different user context
+                similarities[self.contexts[:self.size] != signature] = -1.0
+                row = int(np.argmax(similarities))
+                best = float(similarities[row])
+                if best >= self.threshold:
+                    entry = self.entries[row]
+            self.lookups += 1
+            if entry is not None:
+                self.hits += 1
+            self.latencies_ms.append((time.perf_counter() - started) * 1000)
+        return entry, best
+
+    ### Function to store a prompt and its structured reply
+    def add(self, text, entry, user_context=None):
+        if not self.enabled:
+            return
+        vector = self.vectorize(text)
+        if not vector.any():
+            return
+        with self.lock:
+            row = self.next_row
+            self.matrix[row] = vector
+            self.contexts[row] = context_signature(user_context)
+            self.entries[row] = entry
+            self.next_row = (row + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+
+    ### Function that returns hit rate and lookup latency counters
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies_ms)
+            lookups, hits, size = self.lookups, self.hits, self.size
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "entries": size,
+            "capacity": self.capacity,
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "lookup_ms_avg": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "lookup_ms_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else 0.0
+        }
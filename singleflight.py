@@ -0,0 +1,54 @@
+### Request coalescing: concurrent calls with the same key share one execution
+### Works for threads and for eventlet greenlets (threading is monkey patched).
+import threading
+
+### One in-flight execution and the callers waiting for it
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        ### Counters
+        self.executions = 0
+        self.coalesced = 0
+
+    ### Function to run fn() once per key at a time; callers arriving meanwhile get the same result (or error)
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self.calls[key] = Call()
+                self.executions += 1
+                leader = True
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    ### Function that returns the counters
+    def stats(self):
+        with self.lock:
+            in_flight = len(self.calls)
+        return {"in_flight": in_flight, "executions": self.executions, "coalesced": self.coalesced}
@@ -0,0 +1,90 @@
+### Local SMTP stand-in for development and tests of the email outbox
+### Speaks enough SMTP for smtplib (EHLO, AUTH PLAIN/LOGIN accepting any password, MAIL, RCPT, DATA, RSET,
+### NOOP, QUIT) and keeps the received messages in memory instead of delivering them. Addresses in reject
+### are refused with 550, and drop_every closes the connection after every N messages, which shows the
+### sender's retries and reconnects without a real mail server.
+import socketserver
+import threading
+from email import message_from_bytes
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    ### Function that writes one reply line
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode("utf-8"))
+
+    def handle(self):
+        server = self.server
+        mail_from, recipients = None, []
+        self.reply("220 smtp-stand-in ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.decode("utf-8", "replace").strip().partition(" ")
+            command = command.upper()
+            if command in ("EHLO", "HELO"):
+                if command == "EHLO":
+                    self.reply("250-smtp-stand-in")
+                    self.reply("250 AUTH PLAIN LOGIN")
+                else:
+                    self.reply("250 smtp-stand-in")
+            elif command == "AUTH":
+                ### AUTH LOGIN asks for the user and the password, AUTH PLAIN has them inline (or asks once)
+                mechanism, _, initial = argument.partition(" ")
+                prompts = 2 if mechanism.upper() == "LOGIN" else (0 if initial else 1)
+                for _ in range(prompts):
+                    self.reply("334 ")
+                    self.rfile.readline()
+                self.reply("235 Authentication successful")
+            elif command == "MAIL":
+                mail_from, recipients = argument.partition(":")[2].strip().strip("<>"), []
+                self.reply("250 OK")
+            elif command == "RCPT":
+                recipient = argument.partition(":")[2].strip().strip("<>")
+                if recipient in server.reject:
+                    self.reply("550 Mailbox unavailable")
+                else:
+                    recipients.append(recipient)
+                    self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    data.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                message = message_from_bytes(b"".join(data))
+                with server.lock:
+                    server.messages.append({"from": mail_from, "to": recipients, "message": message})
+                    count = len(server.messages)
+                print(f"📨 Stand-in received '{message['Subject']}' for {', '.join(recipients)}")
+                self.reply("250 OK")
+                if server.drop_every and count % server.drop_every == 0:
+                    return
+            elif command == "RSET":
+                mail_from, recipients = None, []
+                self.reply("250 OK")
+            elif command == "NOOP":
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+class SmtpStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="localhost", port=1025, reject=(), drop_every=0):
+        super().__init__((host, port), StandInHandler)
+        self.messages = []
+        self.lock = threading.Lock()
+        self.reject = set(reject)
+        self.drop_every = drop_every
+
+    ### Function to serve in a daemon thread (tests), returns the server
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -0,0 +1,191 @@
+### Statements and commits of one chat turn
+### handle_user_message runs against a counting stand-in of the MySQL connection (the request connection,
+### the pooled connections and the job queue all share it), so the test counts every statement the turn sends.
+### A turn reads the conversation, the profile and the history once (nothing when they are cached),
+### writes its rows in one unit of work and queues the title job: one commit each.
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+### app reads the database settings when it is imported, no server is contacted
+os.environ.setdefault("MYSQL_PORT", "3306")
+
+import app as botify
+from conversation_cache import ConversationCache, utc_now
+from profile_cache import ProfileCache
+
+USER_ID = 7
+CONVERSATION_ID = 42
+PRODUCTS = [
+    {"name": "Trail shoes", "description": "Light shoes for rocky paths"},
+    {"name": "Rain jacket", "description": "Packable waterproof jacket"}
+]
+
+### Counting stand-in of a MySQLdb connection, answering the reads of a chat turn
+### (the pre-LLM reads run concurrently on pooled connections, hence the lock)
+class CountingConnection:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.last_id = 1000
+        ### Row returned by the conversation read, None when the conversation can't be read
+        self.conversation_row = (USER_ID, "Chat Session", "Hiking", True, utc_now(), 3)
+        self.lock = threading.Lock()
+
+    def cursor(self):
+        return CountingCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def autocommit(self, on):
+        pass
+
+    ### Function that returns the statements sent so far whose text contains a fragment
+    def matching(self, fragment):
+        return [sql for sql in self.statements if fragment in sql]
+
+class CountingCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.lastrowid = None
+        self.rowcount = -1
+
+    ### Function that counts a statement and prepares its result
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        connection = self.connection
+        with connection.lock:
+            connection.statements.append(sql)
+            if sql.startswith("SHOW SESSION STATUS"):
+                ### MySQL counts the SHOW query itself in Questions
+                self.rows = [("Questions", len(connection.statements)), ("Com_commit", connection.commits)]
+            elif "FROM conversations" in sql:
+                self.rows = [connection.conversation_row] if connection.conversation_row else []
+            elif "FROM users" in sql:
+                self.rows = [(1, 34, "Female", "Norway")]
+            elif "FROM messages" in sql:
+                self.rows = [("bot", "What are you looking for?", 6), ("user", "Hello", 1)]
+            else:
+                self.rows = []
+            if sql.startswith("INSERT"):
+                connection.last_id += 1
+                self.lastrowid = connection.last_id
+            self.rowcount = 1
+
+    ### MySQLdb sends an executemany INSERT as one multi-row statement
+    def executemany(self, sql, params):
+        self.execute(sql)
+        self.rowcount = len(params)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+### Pool lending the counting connection
+class CountingPool:
+    def __init__(self, connection):
+        self.stand_in = connection
+
+    @contextmanager
+    def connection(self):
+        yield self.stand_in
+
+### Audit logger keeping the entries in memory (they are written by its own background batches)
+class RecordingAuditLogger:
+    def __init__(self):
+        self.entries = []
+
+    def log(self, log_type, message, user_id=None):
+        self.entries.append((log_type, message, user_id))
+
+@pytest.fixture
+def turn(monkeypatch):
+    connection = CountingConnection()
+    emitted = []
+    monkeypatch.setattr(type(botify.mysql), "connection", property(lambda self: connection))
+    monkeypatch.setattr(botify, "db_pool", CountingPool(connection))
+    monkeypatch.setattr(botify, "conversation_cache", ConversationCache(max_messages=botify.MAX_HISTORY_MESSAGES))
+    monkeypatch.setattr(botify, "profile_cache", ProfileCache())
+    monkeypatch.setattr(botify, "audit_logger", RecordingAuditLogger())
+    monkeypatch.setattr(botify, "emit", lambda event, payload: emitted.append((event, payload)))
+    monkeypatch.setattr(botify, "ask_deepseek", lambda *args, **kwargs: ("Two picks for the trail", PRODUCTS))
+    ### Token counts without the tiktoken download
+    monkeypatch.setattr(botify, "count_tokens", lambda text: len(text or "") // 4 + 1)
+    monkeypatch.setattr(botify, "AUTO_CATEGORIZE_PRODUCTS", False)
+    ### Jobs are queued in the database, no worker is started
+    monkeypatch.setattr(botify.job_runner, "start", lambda: None)
+
+    ### Function that runs one chat turn of the user in the conversation, returns the counting connection
+    def run(content="I need shoes and a jacket for hiking in the rain"):
+        with botify.app.test_request_context():
+            botify.session["user_id"] = USER_ID
+            botify.session["conversation_id"] = CONVERSATION_ID
+            botify.handle_user_message({"content": content, "stream": False})
+        return connection
+
+    run.emitted = emitted
+    run.connection = connection
+    return run
+
+### First turn of a worker: the conversation, the profile and the history are read once
+def test_chat_turn_with_cold_caches(turn):
+    connection = turn()
+
+    assert len(connection.matching("FROM conversations")) == 1
+    assert len(connection.matching("FROM users")) == 1
+    assert len(connection.matching("FROM messages")) == 1
+    ### User message, keywords, bot message and products in one unit of work, then the title job
+    assert len(connection.matching("INSERT INTO messages")) == 2
+    assert len(connection.matching("UPDATE conversations")) == 1
+    assert len(connection.matching("INSERT INTO product_suggestions")) == 1
+    assert len(connection.matching("INSERT INTO background_jobs")) == 1
+    assert len(connection.statements) == 8
+    assert connection.commits == 2
+    assert connection.rollbacks == 0
+    assert turn.emitted[-1][0] == "bot_reply"
+
+### Next turns of the conversation read nothing: only the writes and the title job are sent
+def test_chat_turn_with_warm_caches(turn):
+    connection = turn()
+    statements, commits = len(connection.statements), connection.commits
+
+    turn("Which of them is lighter?")
+
+    assert not [sql for sql in connection.statements[statements:] if sql.startswith("SELECT")]
+    assert len(connection.statements) - statements == 5
+    assert connection.commits - commits == 2
+
+### Without a cached version the keywords are updated without comparing it, and no conflict is taken
+def test_chat_turn_without_cached_version(turn):
+    turn.connection.conversation_row = None
+    connection = turn()
+
+    updates = connection.matching("UPDATE conversations")
+    assert len(updates) == 1
+    assert "version = %s" not in updates[0]
+    assert not connection.matching("FOR UPDATE")
+    assert connection.commits == 2
+
+### The runtime counters (DB_STATEMENT_STATS) report the same counts, without their own SHOW queries
+def test_chat_turn_statement_stats(turn, monkeypatch):
+    monkeypatch.setattr(botify, "DB_STATEMENT_STATS", True)
+    monkeypatch.setattr(botify, "db_turn_stats", {"turns": 0, "statements": 0, "commits": 0, "last": None})
+
+    turn()
+
+    assert botify.db_turn_stats["last"] == {"statements": 8, "commits": 2}
@@ -0,0 +1,40 @@
+### Version checks of the profile cache
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profile_cache import ProfileCache, ProfileContext
+
+USER_ID = 7
+
+### Function that returns a cache holding the profile of the user at a version
+def cache_with(version):
+    cache = ProfileCache()
+    cache.put(ProfileContext(USER_ID, version, 34, "Female", "Norway"))
+    return cache
+
+### A profile changed on another worker is read again
+def test_entry_older_than_the_session_version_is_stale():
+    cache = cache_with(3)
+
+    assert cache.get(USER_ID, 4) is None
+    assert cache.stats()["stale"] == 1
+    assert cache.get(USER_ID) is None
+
+### A session holding an older version (the profile was edited in another browser) keeps the newer entry
+def test_session_holding_an_older_version_keeps_the_entry():
+    cache = cache_with(4)
+
+    for _ in range(3):
+        assert cache.get(USER_ID, 3).version == 4
+    assert cache.stats()["stale"] == 0
+    assert cache.stats()["hits"] == 3
+
+### The session version matches the entry, or the session has no version yet
+def test_same_or_unknown_version_hits():
+    cache = cache_with(4)
+
+    assert cache.get(USER_ID, 4).version == 4
+    assert cache.get(USER_ID).version == 4
+    assert cache.stats()["misses"] == 0
@@ -0,0 +1,65 @@
+### Request-scoped unit of work
+### Writes of a request are queued and flushed together in one transaction at the end
+### (the rows a chat turn reads come from the conversation and profile caches).
+class UnitOfWork:
+    def __init__(self, connection):
+        self.connection = connection
+        self.writes = []
+        ### Row ids of the flushed INSERTs and rows affected by the flushed statements, by name
+        self.ids = {}
+        self.rowcounts = {}
+        ### Functions called with the ids once the writes are committed
+        self.callbacks = []
+
+    ### Function to queue a write
+    ### params can be a function of the ids of the earlier writes (e.g. a message id needed by its products);
+    ### name stores the id of the inserted row (and the affected rows), many runs the statement with executemany.
+    def add(self, sql, params=(), name=None, many=False):
+        self.writes.append((sql, params, name, many))
+
+    ### Function to queue a function called with the ids after the writes are committed (e.g. an audit log entry)
+    def after_flush(self, callback):
+        self.callbacks.append(callback)
+
+    ### Function to run every queued write in a single transaction, returns the ids by name
+    def flush(self):
+        if not self.writes:
+            self.run_callbacks()
+            return self.ids
+        writes, self.writes = self.writes, []
+        cursor = self.connection.cursor()
+        try:
+            for sql, params, name, many in writes:
+                if callable(params):
+                    params = params(self.ids)
+                if many:
+                    if params:
+                        cursor.executemany(sql, params)
+                else:
+                    cursor.execute(sql, params)
+                if name:
+                    self.ids[name] = cursor.lastrowid
+                    self.rowcounts[name] = cursor.rowcount
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.run_callbacks()
+        return self.ids
+
+    ### Function to call the after_flush functions
+    def run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self.ids)
+
+### Function that returns how many statements and commits the connection's MySQL session has run
+### (the query itself counts as one statement)
+def session_statement_counts(connection):
+    cursor = connection.cursor()
+    cursor.execute("SHOW SESSION STATUS WHERE Variable_name IN ('Questions', 'Com_commit')")
+    counts = {name: int(value) for name, value in cursor.fetchall()}
+    cursor.close()
+    return counts.get("Questions", 0), counts.get("Com_commit", 0)